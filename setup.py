@@ -30,5 +30,6 @@ setup(name=PACKAGE_NAME,
     url=URL,
     install_requires=INSTALL_REQUIRES,
     package_dir={"": "src"},
-    packages=find_packages(where="src")
+    packages=find_packages(where="src"),
+    entry_points={"console_scripts": ["thumb=thumb.cli:main"]},
     )
\ No newline at end of file
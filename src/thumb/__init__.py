@@ -1,2 +1,3 @@
-from .core import test, load
-from .core import ThumbTest
\ No newline at end of file
+from .core import test, load, migrate
+from .core import ThumbTest
+from .merge import merge_tests
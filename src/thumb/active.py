@@ -0,0 +1,110 @@
+import random
+
+import numpy as np
+
+# posterior draws used to estimate how likely each variant is to be the best
+N_SAMPLES = 2000
+
+
+class ActiveQueue:
+    """
+    Orders unlabeled responses so each thumbs up / down does the most to settle which prompt (by="pid") or model
+    (by="model") is best. Every (pid, cid, model) cell has a Beta posterior over its thumbs up rate, and a variant's
+    score is the average over its cases. After each label the next response comes from the cell, of the leader or
+    its closest challenger, whose next label would shrink the uncertainty of that variant's score the most.
+    """
+
+    def __init__(self, responses, groups, by="pid", n_samples=N_SAMPLES, seed=None):
+        self.by = by
+        self.random = random.Random(seed)
+        self.rng = np.random.default_rng(seed)
+
+        # cell -> unlabeled responses, in a random order
+        self.queues = {}
+        for response in responses:
+            self.queues.setdefault((response['pid'], response['cid'], response['model']), []).append(response)
+        for queue in self.queues.values():
+            self.random.shuffle(queue)
+
+        # labels so far in every cell that has responses, from the test's totals
+        self.cells = sorted(set(groups) | set(self.queues))
+        self.cell_index = {cell: i for i, cell in enumerate(self.cells)}
+        self.successes = np.array([groups[cell].feedback if cell in groups else 0 for cell in self.cells], dtype=float)
+        self.failures = np.array([groups[cell].labeled if cell in groups else 0 for cell in self.cells], dtype=float) - self.successes
+
+        position = 0 if by == "pid" else 2
+        self.variants = sorted({cell[position] for cell in self.cells})
+        variant_index = {variant: i for i, variant in enumerate(self.variants)}
+        self.cell_variant = np.array([variant_index[cell[position]] for cell in self.cells], dtype=int)
+        self.cell_counts = np.bincount(self.cell_variant, minlength=len(self.variants)).astype(float)
+
+        # each variant's score in every draw, the average of its cells' draws
+        self.draws = self.rng.beta(1 + self.successes[:, None], 1 + self.failures[:, None], size=(len(self.cells), n_samples))
+        self.scores = np.zeros((len(self.variants), n_samples))
+        np.add.at(self.scores, self.cell_variant, self.draws / self.cell_counts[self.cell_variant, None])
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def probabilities(self):
+        """
+        The probability each variant has the best thumbs up rate, averaged over cases.
+        """
+        if not self.variants:
+            return {}
+        best = np.bincount(self.scores.argmax(axis=0), minlength=len(self.variants)) / self.scores.shape[1]
+        return dict(zip(self.variants, best))
+
+    def leader(self):
+        # the variant most likely to be best, and how likely that is
+        probabilities = self.probabilities()
+        if not probabilities:
+            return None, 0.0
+        variant = max(probabilities, key=probabilities.get)
+        return variant, probabilities[variant]
+
+    def stable(self, threshold=0.95):
+        """
+        Whether one variant is the best with at least the given probability, when there's more than one to choose from.
+        """
+        return len(self.variants) > 1 and self.leader()[1] >= threshold
+
+    def _variance_reduction(self):
+        # how much one more label in each cell would shrink the variance of its variant's score
+        a, b = 1 + self.successes, 1 + self.failures
+        variance = a * b / ((a + b) ** 2 * (a + b + 1))
+        return variance / (a + b + 1) / self.cell_counts[self.cell_variant] ** 2
+
+    def pop(self):
+        """
+        The next response to label, or None once every response has been labeled.
+        """
+        open_cells = np.array([bool(self.queues.get(cell)) for cell in self.cells], dtype=bool)
+        if not open_cells.any():
+            return None
+
+        # the contest that decides the ranking is between the leader and whichever variant is closest behind it
+        probabilities = np.bincount(self.scores.argmax(axis=0), minlength=len(self.variants)).astype(float)
+        contenders = np.argsort(-(probabilities + 1e-9 * self.scores.mean(axis=1)))[:2]
+        candidates = open_cells & np.isin(self.cell_variant, contenders)
+        if not candidates.any():
+            candidates = open_cells
+
+        reduction = np.where(candidates, self._variance_reduction(), -np.inf)
+        # break ties at random so equally useful cells all get their turn
+        best = np.flatnonzero(reduction >= reduction.max() * (1 - 1e-9))
+        cell = self.cells[self.random.choice(list(best))]
+        return self.queues[cell].pop()
+
+    def add_feedback(self, pid, cid, model, value):
+        """
+        Counts a new label, redrawing only its cell's posterior.
+        """
+        i = self.cell_index.get((pid, cid, model))
+        if i is None:
+            return
+        self.successes[i] += value
+        self.failures[i] += 1 - value
+        draws = self.rng.beta(1 + self.successes[i], 1 + self.failures[i], size=self.draws.shape[1])
+        self.scores[self.cell_variant[i]] += (draws - self.draws[i]) / self.cell_counts[self.cell_variant[i]]
+        self.draws[i] = draws
@@ -1,4 +1,8 @@
+import json
+import random
+
 from .llm import format_chat_prompt
+from .utils import escape_braces
 
 
 def build_candidate_prompt(task_description, prompt_template, test_cases=None, criteria=None):
@@ -24,27 +28,41 @@ ALWAYS USE MULTIPLE EXAMPLES THAT ARE VERY DIFFERENT FROM ANY TEST CASES PROVIDE
     test_cases_partial = ""
     unique_keys = set()
 
+    # accept the cases dict of a test as well as a plain list
+    if isinstance(test_cases, dict):
+        test_cases = list(test_cases.values())
+    test_cases = [test_case for test_case in (test_cases or []) if test_case]
+
     if len(test_cases) > 0:
         test_cases_partial += "Here are some test case scenarios and their example outputs:\n"
         
         for idx, test_case in enumerate(test_cases):
-            reference = test_case["__ref__"]
-            del test_case["__ref__"]
+            # copy so the reference isn't removed from the caller's test case
+            test_case = dict(test_case)
+            reference = test_case.pop("__ref__", None)
 
             case_str = ""
             for key, value in test_case.items():
-                case_str += f"""- {key}: "{value}"\n"""
+                case_str += f"""- {key}: "{escape_braces(str(value))}"\n"""
                 unique_keys.add(key)
                 
-            test_cases_partial += (f"""## Test case {idx+1}\nInput variables:\n{case_str.strip()}\nExpected output:\n{reference}\n\n""")
+            test_cases_partial += f"""## Test case {idx+1}\nInput variables:\n{case_str.strip()}\n"""
+            if reference is not None:
+                test_cases_partial += f"""Expected output:\n{escape_braces(str(reference))}\n"""
+            test_cases_partial += "\n"
         test_cases_partial = f"\n\n{test_cases_partial.strip()}"
 
     criteria_partial = build_criteria_partial(criteria, unique_keys)
 
+    if isinstance(prompt_template, list):
+        prompt_template = "\n\n".join(prompt_template)
+
     candidate_prompt = "Here is the descripton of the task:\n"
-    candidate_prompt += task_description
-    candidate_prompt += "\n\nHere is the prompt template to optimize:\n"
-    candidate_prompt += prompt_template + test_cases_partial + criteria_partial
+    candidate_prompt += escape_braces(task_description)
+    if prompt_template:
+        candidate_prompt += "\n\nHere is the prompt template to optimize:\n"
+        candidate_prompt += escape_braces(prompt_template)
+    candidate_prompt += test_cases_partial + criteria_partial
     candidate_prompt += "\n\nRespond only with your optimized prompt template."
     
     formatted_candidate_prompt = format_chat_prompt([SYSTEM_PROMPT, candidate_prompt])
@@ -67,10 +85,10 @@ Respond with your rating, and nothing else. Be fair and unbiased in your judgeme
     criteria_partial = build_criteria_partial(criteria)
 
     rating_prompt = "Here is the descripton of the task:\n"
-    rating_prompt += task_description
+    rating_prompt += escape_braces(task_description)
 
     rating_prompt += "\n\nHere is the AI response:\n"
-    rating_prompt += "```" + response + "```"
+    rating_prompt += "```" + escape_braces(response) + "```"
 
     rating_prompt += criteria_partial
 
@@ -81,12 +99,14 @@ Respond with your rating, and nothing else. Be fair and unbiased in your judgeme
 def build_criteria_partial(criteria, unique_keys=set()):
     criteria_partial = "The prompt will be deemed successful if it generates responses that meet the following criteria:\n"
 
+    # copy so the default criterion isn't added to the caller's list
+    criteria = list(criteria or [])
     if len(criteria) == 0:
         ## https://github.com/langchain-ai/langchain/blob/a830b809f39f05026ad32ca1c33c39da7b2bd160/libs/langchain/langchain/evaluation/criteria/eval_chain.py#L45
         criteria.append("Is the submission helpful, insightful, and appropriate?")
 
     for criterion in criteria:
-        criteria_partial += f"- {criterion}\n"
+        criteria_partial += f"- {escape_braces(criterion)}\n"
 
     if len(unique_keys) > 0:
         for key in unique_keys:
@@ -95,7 +115,7 @@ def build_criteria_partial(criteria, unique_keys=set()):
     criteria_partial = f"\n\n{criteria_partial.strip()}"
     return criteria_partial
 
-def build_case_prompt(prompt_template, test_cases=None):
+def build_case_prompt(prompt_template, test_cases=None, max_examples=10):
     SYSTEM_PROMPT = """Your job is to create a test case for a given prompt template that completes a specific task using AI.
 The test case you will be creating will be for freeform tasks, such as generating a landing page headline, an intro paragraph, solving a math problem, etc.
 
@@ -127,14 +147,48 @@ YOU NEVER OUTPUT SOMETHING THAT COMPLETES THE TASK. ONLY A TEST CASE.
 Most importantly, output NOTHING but the test case. Do not include anything else in your message.
 You only output one test case per message, in JSON format."""
 
+    if isinstance(prompt_template, list):
+        prompt_template = "\n\n".join(prompt_template)
+
+    # accept the cases dict of a test as well as a plain list
+    if isinstance(test_cases, dict):
+        test_cases = list(test_cases.values())
+    test_cases = [test_case for test_case in (test_cases or []) if test_case]
+    # a random sample of examples keeps the prompt short and the new cases varied
+    if len(test_cases) > max_examples:
+        test_cases = random.sample(test_cases, max_examples)
+
     case_prompt = "Here is the prompt template to create a test case for:\n"
-    case_prompt += prompt_template
+    case_prompt += escape_braces(prompt_template)
 
     if len(test_cases) > 0:
         case_prompt += "\n\nHere are some examples of existing test cases for this prompt:\n"
         for test_case in test_cases:
-            case_prompt += f"- Test case: {test_case}\n"
+            case_prompt += f"- Test case: {escape_braces(json.dumps(test_case))}\n"
 
     formatted_case_prompt = format_chat_prompt([SYSTEM_PROMPT, case_prompt])
 
-    return formatted_case_prompt
\ No newline at end of file
+    return formatted_case_prompt
+
+def parse_case(content, input_variables):
+    """
+    Parses a generated test case from JSON, returning None if it doesn't have a value for every input variable.
+    """
+    # models sometimes wrap the JSON in a code block or add text around it
+    start, end = content.find("{"), content.rfind("}")
+    if start == -1 or end == -1:
+        return None
+    try:
+        case = json.loads(content[start:end+1])
+    except json.JSONDecodeError:
+        return None
+
+    if not isinstance(case, dict):
+        return None
+    for variable in input_variables:
+        value = case.get(variable)
+        if value is None or isinstance(value, (dict, list)) or str(value).strip() == "":
+            return None
+
+    # drop any keys the prompts don't use, keeping the reference answer if there is one
+    return {key: value for key, value in case.items() if key in input_variables or key == "__ref__"}
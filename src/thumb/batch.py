@@ -0,0 +1,278 @@
+import os
+import json
+import time
+import threading
+from uuid import uuid4
+from urllib import request, error
+from urllib.parse import quote, unquote
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .llm import format_chat_prompt, messages_to_openai, function_call_fields
+from .pricing import estimate_cost, cached_tokens
+
+ENDPOINT = "/v1/chat/completions"
+
+
+def encode_custom_id(pid, cid, model, run):
+    # the same run always gets the same id, so results can be matched back whenever they arrive
+    return "/".join([quote(str(part), safe="") for part in (pid, cid, model, run)])
+
+
+def decode_custom_id(custom_id):
+    pid, cid, model, run = [unquote(part) for part in custom_id.split("/")]
+    return pid, cid, model, int(run)
+
+
+def write_batch_file(required_runs, file_path):
+    """
+    Writes the required runs as a JSONL file of chat completion requests, one per line. Returns how many were written.
+    """
+    formatted_key, messages = None, None
+    count = 0
+    with open(file_path, "w") as file:
+        for item in required_runs:
+            # runs come grouped by prompt and case, so each combination only needs formatting once
+            key = (item["pid"], item["cid"])
+            if key != formatted_key:
+                formatted_key, messages = key, messages_to_openai(format_chat_prompt(item["prompt"], item["test_case"]))
+
+            body = {"model": item.get("model_name", item["model"]), "messages": messages, **(item.get("params") or {})}
+            if item.get("temperature") is not None:
+                body["temperature"] = item["temperature"]
+
+            line = {
+                "custom_id": encode_custom_id(item["pid"], item["cid"], item["model"], item["run"]),
+                "method": "POST",
+                "url": ENDPOINT,
+                "body": body,
+            }
+            file.write(json.dumps(line) + "\n")
+            count += 1
+    return count
+
+
+def parse_batch_result(line):
+    """
+    Turns one line of a batch result file into (pid, cid, model, run, response).
+    """
+    result = json.loads(line)
+    pid, cid, model, run = decode_custom_id(result["custom_id"])
+
+    response = result.get("response") or {}
+    body = response.get("body") or {}
+    if result.get("error") or response.get("status_code", 200) != 200 or "choices" not in body:
+        message = result.get("error") or body.get("error") or "Batch request failed"
+        if isinstance(message, dict):
+            message = message.get("message", json.dumps(message))
+        return pid, cid, model, run, {"content": str(message), "error": True}
+
+    usage = body.get("usage") or {}
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    cached = cached_tokens(usage)
+    message = body["choices"][0]["message"]
+    response_data = {
+        "content": message.get("content") or "",
+        "tokens": usage.get("total_tokens", prompt_tokens + completion_tokens) or 0,
+        # the batch API is billed at a discount
+        "cost": estimate_cost(prompt_tokens, completion_tokens, body.get("model", model), tier="batch", cached_tokens=cached) or 0,
+        "prompt_tokens": prompt_tokens or 0,
+        "completion_tokens": completion_tokens or 0,
+        "tier": "batch",
+        **function_call_fields(message, message.get("content")),
+    }
+    if cached:
+        response_data["cached_tokens"] = cached
+    return pid, cid, model, run, response_data
+
+
+def read_batch_results(file_path):
+    """
+    Yields (pid, cid, model, run, response) for every line of a batch result file.
+    """
+    with open(file_path, "r") as file:
+        for line in file:
+            if line.strip():
+                yield parse_batch_result(line)
+
+
+class BatchClient:
+    """
+    Uploads job files and manages batches through an OpenAI compatible batch API.
+    Point base_url at another server (like LocalBatchServer) to test without calling the real API.
+    """
+
+    def __init__(self, base_url=None, api_key=None, timeout=60):
+        self.base_url = (base_url or os.environ.get("OPENAI_BASE_URL") or "https://api.openai.com/v1").rstrip("/")
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY", "")
+        self.timeout = timeout
+
+    def _request(self, method, path, data=None, headers=None):
+        headers = {"Authorization": f"Bearer {self.api_key}", **(headers or {})}
+        if isinstance(data, dict):
+            data = json.dumps(data).encode()
+            headers["Content-Type"] = "application/json"
+        req = request.Request(f"{self.base_url}{path}", data=data, headers=headers, method=method)
+        try:
+            return request.urlopen(req, timeout=self.timeout)
+        except error.HTTPError as e:
+            raise RuntimeError(f"Batch API request to {path} failed with {e.code}: {e.read().decode(errors='replace')}")
+
+    def _json(self, method, path, data=None, headers=None):
+        with self._request(method, path, data, headers) as resp:
+            return json.loads(resp.read())
+
+    def upload_file(self, file_path, purpose="batch"):
+        boundary = uuid4().hex
+        with open(file_path, "rb") as file:
+            content = file.read()
+        body = (
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"purpose\"\r\n\r\n{purpose}\r\n"
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{os.path.basename(file_path)}\"\r\n"
+            f"Content-Type: application/jsonl\r\n\r\n"
+        ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+        return self._json("POST", "/files", body, {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+
+    def create_batch(self, input_file_id, completion_window="24h", metadata=None):
+        data = {"input_file_id": input_file_id, "endpoint": ENDPOINT, "completion_window": completion_window}
+        if metadata:
+            data["metadata"] = metadata
+        return self._json("POST", "/batches", data)
+
+    def retrieve_batch(self, batch_id):
+        return self._json("GET", f"/batches/{batch_id}")
+
+    def cancel_batch(self, batch_id):
+        return self._json("POST", f"/batches/{batch_id}/cancel")
+
+    def download_file(self, file_id, file_path, chunk_size=1 << 20):
+        # streamed to disk, result files for big sweeps can be large
+        with self._request("GET", f"/files/{file_id}/content") as resp, open(file_path, "wb") as file:
+            while True:
+                chunk = resp.read(chunk_size)
+                if not chunk:
+                    break
+                file.write(chunk)
+        return file_path
+
+
+def echo_responder(body):
+    # the default local server reply, repeats back the last message
+    return f"Echo: {body['messages'][-1]['content']}"
+
+
+class LocalBatchServer:
+    """
+    A minimal stand-in for the batch API that runs in a background thread. Batches complete as soon as they're created,
+    with each request answered by the responder function (given the request body, returning the content).
+    """
+
+    def __init__(self, responder=None, host="127.0.0.1", port=0):
+        self.responder = responder or echo_responder
+        self.files = {}
+        self.batches = {}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, data, content_type="application/json"):
+                if not isinstance(data, bytes):
+                    data = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _body(self):
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def do_POST(self):
+                path = self.path.split("/v1", 1)[-1]
+                if path == "/files":
+                    message = BytesParser().parsebytes(
+                        f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + self._body()
+                    )
+                    parts = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True) for part in message.get_payload()}
+                    self._send(200, server._add_file(parts["file"]))
+                elif path == "/batches":
+                    self._send(200, server._run_batch(json.loads(self._body())))
+                elif path.startswith("/batches/") and path.endswith("/cancel"):
+                    batch = server.batches.get(path.split("/")[2])
+                    self._send(200 if batch else 404, batch or {"error": {"message": "No such batch"}})
+                else:
+                    self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+            def do_GET(self):
+                path = self.path.split("/v1", 1)[-1]
+                parts = path.strip("/").split("/")
+                if parts[0] == "batches" and len(parts) == 2 and parts[1] in server.batches:
+                    self._send(200, server.batches[parts[1]])
+                elif parts[0] == "files" and len(parts) == 3 and parts[2] == "content" and parts[1] in server.files:
+                    self._send(200, server.files[parts[1]], content_type="application/jsonl")
+                else:
+                    self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.base_url = f"http://{host}:{self.httpd.server_address[1]}/v1"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def _add_file(self, content):
+        file_id = f"file-{uuid4().hex[0:12]}"
+        self.files[file_id] = content
+        return {"id": file_id, "object": "file", "bytes": len(content), "purpose": "batch"}
+
+    def _run_batch(self, data):
+        lines = []
+        for line in self.files[data["input_file_id"]].decode().splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            content = self.responder(item["body"])
+            prompt_tokens = sum(len(message["content"].split()) for message in item["body"]["messages"])
+            completion_tokens = len(content.split())
+            lines.append(json.dumps({
+                "id": f"batch_req_{uuid4().hex[0:12]}",
+                "custom_id": item["custom_id"],
+                "response": {"status_code": 200, "body": {
+                    "model": item["body"]["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+                }},
+                "error": None,
+            }))
+        output = self._add_file(("\n".join(lines) + "\n").encode())
+
+        batch_id = f"batch_{uuid4().hex[0:12]}"
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": data["endpoint"],
+            "input_file_id": data["input_file_id"],
+            "completion_window": data.get("completion_window", "24h"),
+            "status": "completed",
+            "output_file_id": output["id"],
+            "error_file_id": None,
+            "created_at": int(time.time()),
+            "request_counts": {"total": len(lines), "completed": len(lines), "failed": 0},
+            "metadata": data.get("metadata"),
+        }
+        return self.batches[batch_id]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,86 @@
+import time
+
+
+class Budget:
+    """
+    Limits on the cost, tokens and wall time of one generation run, checked against running totals of the responses
+    as they come in. Any limit left as None isn't checked.
+    """
+
+    def __init__(self, max_cost=None, max_tokens=None, max_seconds=None):
+        self.max_cost = max_cost
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.reset()
+
+    def reset(self):
+        self.cost = 0
+        self.tokens = 0
+        self.runs = 0
+        # the most any one run has cost so far, reserved for every run that's started
+        self.run_cost = 0
+        self.run_tokens = 0
+        self.reason = None
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def remaining_seconds(self):
+        if self.max_seconds is None:
+            return None
+        return max(self.max_seconds - self.elapsed, 0)
+
+    def add(self, responses):
+        for response in responses:
+            self.cost += response.get('cost') or 0
+            self.tokens += response.get('tokens') or 0
+            self.run_cost = max(self.run_cost, response.get('cost') or 0)
+            self.run_tokens = max(self.run_tokens, response.get('tokens') or 0)
+            self.runs += 1
+
+    def check(self):
+        """
+        Returns the name of the limit that has been reached ("cost", "tokens" or "time"), or None if there's budget left.
+        """
+        if self.reason is None:
+            if self.max_cost is not None and self.cost >= self.max_cost:
+                self.reason = "cost"
+            elif self.max_tokens is not None and self.tokens >= self.max_tokens:
+                self.reason = "tokens"
+            elif self.max_seconds is not None and self.elapsed >= self.max_seconds:
+                self.reason = "time"
+        return self.reason
+
+    def blocking_limit(self, runs, in_flight_runs=0):
+        """
+        Returns the name of the limit that starting another runs could exceed, or None if they can start. The runs in
+        flight and the new ones are each expected to cost as much as the most expensive run so far, so a limit is only
+        exceeded by a run that costs more than every run before it, or by the first request when there's nothing to
+        go on yet.
+        """
+        if self.check():
+            return self.reason
+        for name, limit, total, per_run in [("cost", self.max_cost, self.cost, self.run_cost), ("tokens", self.max_tokens, self.tokens, self.run_tokens)]:
+            if limit is None:
+                continue
+            if self.runs == 0:
+                # nothing to estimate from yet, so only one request is in flight until the first comes back
+                if in_flight_runs > 0:
+                    return name
+                continue
+            if total + per_run * (in_flight_runs + runs) > limit:
+                return name
+        return None
+
+    def summary(self, generated, remaining):
+        return {
+            'generated': generated,
+            'remaining': remaining,
+            'cost': self.cost,
+            'tokens': self.tokens,
+            'seconds': self.elapsed,
+            'stopped': self.reason,
+            'resumable': remaining > 0,
+        }
@@ -0,0 +1,158 @@
+import gzip
+import json
+
+from .leases import atomic_file
+from .records import to_json
+
+# binary caches start with a magic string, then one byte each for the format version, serializer and compression
+MAGIC = b"THUMB\x00"
+FORMAT_VERSION = 1
+HEADER_SIZE = len(MAGIC) + 3
+
+SERIALIZERS = {"json": 0, "orjson": 1, "msgpack": 2}
+COMPRESSIONS = {"gzip": 0, "zstd": 1}
+
+CHUNK_SIZE = 1 << 20
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def default_serializer():
+    return "orjson" if orjson is not None else "json"
+
+
+def default_compression():
+    return "zstd" if zstandard is not None else "gzip"
+
+
+def _serialize(data, serializer):
+    if serializer == "orjson":
+        if orjson is None:
+            raise ImportError("The orjson serializer requires orjson: pip install orjson")
+        return orjson.dumps(data, default=to_json)
+    if serializer == "msgpack":
+        if msgpack is None:
+            raise ImportError("The msgpack serializer requires msgpack: pip install msgpack")
+        return msgpack.packb(data, default=to_json)
+    return json.dumps(data, default=to_json).encode()
+
+
+def _serialize_chunks(data, serializer):
+    """
+    Serializes the test data one pid of responses at a time, yielding pieces that join up to the same document
+    _serialize would write, so the whole payload never has to be in memory at once.
+    """
+    if serializer == "msgpack":
+        if msgpack is None:
+            raise ImportError("The msgpack serializer requires msgpack: pip install msgpack")
+        packer = msgpack.Packer(default=to_json)
+        yield packer.pack_map_header(len(data))
+        for key, value in data.items():
+            yield packer.pack(key)
+            if key == "data":
+                yield packer.pack_map_header(len(value))
+                for pid, pid_data in value.items():
+                    yield packer.pack(pid) + packer.pack(pid_data)
+            else:
+                yield packer.pack(value)
+        return
+
+    yield b"{"
+    for i, (key, value) in enumerate(data.items()):
+        yield (b"," if i else b"") + _serialize(key, serializer) + b":"
+        if key == "data":
+            yield b"{"
+            for j, (pid, pid_data) in enumerate(value.items()):
+                yield (b"," if j else b"") + _serialize(pid, serializer) + b":" + _serialize(pid_data, serializer)
+            yield b"}"
+        else:
+            yield _serialize(value, serializer)
+    yield b"}"
+
+
+def _deserialize(payload, serializer):
+    if serializer == "orjson":
+        if orjson is not None:
+            return orjson.loads(payload)
+        # orjson output is plain JSON
+        return json.loads(payload)
+    if serializer == "msgpack":
+        if msgpack is None:
+            raise ImportError("This cache was written with msgpack: pip install msgpack")
+        return msgpack.unpackb(payload)
+    return json.loads(payload)
+
+
+def _compressor(file, compression):
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd compression requires zstandard: pip install zstandard")
+        return zstandard.ZstdCompressor(level=3).stream_writer(file, closefd=False)
+    return gzip.GzipFile(fileobj=file, mode="wb", compresslevel=6, mtime=0)
+
+
+def _decompressor(file, compression):
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("This cache was written with zstd compression: pip install zstandard")
+        return zstandard.ZstdDecompressor().stream_reader(file, closefd=False)
+    return gzip.GzipFile(fileobj=file, mode="rb")
+
+
+def is_binary_cache(file_path):
+    with open(file_path, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def write_cache(file_path, data, serializer=None, compression=None):
+    """
+    Writes the test data to a compressed binary cache, serializing it one pid at a time into the compressor, which
+    streams to a temporary file that's swapped in when it's complete.
+    """
+    serializer = serializer or default_serializer()
+    compression = compression or default_compression()
+
+    with atomic_file(file_path, "wb") as file:
+        file.write(MAGIC + bytes([FORMAT_VERSION, SERIALIZERS[serializer], COMPRESSIONS[compression]]))
+        with _compressor(file, compression) as stream:
+            for chunk in _serialize_chunks(data, serializer):
+                stream.write(chunk)
+
+
+def read_cache(file_path):
+    """
+    Reads test data from a binary cache, detecting how it was serialized and compressed from its header.
+    """
+    with open(file_path, "rb") as file:
+        header = file.read(HEADER_SIZE)
+        if header[:len(MAGIC)] != MAGIC:
+            raise TypeError(f"{file_path} is not a thumb binary cache")
+
+        version, serializer_id, compression_id = header[len(MAGIC):]
+        if version > FORMAT_VERSION:
+            raise TypeError(f"{file_path} was written by a newer version of thumb (cache format {version})")
+        serializer = {value: key for key, value in SERIALIZERS.items()}[serializer_id]
+        compression = {value: key for key, value in COMPRESSIONS.items()}[compression_id]
+
+        chunks = []
+        with _decompressor(file, compression) as stream:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+
+    return _deserialize(b"".join(chunks), serializer)
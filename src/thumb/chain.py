@@ -0,0 +1,205 @@
+import time
+import asyncio
+
+from .llm import format_chat_prompt, get_input_variables, make_chat, parse_generate_response, split_model, _record_params
+
+# fields of each step's response that are added up for the run
+TOTAL_FIELDS = ("tokens", "prompt_tokens", "completion_tokens", "cost")
+
+
+class PromptChain:
+    """
+    A prompt made of several steps, where a step can use the output of earlier steps as a {variable} named after them.
+    Steps are a dict of name to prompt (a string or list of messages), or to a dict with the prompt and optionally its
+    own model and params. The output step's content is the response that's rated, the last step nothing else uses by default.
+    """
+
+    def __init__(self, steps, output=None):
+        self.steps = {}
+        for name, step in steps.items():
+            if not isinstance(step, dict):
+                step = {"prompt": step}
+            prompt = step["prompt"]
+            self.steps[name] = {
+                "prompt": [prompt] if isinstance(prompt, str) else list(prompt),
+                "model": step.get("model"),
+                "params": step.get("params") or {},
+            }
+
+        chain = {"steps": self.steps, "output": output}
+        # checks for cycles
+        step_order(chain)
+        if output is None:
+            used = {dependency for name in self.steps for dependency in step_dependencies(chain, name)}
+            output = [name for name in self.steps if name not in used][-1]
+        if output not in self.steps:
+            raise ValueError(f"The output step {output} isn't one of the steps {list(self.steps)}")
+        self.output = output
+
+    def to_dict(self, output=None):
+        # how the chain is stored with the test
+        return {"steps": self.steps, "output": output or self.output}
+
+
+def is_chain(prompt):
+    return isinstance(prompt, PromptChain) or (isinstance(prompt, dict) and "steps" in prompt)
+
+
+def step_dependencies(chain, name):
+    # the earlier steps a step's prompt uses
+    return [variable for variable in get_input_variables(chain["steps"][name]["prompt"]) if variable in chain["steps"]]
+
+
+def step_order(chain):
+    """
+    The steps in an order where every step comes after the ones it uses. Raises a ValueError if they form a cycle.
+    """
+    order, visiting, done = [], set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"The steps of the chain form a cycle at {name}")
+        visiting.add(name)
+        for dependency in step_dependencies(chain, name):
+            visit(dependency)
+        visiting.discard(name)
+        done.add(name)
+        order.append(name)
+
+    for name in chain["steps"]:
+        visit(name)
+    return order
+
+
+def input_variables(chain):
+    # the variables the test cases have to fill in, the ones that aren't step outputs
+    variables = []
+    for step in chain["steps"].values():
+        for variable in get_input_variables(step["prompt"]):
+            if variable not in chain["steps"] and variable not in variables:
+                variables.append(variable)
+    return variables
+
+
+def _step_call(chain, name, test_case, outputs, model, params):
+    step = chain["steps"][name]
+    step_model, step_params = split_model(step.get("model") or model, {**(params or {}), **(step.get("params") or {})})
+    variables = {**(test_case or {}), **{dependency: outputs[dependency]["content"] for dependency in step_dependencies(chain, name)}}
+    return make_chat(step_model, step_params), format_chat_prompt(step["prompt"], variables), step_model, step_params
+
+
+def _step_response(resp, model, params, latency):
+    # each step keeps the model it ran on, so it can be priced on its own
+    response_data = parse_generate_response(resp)
+    response_data["model"] = model
+    return _record_params(response_data, params, latency)
+
+
+def _skipped(chain, name, outputs):
+    # a step can't run if a step it uses failed
+    failed = [dependency for dependency in step_dependencies(chain, name) if outputs[dependency].get("error")]
+    if failed:
+        return {"content": f"Skipped because {', '.join(failed)} failed", "error": True}
+    return None
+
+
+def _combine(chain, outputs, latency, params):
+    """
+    The response of a whole run: the output step's content, the totals of every step, and each step's own response.
+    """
+    output = outputs[chain["output"]]
+    response_data = {"content": output["content"]}
+    if any(step.get("error") for step in outputs.values()):
+        response_data["error"] = True
+    for field in TOTAL_FIELDS:
+        response_data[field] = sum(step.get(field) or 0 for step in outputs.values())
+    response_data["steps"] = outputs
+    return _record_params(response_data, params or {}, latency)
+
+
+def run_chain(chain, test_case, model, params=None, tags=None):
+    """
+    Runs the steps one after another.
+    """
+    chain = chain.to_dict() if isinstance(chain, PromptChain) else chain
+    outputs = {}
+    start_time = time.time()
+    for name in step_order(chain):
+        outputs[name] = _skipped(chain, name, outputs)
+        if outputs[name] is not None:
+            continue
+        try:
+            chat, formatted_prompt, step_model, step_params = _step_call(chain, name, test_case, outputs, model, params)
+            step_start = time.time()
+            resp = chat.generate([formatted_prompt], tags=(tags or []) + [f"step_{name}"])
+            outputs[name] = _step_response(resp, step_model, step_params, time.time() - step_start)
+        except Exception as e:
+            outputs[name] = {"content": str(e), "error": True}
+    return _combine(chain, outputs, time.time() - start_time, params)
+
+
+async def async_run_chain(chain, test_case, model, params=None, tags=None):
+    """
+    Runs the steps concurrently, each one starting as soon as the steps it uses have finished.
+    """
+    chain = chain.to_dict() if isinstance(chain, PromptChain) else chain
+    outputs = {}
+    tasks = {}
+
+    async def run_step(name):
+        await asyncio.gather(*[tasks[dependency] for dependency in step_dependencies(chain, name)])
+        skipped = _skipped(chain, name, outputs)
+        if skipped is not None:
+            outputs[name] = skipped
+            return
+        try:
+            chat, formatted_prompt, step_model, step_params = _step_call(chain, name, test_case, outputs, model, params)
+            step_start = time.time()
+            resp = await chat.agenerate([formatted_prompt], tags=(tags or []) + [f"step_{name}"])
+            outputs[name] = _step_response(resp, step_model, step_params, time.time() - step_start)
+        except Exception as e:
+            outputs[name] = {"content": str(e), "error": True}
+
+    start_time = time.time()
+    order = step_order(chain)
+    for name in order:
+        tasks[name] = asyncio.ensure_future(run_step(name))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        # cancelling the run cancels its steps
+        for task in tasks.values():
+            task.cancel()
+    # keep the steps in the order they run
+    outputs = {name: outputs[name] for name in order}
+    return _combine(chain, outputs, time.time() - start_time, params)
+
+
+def get_chain_responses(chain, test_case, model, runs, pid, cid, params=None, heartbeat=None):
+    """
+    Runs a chain runs times, the same way get_responses generates the responses of a prompt.
+    """
+    responses = []
+    for _ in range(runs):
+        responses.append(run_chain(chain, test_case, model, params, tags=[f"pid_{pid}", f"cid_{cid}"]))
+        if heartbeat: heartbeat()
+    return responses
+
+
+async def async_get_chain_responses(batch, verbose=False):
+    """
+    Runs the chains of a batch of items concurrently, returning the responses in order like async_get_responses.
+    Every run of a chain is separate, later steps depend on what earlier steps said in that run.
+    """
+    tasks = []
+    for item in batch:
+        if verbose: print(f"Starting chain – pid: {item.get('pid')}, cid: {item.get('cid')}, model: {item.get('model')}")
+        params = dict(item.get('params') or {})
+        if item.get('temperature') is not None:
+            params['temperature'] = item['temperature']
+        tags = [f"pid_{item['pid']}", f"cid_{item['cid']}"] if item.get('pid') else []
+        for _ in range(item.get('n', 1)):
+            tasks.append(async_run_chain(item['prompt'], item.get('test_case'), item.get('model_name', item.get('model')), params, tags=tags))
+    return list(await asyncio.gather(*tasks))
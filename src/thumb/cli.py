@@ -0,0 +1,207 @@
+import sys
+import json
+import contextlib
+import math
+import argparse
+
+from tqdm import tqdm
+
+from .core import ThumbTest, run_async
+from .budget import Budget
+from .dashboard import summarize_totals
+from .evaluators import RegexEvaluator, AutoFailEvaluator, JSONEvaluator, JSONSchemaEvaluator
+
+# exit codes, so a nightly job can tell a failed run from a regression
+EXIT_ERROR = 1
+EXIT_BUDGET = 3
+EXIT_THRESHOLD = 4
+
+EVALUATORS = {
+    "regex": lambda spec: RegexEvaluator(spec["name"], spec["pattern"], fail_on_match=spec.get("fail_on_match", False)),
+    "words": lambda spec: AutoFailEvaluator(spec["name"], spec["words"], case_sensitive=spec.get("case_sensitive", False)),
+    "json": lambda spec: JSONEvaluator(spec.get("name", "valid_json")),
+    "json_schema": lambda spec: JSONSchemaEvaluator(spec["name"], spec["schema"]),
+}
+
+
+def load_config(file_path):
+    """
+    Reads a test config from a YAML or JSON file.
+    """
+    with open(file_path, "r") as file:
+        if file_path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("YAML configs require PyYAML: pip install pyyaml")
+            config = yaml.safe_load(file)
+        else:
+            config = json.load(file)
+
+    if not isinstance(config, dict) or not config.get("prompts"):
+        raise ValueError(f"{file_path} must contain a list of prompts")
+    return config
+
+
+def build_test(config, tid=None):
+    """
+    Creates a test from a config, or adds the config to an existing test to resume it.
+    """
+    if tid:
+        test = ThumbTest(tid, cache_format=config.get("cache_format"))
+    else:
+        test = ThumbTest(
+            task_description=config.get("task_description") or config["prompts"][0],
+            storage=config.get("storage", "json"),
+            cache_format=config.get("cache_format"),
+        )
+
+    test.add_prompts(config["prompts"])
+    if config.get("cases"):
+        test.add_cases(config["cases"])
+    test.add_models(config.get("models", ["gpt-3.5-turbo"]))
+    if config.get("params"):
+        test.add_params(config["params"])
+    if config.get("param_grid"):
+        test.add_param_grid(**config["param_grid"])
+    # runs add up, so a resumed test only gets topped up to the configured number
+    if config.get("runs", 10) > test.runs:
+        test.add_runs(config.get("runs", 10) - test.runs)
+    if config.get("criteria"):
+        test.add_criteria(config["criteria"])
+
+    for spec in config.get("evaluators", []):
+        kind = spec.get("type", "regex")
+        if kind not in EVALUATORS:
+            raise ValueError(f"Unknown evaluator type {kind}, choose one of {list(EVALUATORS)}")
+        test.add_evaluator(EVALUATORS[kind](spec))
+
+    if config.get("output_schema"):
+        test.set_output_schema(config["output_schema"])
+
+    if config.get("budget"):
+        test.set_budget(**config["budget"])
+    return test
+
+
+def _clean(value):
+    # NaN isn't valid JSON
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def collect_results(test):
+    """
+    Runs, feedback, score, tokens, cost, latency and the automatic scores of every prompt.
+    """
+    totals_df = test._aggregator().totals_frame()
+    if totals_df.empty:
+        return []
+    auto_scores = test._auto_scores()
+    results = []
+    for row in summarize_totals(totals_df, ["pid"]).to_dict(orient="records"):
+        row = {key: _clean(value) for key, value in row.items()}
+        row["prompt"] = test.prompts.get(row["pid"])
+        row.update(auto_scores.get(row["pid"], {}))
+        results.append(row)
+    return results
+
+
+def check_thresholds(results, thresholds):
+    """
+    Returns the breaches of the thresholds by any prompt. Each threshold is a metric name (like score, cost or an
+    evaluator name) and either a minimum average or {"min": ..., "max": ...}. A prompt missing the metric breaches it.
+    """
+    breaches = []
+    for metric, limits in thresholds.items():
+        if not isinstance(limits, dict):
+            limits = {"min": limits}
+        for result in results:
+            value = result.get(metric)
+            if value is None:
+                breaches.append({"pid": result["pid"], "metric": metric, "value": None, **limits})
+            elif ("min" in limits and value < limits["min"]) or ("max" in limits and value > limits["max"]):
+                breaches.append({"pid": result["pid"], "metric": metric, "value": value, **limits})
+    return breaches
+
+
+def run(args):
+    # the library prints progress and warnings as it goes, which would corrupt the JSON results on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        output, code = _run(args)
+
+    text = json.dumps(output, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    return code
+
+
+def _run(args):
+    config = load_config(args.config)
+    test = build_test(config, tid=args.resume)
+
+    limits = {key: getattr(args, key) for key in ["max_cost", "max_tokens", "max_seconds"] if getattr(args, key) is not None}
+    budget = None
+    if limits:
+        budget = Budget(**{**(config.get("budget") or {}), **limits})
+
+    samples_per_call = config.get("samples_per_call", 10)
+    with tqdm(total=test._count_required_runs(), unit="run", disable=args.no_progress, file=sys.stderr) as bar:
+        if config.get("async", True):
+            summary = run_async(test.async_generate(batch_size=config.get("batch_size", 30), samples_per_call=samples_per_call,
+                                                    budget=budget, progress=bar.update))
+        else:
+            summary = test.generate(samples_per_call=samples_per_call, budget=budget, progress=bar.update)
+
+    # automatic scoring, so there's something to hold the prompts to without anyone rating them
+    if any(case and case.get("__ref__") is not None for case in test.cases.values()):
+        test.score_references()
+    if test.evaluators:
+        test.run_evaluators(processes=args.processes)
+
+    results = collect_results(test)
+    breaches = check_thresholds(results, config.get("thresholds") or {})
+
+    status, code = "ok", 0
+    if breaches:
+        status, code = "threshold", EXIT_THRESHOLD
+    elif summary["stopped"] and summary["remaining"]:
+        # the budget can run out with the last request, which didn't stop anything
+        status, code = "budget", EXIT_BUDGET
+
+    output = {"tid": test.tid, "status": status, "generation": summary, "results": results, "breaches": breaches}
+    if args.report:
+        output["report"] = test.report(args.report)
+    return output, code
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="thumb", description="Run prompt tests from a config file, without a notebook.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="generate and score the responses for a YAML or JSON test config")
+    run_parser.add_argument("config", help="path to the test config")
+    run_parser.add_argument("--resume", metavar="TID", help="add to an existing test, only generating the runs it's missing")
+    run_parser.add_argument("--output", "-o", help="write the JSON results to a file instead of stdout")
+    run_parser.add_argument("--max-cost", type=float, help="stop once generation has cost this many dollars")
+    run_parser.add_argument("--max-tokens", type=int, help="stop once generation has used this many tokens")
+    run_parser.add_argument("--max-seconds", type=float, help="stop once generation has taken this long")
+    run_parser.add_argument("--report", metavar="DIR", help="also write a static HTML report of the results to a directory")
+    run_parser.add_argument("--processes", type=int, help="worker processes for the evaluators")
+    run_parser.add_argument("--no-progress", action="store_true", help="don't show the progress bar")
+    run_parser.set_defaults(func=run)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except (ValueError, TypeError, ImportError, FileNotFoundError) as e:
+        print(f"thumb: {e}", file=sys.stderr)
+        return EXIT_ERROR
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,31 +1,66 @@
 
 import os
+import sys
 import random
 import csv
 import json
 from collections import defaultdict
+import itertools
 from uuid import uuid4
 import ipywidgets as widgets
 from IPython.display import display, clear_output
 import asyncio
+import threading
 import nest_asyncio
 
+import numpy as np
 import pandas as pd
 import datetime
 
-from .llm import get_responses, async_get_responses, call, acall
-from .utils import hash_id
-from .ape import build_candidate_prompt, build_case_prompt, build_rating_prompt
+from .llm import get_responses, async_get_responses, call, acall, get_input_variables, split_model
+from .pricing import registry as pricing
+from .utils import hash_id, run_id
+from .storage import SQLiteStore
+from .cache import write_cache, read_cache, is_binary_cache
+from .leases import RunLeases, file_lock, atomic_write
+from .ape import build_candidate_prompt, build_case_prompt, build_rating_prompt, parse_case
+from .dedupe import NearDuplicateIndex
+from .metrics import score_responses, reference_hash
+from .evaluators import Evaluator, JSONEvaluator, JSONSchemaEvaluator, run_evaluators
+from .records import Response, compact_data, to_json
+from .dashboard import ResultsAggregator, LiveResults, summary_html, summarize_totals
+from .batch import BatchClient, write_batch_file, read_batch_results
+from .budget import Budget
+from .lift import bootstrap_lift
+from .pairwise import PairPool, replay_judgments
+from .active import ActiveQueue
+from .report import write_report
+from .chain import PromptChain, is_chain, input_variables, get_chain_responses, async_get_chain_responses
+from .optimize import PromptOptimizer
 
 DIR_PATH = "thumb-tests/.cache"
 
-# solves a problem with event loop in asyncio in jupyter notebooks
-nest_asyncio.apply()
+# dict fields of a response holding automatic scores, averaged by stats()
+AUTO_SCORE_FIELDS = ["metrics", "evals"]
 
-def test(prompts, cases=None, runs=10, models=["gpt-3.5-turbo"], task_description=None, async_generate=True, show_cases=False, verbose=False):
+CSV_COLUMNS = ["PID", "Prompt", "CID", "Case", "Model", "RID", "Content", "Tokens", "Prompt Tokens", "Completion Tokens", "Cost", "Latency", "Feedback"]
+
+def run_async(coroutine):
+    """
+    Runs a coroutine to completion. Jupyter notebooks already have an event loop running, which asyncio.run can't be
+    nested in, so nest_asyncio is only applied there rather than on import, leaving scripts and the CLI untouched.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    nest_asyncio.apply()
+    return asyncio.run(coroutine)
+
+def test(prompts, cases=None, runs=10, models=["gpt-3.5-turbo"], task_description=None, async_generate=True, show_cases=False, verbose=False, storage="json", cache_format=None, samples_per_call=10):
     if not task_description:
         task_description = prompts[0]
-    thumb = ThumbTest(task_description=task_description, show_cases=show_cases, verbose=verbose)
+    thumb = ThumbTest(task_description=task_description, show_cases=show_cases, verbose=verbose, storage=storage, cache_format=cache_format)
     thumb.add_prompts(prompts)
 
 
@@ -33,37 +68,82 @@ def test(prompts, cases=None, runs=10, models=["gpt-3.5-turbo"], task_descriptio
     thumb.add_models(models)
     thumb.add_runs(runs)
     if async_generate:
-        asyncio.run(thumb.async_generate())
+        run_async(thumb.async_generate(samples_per_call=samples_per_call))
     else:
-        thumb.generate()
+        thumb.generate(samples_per_call=samples_per_call)
 
     thumb.evaluate()
 
     return thumb
 
-def load(tid):
+def load(tid, cache_format=None):
     # check if the tid is a file path
     if os.path.exists(tid):
-        return ThumbTest(file_path=tid)
+        return ThumbTest(file_path=tid, cache_format=cache_format)
     else:
-        return ThumbTest(tid)
+        return ThumbTest(tid, cache_format=cache_format)
+
+def migrate(tid, keep_json=False):
+    """
+    Converts a test's json cache to the binary cache format, removing the json file once the binary one is written.
+    """
+    thumb = ThumbTest(tid, cache_format="binary")
+    thumb._save_data()
+
+    json_file_path = os.path.join(DIR_PATH, f"{thumb.tid}.json")
+    if not keep_json and os.path.exists(thumb._cache_path()) and os.path.exists(json_file_path):
+        os.remove(json_file_path)
+    return thumb
 
 class ThumbTest:
     
-    def __init__(self, tid=None, file_path=None, task_description=None, show_cases=False, verbose=False):
+    def __init__(self, tid=None, file_path=None, task_description=None, show_cases=False, verbose=False, storage="json", cache_format=None):
 
         self.verbose = verbose
 
+        if storage not in ["json", "sqlite"]:
+            raise ValueError("storage must be 'json' or 'sqlite'")
+        self.storage = storage
+        self.store = None
+
+        # how the json storage is cached, defaults to whatever format the test was loaded from
+        if cache_format not in [None, "json", "binary"]:
+            raise ValueError("cache_format must be 'json' or 'binary'")
+        self.cache_format = cache_format
+
         self.data = defaultdict(dict)
 
         self.prompts = {}
         self.cases = {"base-case": None}
         self.models = []
+        # sampling parameter sets by id, and the ones every model is run with
+        self.params = {}
+        self.sweep = []
         self.runs = 0
 
         self.criteria = []
         self.task_description = task_description
 
+        self.evaluators = []
+        # the JSON schema responses are validated against, kept with the test unlike other evaluators
+        self.output_schema = None
+
+        # limits on the cost, tokens and time of each generation run
+        self.budget = None
+
+        # batch jobs submitted for this test, ingested once they complete
+        self.batches = []
+
+        # pairwise judgments, which of two responses to the same case was better
+        self.judgments = []
+
+        # mtime of the cache file when it was last read or written by this process
+        self._synced_mtime = None
+
+        # bumped whenever responses or feedback change, so cached comparisons know when they're stale
+        self._feedback_version = 0
+        self._comparisons = {}
+
         if tid:
             # get just the tid from the file path if its a filepath
             if "/" in tid:
@@ -80,8 +160,18 @@ class ThumbTest:
             if self.verbose: print(f"Loaded ThumbTest: {self.tid}")
         else:
             self.tid = uuid4().hex[0:8]
+            if self.storage == "sqlite":
+                self.store = SQLiteStore(os.path.join(DIR_PATH, f"{self.tid}.db"))
             if self.verbose: print(f"Created ThumbTest: {self.tid}")
 
+        if self.cache_format is None:
+            self.cache_format = "json"
+
+        if self.output_schema:
+            self._add_schema_evaluators()
+
+        self.leases = RunLeases(os.path.join(DIR_PATH, f"{self.tid}.claims"))
+
         if os.environ.get("LANGCHAIN_API_KEY", None):
             os.environ["LANGCHAIN_TRACING_V2"] = "true"
             os.environ["LANGCHAIN_PROJECT"] = f"ThumbTest: {self.tid}"
@@ -90,18 +180,26 @@ class ThumbTest:
         self.show_cases = show_cases
 
     def __str__(self):
-        combinations = len(self.prompts) * len(self.cases) * len(self.models) * self.runs
+        variants = self._count_model_variants()
+        combinations = len(self.prompts) * len(self.cases) * variants * self.runs
         if "base-case" in self.cases.keys():
-            return f"ThumbTest: {self.tid}\n\nPrompts: {len(self.prompts)}\nCases: {len(self.cases) - 1}\nModels: {len(self.models)}\nRuns: {self.runs}\n\n{len(self.prompts)} x {len(self.cases) - 1} x {len(self.models)} x {self.runs} = {combinations}"
-        return f"ThumbTest: {self.tid}\n\nPrompts: {len(self.prompts)}\nCases: {len(self.cases)}\nModels: {len(self.models)}\nRuns: {self.runs}\n\n{len(self.prompts)} x {len(self.cases)} x {len(self.models)} x {self.runs} = {combinations}"
+            return f"ThumbTest: {self.tid}\n\nPrompts: {len(self.prompts)}\nCases: {len(self.cases) - 1}\nModels: {variants}\nRuns: {self.runs}\n\n{len(self.prompts)} x {len(self.cases) - 1} x {variants} x {self.runs} = {combinations}"
+        return f"ThumbTest: {self.tid}\n\nPrompts: {len(self.prompts)}\nCases: {len(self.cases)}\nModels: {variants}\nRuns: {self.runs}\n\n{len(self.prompts)} x {len(self.cases)} x {variants} x {self.runs} = {combinations}"
     
     def add_prompts(self, prompts):
         for prompt in prompts:
-            # if the prompt is a string, convert it to a list
-            if isinstance(prompt, str):
-                prompt = [prompt]
-            
-            msg_string = "\n".join(prompt)
+            if is_chain(prompt):
+                # chains are stored as a dict of their steps, and identified by all of them
+                if not isinstance(prompt, PromptChain):
+                    prompt = PromptChain(prompt["steps"], prompt.get("output"))
+                prompt = prompt.to_dict()
+                msg_string = json.dumps(prompt, sort_keys=True)
+            else:
+                # if the prompt is a string, convert it to a list
+                if isinstance(prompt, str):
+                    prompt = [prompt]
+                msg_string = "\n".join(prompt)
+
             pid = f"{hash_id(msg_string)}"
             if pid not in self.prompts.keys():
                 self.prompts[pid] = prompt
@@ -120,10 +218,70 @@ class ThumbTest:
 
     def add_models(self, models):
         for model in models:
+            if isinstance(model, dict):
+                # a model with its own parameters is added as a single variant, it isn't crossed with the parameter sets
+                name, params = split_model(model)
+                model = f"{name}@{self._add_param_set(params)}"
             if model not in self.models:
                 self.models.append(model)
                 if self.verbose: print(f"Added model: {model}")
 
+    def _add_param_set(self, params):
+        psid = hash_id(json.dumps(params, sort_keys=True))
+        if psid not in self.params:
+            self.params[psid] = params
+        return psid
+
+    def add_params(self, param_sets):
+        """
+        Adds sampling parameter sets, like {"temperature": 0.7, "max_tokens": 256}. Every model is run with every
+        parameter set, and the responses are stored under model@psid, where psid is a stable id for the parameters.
+        Include an empty set {} to also run the models with their default parameters.
+        """
+        if isinstance(param_sets, dict):
+            param_sets = [param_sets]
+        for params in param_sets:
+            psid = self._add_param_set(params)
+            if psid not in self.sweep:
+                self.sweep.append(psid)
+                if self.verbose: print(f"Added params: {psid}: {params}")
+
+    def add_param_grid(self, **grid):
+        """
+        Adds a parameter set for every combination of the values, e.g. add_param_grid(temperature=[0, 0.7], top_p=[0.5, 1]).
+        """
+        keys = list(grid.keys())
+        self.add_params([dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])])
+
+    def _model_name(self, model):
+        # the name to call for a model, without its parameter set id
+        name, _, psid = model.rpartition("@")
+        return name if name and psid in self.params else model
+
+    def _model_variants(self):
+        """
+        Yields (model, name, params) for every model and parameter set combination, where model is the key responses are stored under.
+        """
+        for model in self.models:
+            if self._model_name(model) != model:
+                # a model added with its own parameters
+                yield model, self._model_name(model), self.params[model.rpartition("@")[2]]
+            elif self.sweep:
+                for psid in self.sweep:
+                    yield f"{model}@{psid}", model, self.params[psid]
+            else:
+                yield model, model, {}
+
+    def _count_model_variants(self):
+        return sum(1 for _ in self._model_variants())
+
+    def set_budget(self, max_cost=None, max_tokens=None, max_seconds=None):
+        """
+        Sets the cost (in dollars), token and wall time (in seconds) limits for each call to generate or async_generate.
+        """
+        self.budget = Budget(max_cost=max_cost, max_tokens=max_tokens, max_seconds=max_seconds)
+        return self.budget
+
     def add_runs(self, runs):
         # check if runs is an int
         if not isinstance(runs, int):
@@ -150,144 +308,546 @@ class ThumbTest:
                 self.criteria.remove(criterion)
         if self.verbose: print(f"Removed criteria: {criteria}")
 
+    def add_evaluator(self, evaluator, name=None, version="1"):
+        """
+        Adds an evaluator that scores responses without an LLM: an Evaluator, or a function that takes the response content
+        and returns a score (True / False count as 1 / 0).
+        """
+        if not isinstance(evaluator, Evaluator):
+            if not callable(evaluator):
+                raise TypeError("evaluator must be an Evaluator or a function")
+            evaluator = Evaluator(name or evaluator.__name__, evaluator, version=version)
+
+        # replace an evaluator with the same name
+        self.evaluators = [existing for existing in self.evaluators if existing.name != evaluator.name]
+        self.evaluators.append(evaluator)
+        if self.verbose: print(f"Added evaluator: {evaluator.name}")
+
+    def set_output_schema(self, schema, name="valid_schema"):
+        """
+        Checks every response is valid JSON (valid_json) that matches the JSON schema (valid_schema), for prompts that
+        return JSON or call functions, where a function call is checked on its arguments. The schema is compiled once and
+        the responses are validated in bulk by run_evaluators, with the validity rates shown in stats.
+        """
+        # compiled now, so a bad schema or missing jsonschema fails here rather than every response failing validation
+        JSONSchemaEvaluator(name, schema).validator
+        self.output_schema = {'name': name, 'schema': schema}
+        self._add_schema_evaluators()
+
+    def _add_schema_evaluators(self):
+        self.add_evaluator(JSONEvaluator())
+        self.add_evaluator(JSONSchemaEvaluator(self.output_schema['name'], self.output_schema['schema']))
+
+    def remove_evaluator(self, name):
+        self.evaluators = [evaluator for evaluator in self.evaluators if evaluator.name != name]
+        if self.verbose: print(f"Removed evaluator: {name}")
+
     def set_task_description(self, task_description):
         self.task_description = task_description
         if self.verbose: print(f"Set task description: {task_description}")
 
-    def generate(self):
-        combinations = len(self.prompts) * len(self.cases) * len(self.models) * self.runs
-        if self.verbose: print(f"{len(self.prompts)} prompts x {len(self.cases)} cases x {len(self.models)} x runs {self.runs} = {combinations} calls to the OpenAI API")
+    def generate(self, samples_per_call=10, budget=None, progress=None):
+        """
+        Generates the missing runs one prompt, case and model at a time, stopping before one the budget isn't expected to cover.
+        progress is called with the number of runs each time some are stored, like a tqdm bar's update.
+        """
+        budget = budget or self.budget or Budget()
+        budget.reset()
+        generated = 0
 
-        for pid in self.prompts.keys():
-            for cid in self.cases.keys():
-                for model in self.models: 
-                    runs_completed = len(self.data.get(pid, {}).get(cid, {}).get(model, {}).keys())
-                    if runs_completed < self.runs:
-                        # Process this combination
-                        runs = self.runs - runs_completed
-                        prompt = self.prompts[pid]
+        variants = self._count_model_variants()
+        combinations = len(self.prompts) * len(self.cases) * variants * self.runs
+        if self.verbose: print(f"{len(self.prompts)} prompts x {len(self.cases)} cases x {variants} models x runs {self.runs} = {combinations} calls to the OpenAI API")
+
+        try:
+            for pid in self.prompts.keys():
+                for cid in self.cases.keys():
+                    for model, name, params in self._model_variants():
+                        missing_runs = self._missing_runs(pid, cid, model)
+                        # stop before a combination the budget isn't expected to cover
+                        limit = budget.blocking_limit(len(missing_runs)) if missing_runs else budget.check()
+                        if limit:
+                            budget.reason = limit
+                            break
+                        if missing_runs:
+                            # Claim the missing runs so another process resuming this test skips them
+                            rids = self._claim_runs(pid, cid, model, [rid for _, rid in missing_runs])
+                            if not rids:
+                                continue
+                            prompt = self.prompts[pid]
                         
-                        test_case = self.cases[cid]
+                            test_case = self.cases[cid]
                         
-                        responses = get_responses(prompt, test_case, model, runs, pid, cid)
-
-                        # Ensure pid is in the dictionary
-                        if pid not in self.data:
-                            self.data[pid] = {}
-
-                        # Ensure cid is in the dictionary associated with pid
-                        if cid not in self.data[pid]:
-                            self.data[pid][cid] = {}
+                            try:
+                                if is_chain(prompt):
+                                    responses = get_chain_responses(prompt, test_case, name, len(rids), pid, cid, params=params, heartbeat=self.leases.renew)
+                                else:
+                                    responses = get_responses(prompt, test_case, name, len(rids), pid, cid, samples_per_call=samples_per_call, params=params, heartbeat=self.leases.renew)
+
+                                # Add the responses to the test
+                                rows = []
+                                for rid, response in zip(rids, responses):
+                                    response["feedback"] = None
+                                    rows.append((pid, cid, model, rid, response))
+                                stored = self._add_responses(rows)
+                                budget.add(responses)
+                                generated += stored
+                                if progress: progress(stored)
+
+                                self._save_data()
+                            finally:
+                                self.leases.release(rids)
+        finally:
+            # removes the claims directory once no one is using it
+            self.leases.release_all()
+
+        summary = budget.summary(generated, self._count_required_runs())
+        if self.verbose and summary['stopped']:
+            print(f"Stopped after the {summary['stopped']} budget ran out: generated {generated} runs costing ${summary['cost']:.4f}, {summary['remaining']} runs left to resume")
+        return summary
+
+    def _claim_runs(self, pid, cid, model, rids):
+        """
+        Claims runs of a prompt, case and model for this process to generate, returning the rids it now holds. Runs that
+        another process is generating, or has already saved, are left out.
+        """
+        if self.store is not None:
+            claimed = self.leases.claim_many(rids)
+        else:
+            file_path = self._cache_path()
+            if not os.path.exists(DIR_PATH):
+                os.makedirs(DIR_PATH)
+            # a process only lets go of its runs once they're saved, so under the cache lock a run is either still
+            # claimed or already in the cache
+            with file_lock(file_path):
+                if os.path.exists(file_path) and os.path.getmtime(file_path) != self._synced_mtime:
+                    self._merge_from_cache(file_path)
+                    self._synced_mtime = os.path.getmtime(file_path)
+                claimed = self.leases.claim_many(rids)
+
+        stored = set(self._get_rids(pid, cid, model))
+        self.leases.release([rid for rid in claimed if rid in stored])
+        return [rid for rid in claimed if rid not in stored]
+
+    def _missing_runs(self, pid, cid, model):
+        """
+        Returns the (run index, rid) of every run that hasn't been generated yet for a prompt, case and model.
+        """
+        existing = set(self._get_rids(pid, cid, model))
+        expected = [(index, run_id(pid, cid, model, index)) for index in range(self.runs)]
+        missing = [(index, rid) for index, rid in expected if rid not in existing]
 
-                        # If the model is not in the dict, add it
-                        if model not in self.data[pid][cid]:
-                            self.data[pid][cid][model] = {}
-                        
-                        # Add the responses to the dictionary
-                        for response in responses:
-                            response["feedback"] = None
-                            rid = uuid4().hex[0:8]
-                            self.data[pid][cid][model][rid] = response
+        # responses cached before run ids were deterministic have random rids, count them towards the runs
+        legacy = len(existing - {rid for _, rid in expected})
+        return missing[legacy:]
 
-                        self._save_data()
+    def _iter_required_runs(self):
+        """
+        Lazily yields every run that hasn't been generated yet for the prompts, cases, models and parameter sets,
+        so scheduling a big grid only holds one combination's runs in memory at a time.
+        """
+        for pid in self.prompts.keys():
+            for cid in self.cases.keys():
+                for model, name, params in self._model_variants():
+                    # Add a new item for each individual run that hasn't been completed yet
+                    for index, rid in self._missing_runs(pid, cid, model):
+                        yield {
+                            'pid': pid,
+                            'cid': cid,
+                            'model': model,
+                            'model_name': name,
+                            'params': params,
+                            'run': index,
+                            'rid': rid,
+                            'prompt': self.prompts[pid],
+                            'test_case': self.cases[cid]
+                        }
 
     def _collect_required_runs(self):
         """
         Collects and returns all the required runs for the prompts, cases, and models.
         """
-        required_runs = []
+        return list(self._iter_required_runs())
 
-        for pid in self.prompts.keys():
-            for cid in self.cases.keys():
-                for model in self.models:
-                    runs_completed = len(self.data.get(pid, {}).get(cid, {}).get(model, {}).keys())
-                    if runs_completed < self.runs:
-                        runs_to_do = self.runs - runs_completed
-
-                        # Add a new item for each individual run that hasn't been completed yet
-                        for _ in range(runs_to_do):
-                            required_runs.append({
-                                'pid': pid,
-                                'cid': cid,
-                                'model': model,
-                                'prompt': self.prompts[pid],
-                                'test_case': self.cases[cid]
-                            })
-        return required_runs
-
-    async def async_generate(self, batch_size=30):
-        combinations = len(self.prompts) * len(self.cases) * len(self.models) * self.runs
-        if self.verbose: print(f"{len(self.prompts)} prompts x {len(self.cases)} cases x {len(self.models)} x runs {self.runs} = {combinations} calls to the OpenAI API")
-
-        # Create a list to collect needed runs
-        required_runs = self._collect_required_runs()
-        
-        # Process the required runs in batches determined by batch_size
-        for i in range(0, len(required_runs), batch_size):
-            batch = required_runs[i:i+batch_size]
-            
-            batch_responses = await async_get_responses(batch, verbose=self.verbose)
+    def _count_required_runs(self):
+        return sum(1 for _ in self._iter_required_runs())
 
-            for idx, response in enumerate(batch_responses):
-                pid, cid, model = batch[idx]['pid'], batch[idx]['cid'], batch[idx]['model']
+    def _group_required_runs(self, required_runs, samples_per_call):
+        """
+        Lazily groups runs of the same prompt, case and model, which send identical requests, into lists of up to samples_per_call runs.
+        """
+        group = []
+        for item in required_runs:
+            if group and (len(group) >= samples_per_call or any(group[0][key] != item[key] for key in ['pid', 'cid', 'model'])):
+                yield group
+                group = []
+            group.append(item)
+        if group:
+            yield group
+
+    async def async_generate(self, batch_size=30, samples_per_call=10, budget=None, progress=None):
+        """
+        Generates the missing runs with up to batch_size requests in flight at once. If the budget (or the test's budget)
+        runs out, the requests still in flight are cancelled and everything completed is saved, so the test can be resumed
+        by calling async_generate again. Returns a summary of what was generated and what's left.
+        progress is called with the number of runs each time some are stored, like a tqdm bar's update.
+        """
+        variants = self._count_model_variants()
+        combinations = len(self.prompts) * len(self.cases) * variants * self.runs
+        if self.verbose: print(f"{len(self.prompts)} prompts x {len(self.cases)} cases x {variants} models x runs {self.runs} = {combinations} calls to the OpenAI API")
+
+        budget = budget or self.budget or Budget()
+        budget.reset()
+
+        # Enumerate the needed runs lazily, grouped so identical runs are requested in one call
+        groups = self._group_required_runs(self._iter_required_runs(), samples_per_call)
+        next_group = next(groups, None)
+
+        # each running request and the runs it's generating
+        pending = {}
+        # runs that are generated but not saved yet, their leases are held until they are
+        finished = []
+        generated = 0
+        unsaved = 0
+        try:
+            while next_group is not None or pending:
+                # start requests until batch_size are in flight, or the budget wouldn't cover another one
+                while next_group is not None and len(pending) < batch_size:
+                    in_flight = sum(len(group) for group in pending.values())
+                    limit = budget.blocking_limit(len(next_group), in_flight)
+                    if limit:
+                        if not pending:
+                            budget.reason = limit
+                        break
+
+                    group, next_group = next_group, next(groups, None)
+                    # skip runs that another process is already generating
+                    claimed = set(self._claim_runs(group[0]['pid'], group[0]['cid'], group[0]['model'], [item['rid'] for item in group]))
+                    group = [item for item in group if item['rid'] in claimed]
+                    if not group:
+                        continue
+
+                    request = [{**group[0], 'n': len(group)}]
+                    # chains are just another request in flight, so their runs share the pool with plain prompts
+                    get = async_get_chain_responses if is_chain(group[0]['prompt']) else async_get_responses
+                    pending[asyncio.ensure_future(get(request, verbose=self.verbose))] = group
+
+                if not pending:
+                    break
+
+                done, _ = await asyncio.wait(pending.keys(), timeout=budget.remaining_seconds(), return_when=asyncio.FIRST_COMPLETED)
+
+                rows = []
+                for task in done:
+                    group = pending.pop(task)
+                    responses = task.result()
+                    # the responses come back in the same order as the runs
+                    for item, response in zip(group, responses):
+                        response["feedback"] = None
+                        rows.append((item['pid'], item['cid'], item['model'], item['rid'], response))
+                    budget.add(responses)
+                    finished += [item['rid'] for item in group]
+
+                if rows:
+                    stored = self._add_responses(rows)
+                    generated += stored
+                    unsaved += len(done)
+                    if progress: progress(stored)
+                if unsaved >= batch_size:
+                    self._save_data()
+                    self.leases.release(finished)
+                    finished = []
+                    self.leases.renew()
+                    unsaved = 0
+
+                if budget.check():
+                    break
+        finally:
+            # cancel anything still running, its runs are generated when the test is resumed
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending.keys(), return_exceptions=True)
+            self._save_data()
+            self.leases.release_all()
 
-                # Ensure pid is in the dictionary
-                if pid not in self.data:
-                    self.data[pid] = {}
+        summary = budget.summary(generated, self._count_required_runs())
+        if self.verbose and summary['stopped']:
+            print(f"Stopped after the {summary['stopped']} budget ran out: generated {generated} runs costing ${summary['cost']:.4f}, {summary['remaining']} runs left to resume")
+        return summary
 
-                # Ensure cid is in the dictionary associated with pid
-                if cid not in self.data[pid]:
-                    self.data[pid][cid] = {}
+    def write_batch(self, file_path=None):
+        """
+        Writes every run that hasn't been generated yet to a JSONL file of requests for a batch API.
+        Returns the file path and how many requests were written.
+        """
+        if file_path is None:
+            if not os.path.exists(DIR_PATH):
+                os.makedirs(DIR_PATH)
+            file_path = os.path.join(DIR_PATH, f"{self.tid}.batch.jsonl")
 
-                # If the model is not in the dict, add it
-                if model not in self.data[pid][cid]:
-                    self.data[pid][cid][model] = {}
+        # each step of a chain needs the output of the one before, so chains can't be sent as one batch
+        required_runs = (item for item in self._iter_required_runs() if not is_chain(item['prompt']))
+        count = write_batch_file(required_runs, file_path)
+        if self.verbose: print(f"Wrote {count} requests to {file_path}")
+        if any(is_chain(prompt) for prompt in self.prompts.values()):
+            print("Prompt chains were left out of the batch, generate them with generate or async_generate")
+        return file_path, count
 
-                # Add the response to the dictionary
+    def submit_batch(self, base_url=None, api_key=None, completion_window="24h", force=False):
+        """
+        Uploads the missing runs as a batch job, instead of calling the API for each one. Use ingest_batch to add the responses
+        once the batch has completed. Returns the batch id, or None if there's nothing to generate.
+        """
+        pending = [batch['id'] for batch in self.batches if batch['status'] != "ingested"]
+        if pending and not force:
+            raise ValueError(f"Batches {pending} haven't been ingested yet, submitting again would generate their runs twice. Pass force=True to submit anyway.")
+
+        file_path, count = self.write_batch()
+        if count == 0:
+            if self.verbose: print("No runs to generate")
+            return None
+
+        client = BatchClient(base_url=base_url, api_key=api_key)
+        uploaded = client.upload_file(file_path)
+        batch = client.create_batch(uploaded['id'], completion_window=completion_window, metadata={"thumb_test": self.tid})
+
+        self.batches.append({'id': batch['id'], 'status': batch['status'], 'runs': count, 'base_url': client.base_url})
+        self._save_data()
+        if self.verbose: print(f"Submitted batch {batch['id']} with {count} runs")
+        return batch['id']
+
+    def _find_batch(self, batch_id=None):
+        if batch_id is None:
+            if not self.batches:
+                raise ValueError("No batches have been submitted for this test.")
+            return self.batches[-1]
+        for batch in self.batches:
+            if batch['id'] == batch_id:
+                return batch
+        raise ValueError(f"No batch {batch_id} was submitted for this test.")
+
+    def batch_status(self, batch_id=None, base_url=None, api_key=None):
+        """
+        Checks on a submitted batch, the latest one by default.
+        """
+        batch = self._find_batch(batch_id)
+        client = BatchClient(base_url=base_url or batch.get('base_url'), api_key=api_key)
+        status = client.retrieve_batch(batch['id'])
+        if batch['status'] != "ingested":
+            batch['status'] = status['status']
+        return status
+
+    def ingest_batch(self, batch_id=None, file_path=None, base_url=None, api_key=None):
+        """
+        Adds the responses from a completed batch, downloading its result file, or from a result file you already have.
+        Results are matched to their prompt, case, model and run, and runs that already have a response are skipped.
+        Returns how many responses were added.
+        """
+        batch = None
+        if file_path is None:
+            batch = self._find_batch(batch_id)
+            client = BatchClient(base_url=base_url or batch.get('base_url'), api_key=api_key)
+            status = client.retrieve_batch(batch['id'])
+            if status['status'] != "completed":
+                raise ValueError(f"Batch {batch['id']} is {status['status']}, it can only be ingested once it has completed.")
+
+            file_paths = []
+            for key in ['output_file_id', 'error_file_id']:
+                if status.get(key):
+                    result_path = os.path.join(DIR_PATH, f"{self.tid}.{batch['id']}.{key.split('_')[0]}.jsonl")
+                    file_paths.append(client.download_file(status[key], result_path))
+        else:
+            file_paths = [file_path]
+
+        added = 0
+        existing = {}
+        for result_path in file_paths:
+            rows = []
+            for pid, cid, model, run, response in read_batch_results(result_path):
+                if (pid, cid, model) not in existing:
+                    existing[(pid, cid, model)] = set(self._get_rids(pid, cid, model))
+                rid = run_id(pid, cid, model, run)
+                if rid in existing[(pid, cid, model)]:
+                    continue
+                existing[(pid, cid, model)].add(rid)
                 response["feedback"] = None
-                rid = uuid4().hex[0:8]
-                self.data[pid][cid][model][rid] = response
+                rows.append((pid, cid, model, rid, response))
+            added += self._add_responses(rows)
 
-            self._save_data()
+        if batch is not None:
+            batch['status'] = "ingested"
+        self._save_data()
+        if self.verbose: print(f"Ingested {added} responses")
+        return added
+
+    def _get_rids(self, pid, cid, model):
+        """
+        Returns the rids of the responses stored for a prompt, case and model.
+        """
+        if self.store is not None:
+            return self.store.rids(pid, cid, model)
+        return list(self.data.get(pid, {}).get(cid, {}).get(model, {}).keys())
+
+    def _add_responses(self, rows):
+        """
+        Stores a batch of (pid, cid, model, rid, response) rows, returning how many were stored. Failed calls aren't
+        stored, so their runs stay missing and are generated again when the test is resumed.
+        """
+        rows = [row for row in rows if not row[4].get('error')]
+        self._feedback_version += 1
+        if self.store is not None:
+            self.store.insert_responses(rows)
+            return len(rows)
+
+        for pid, cid, model, rid, response in rows:
+            # intern the ids so they're only stored once however many responses share them
+            pid, cid, model, rid = sys.intern(pid), sys.intern(cid), sys.intern(model), sys.intern(rid)
+
+            # Ensure pid, cid and model are in the dictionary
+            if pid not in self.data:
+                self.data[pid] = {}
+            if cid not in self.data[pid]:
+                self.data[pid][cid] = {}
+            if model not in self.data[pid][cid]:
+                self.data[pid][cid][model] = {}
+
+            self.data[pid][cid][model][rid] = Response.from_dict(response)
+        return len(rows)
+
+    def _iter_responses(self, pid=None, unlabeled=False):
+        """
+        Yields (pid, cid, model, rid, response) for every stored response, optionally for one pid or only those without feedback.
+        """
+        if self.store is not None:
+            yield from self.store.iter_responses(pid=pid, unlabeled=unlabeled)
+            return
+
+        pids = [pid] if pid is not None else list(self.data.keys())
+        for pid in pids:
+            for cid, cid_data in self.data.get(pid, {}).items():
+                for model, model_data in cid_data.items():
+                    for rid, response in model_data.items():
+                        if unlabeled and response['feedback'] is not None:
+                            continue
+                        yield pid, cid, model, rid, response
+
+    def _update_responses(self, updates):
+        """
+        Merges new fields into stored responses, given a list of (pid, cid, model, rid, fields).
+        """
+        if any('feedback' in fields for *_, fields in updates):
+            self._feedback_version += 1
+        if self.store is not None:
+            self.store.update_responses(updates)
+            return
+
+        for pid, cid, model, rid, fields in updates:
+            self.data[pid][cid][model][rid].update(fields)
+
+    def _cache_path(self):
+        extension = "thumb" if self.cache_format == "binary" else "json"
+        return os.path.join(DIR_PATH, f"{self.tid}.{extension}")
 
     def _save_data(self):
         """
-        Save responses, prompts, cases, and models to a json file.
+        Save responses, prompts, cases, and models to a json or binary cache file.
         """
-        # Create a dictionary to hold the relevant data
-        data = {
-            'data': self.data,
-            'prompts': self.prompts,
-            'cases': self.cases,
-            'models': self.models,
-            'runs': self.runs,
-        }
-        
-        # Convert the dictionary to JSON
-        data_json = json.dumps(data, indent=4)
-        
+        if self.store is not None:
+            # responses are written as they come in, so only the test setup needs saving
+            try:
+                self.store.set_meta({
+                    'prompts': self.prompts,
+                    'cases': self.cases,
+                    'models': self.models,
+                    'params': self.params,
+                    'sweep': self.sweep,
+                    'runs': self.runs,
+                    'batches': self.batches,
+                    'judgments': self.judgments,
+                    'output_schema': self.output_schema,
+                    'task_description': self.task_description,
+                })
+            except Exception as e:
+                print(f"Caching failed due to: {e}")
+            return
+
         # Define the directory and file path
-        file_path = os.path.join(DIR_PATH, f"{self.tid}.json")
+        file_path = self._cache_path()
         
         try:
             # Check if directory exists, if not create it
             if not os.path.exists(DIR_PATH):
                 os.makedirs(DIR_PATH)
-            
-            # Write the JSON to the file
-            with open(file_path, 'w') as file:
-                file.write(data_json)
+
+            with file_lock(file_path):
+                # pick up responses another process saved since we last read the cache
+                if os.path.exists(file_path) and os.path.getmtime(file_path) != self._synced_mtime:
+                    self._merge_from_cache(file_path)
+
+                # Create a dictionary to hold the relevant data
+                data = {
+                    'data': self.data,
+                    'prompts': self.prompts,
+                    'cases': self.cases,
+                    'models': self.models,
+                    'params': self.params,
+                    'sweep': self.sweep,
+                    'runs': self.runs,
+                    'batches': self.batches,
+                    'judgments': self.judgments,
+                    'output_schema': self.output_schema,
+                    'task_description': self.task_description,
+                }
+                
+                if self.cache_format == "binary":
+                    # streams compressed chunks to a temporary file and swaps it in
+                    write_cache(file_path, data)
+                else:
+                    # Convert the dictionary to JSON
+                    data_json = json.dumps(data, indent=4, default=to_json)
+
+                    # Write the JSON to a temporary file and swap it in
+                    atomic_write(file_path, data_json)
+                self._synced_mtime = os.path.getmtime(file_path)
         except Exception as e:
             print(f"Caching failed due to: {e}")
 
+    def _merge_from_cache(self, cache_file_path):
+        """
+        Adds responses and feedback from the cache file that this process doesn't have yet.
+        """
+        data = self._read_cache_file(cache_file_path)
+
+        rows = []
+        for pid, pid_data in data.get('data', {}).items():
+            for cid, cid_data in pid_data.items():
+                for model, model_data in cid_data.items():
+                    for rid, response in model_data.items():
+                        existing = self.data.get(pid, {}).get(cid, {}).get(model, {}).get(rid)
+                        if existing is None:
+                            rows.append((pid, cid, model, rid, response))
+                        elif existing['feedback'] is None and response.get('feedback') is not None:
+                            existing['feedback'] = response['feedback']
+                            self._feedback_version += 1
+        self._add_responses(rows)
+
+        # and the pairwise judgments made in the other process
+        seen = {judgment['id'] for judgment in self.judgments}
+        self.judgments.extend(judgment for judgment in data.get('judgments', []) if judgment['id'] not in seen)
 
     def _load_data(self, file_path=None):
         """
-        Load responses, prompts, cases, and models from a json or csv file.
+        Load responses, prompts, cases, and models from a sqlite, binary, json or csv file.
         """
         if file_path is None:
-            # Default to a JSON file path using self.tid if no file_path is provided
-            file_path = os.path.join(DIR_PATH, f"{self.tid}.json")
+            # Default to a SQLite, binary or JSON file path using self.tid if no file_path is provided
+            file_path = os.path.join(DIR_PATH, f"{self.tid}.db")
+            if not os.path.exists(file_path):
+                # if both cache formats exist, the most recently saved one is current
+                caches = [os.path.join(DIR_PATH, f"{self.tid}.{extension}") for extension in ["thumb", "json"]]
+                caches = [path for path in caches if os.path.exists(path)]
+                file_path = max(caches, key=os.path.getmtime) if caches else os.path.join(DIR_PATH, f"{self.tid}.json")
             if not os.path.exists(file_path):
                 # Fallback to CSV if JSON does not exist
                 file_path = os.path.join(DIR_PATH, f"{self.tid}.csv")
@@ -299,14 +859,33 @@ class ThumbTest:
             raise FileNotFoundError(f"No file found at {file_path}")
 
         # Determine file type and read data
-        if file_path.endswith(".json"):
-            self._read_from_json(file_path)
+        if file_path.endswith(".db"):
+            self._read_from_sqlite(file_path)
         elif file_path.endswith(".csv"):
             self._read_from_csv(file_path)
+        elif file_path.endswith((".json", ".thumb")):
+            # binary caches are detected by their header, whatever the file is called
+            self._read_from_json(file_path)
         else:
-            raise TypeError(f"Unsupported file format. File must be JSON or CSV.")
+            raise TypeError(f"Unsupported file format. File must be SQLite, binary, JSON or CSV.")
+
+    def _read_from_sqlite(self, db_file_path):
+        # only the test setup is read, responses are queried when needed
+        self.storage = "sqlite"
+        self.store = SQLiteStore(db_file_path)
+        meta = self.store.get_meta()
+
+        self.prompts = meta.get('prompts', {})
+        self.cases = meta.get('cases', {})
+        self.models = meta.get('models', [])
+        self.params = meta.get('params', {})
+        self.sweep = meta.get('sweep', [])
+        self.runs = meta.get('runs', 0)
+        self.batches = meta.get('batches', [])
+        self.judgments = meta.get('judgments', [])
+        self.output_schema = meta.get('output_schema')
+        self.task_description = self.task_description or meta.get('task_description')
 
-        
     def _read_from_csv(self, csv_file_path):
         # Load the CSV file into a DataFrame
         csv_df = pd.read_csv(csv_file_path)
@@ -372,52 +951,65 @@ class ThumbTest:
         runs_value = compute_runs(data)
         
         # Combine all parts to form the final structure
-        self.data = data
+        self.data = compact_data(data)
         self.prompts = prompts
         self.cases = cases
         self.models = models
         self.runs = runs_value
 
+    def _read_cache_file(self, cache_file_path):
+        if is_binary_cache(cache_file_path):
+            return read_cache(cache_file_path)
+        with open(cache_file_path, 'r') as file:
+            return json.load(file)
+
     def _read_from_json(self, json_file_path):
-        with open(json_file_path, 'r') as file:
-            data = json.load(file)
+        binary = is_binary_cache(json_file_path)
+        data = self._read_cache_file(json_file_path)
+        if self.cache_format is None:
+            self.cache_format = "binary" if binary else "json"
+
+        # only track the mtime of the file this test will save to, a cache being migrated is left alone
+        if os.path.abspath(json_file_path) == os.path.abspath(self._cache_path()):
+            self._synced_mtime = os.path.getmtime(json_file_path)
             
         # Update the instance variables with the loaded data
-        self.data = data.get('data', {})
+        self.data = compact_data(data.get('data', {}))
         self.prompts = data.get('prompts', {})
         self.cases = data.get('cases', {})
         self.models = data.get('models', [])
+        self.params = data.get('params', {})
+        self.sweep = data.get('sweep', [])
         self.runs = data.get('runs', 0)
+        self.batches = data.get('batches', [])
+        self.judgments = data.get('judgments', [])
+        self.output_schema = data.get('output_schema')
+        self.task_description = self.task_description or data.get('task_description')
 
     def _prep_for_eval(self):
         """
         Prepare the responses for evaluation.
         """
+        if self.store is not None:
+            # already shuffled by the query
+            return self.store.unlabeled()
+
         # Create a list to hold the responses
         responses = []
         
-        # Loop through the prompts
-        for pid in self.data.keys():
-            # Loop through the cases
-            for cid in self.data[pid].keys():
-                # Loop through the models
-                for model in self.data[pid][cid].keys():
-                    # Loop through the responses
-                    for rid, response in self.data[pid][cid][model].items():
-                        # if the response has feedback, skip it
-                        if response['feedback'] is not None:
-                            continue
-                        # Create a dictionary to hold the response data
-                        response_data = {
-                            'pid': pid,
-                            'cid': cid,
-                            'model': model,
-                            'rid': rid,
-                            'content': response["content"],
-                        }
-                        
-                        # Add the response data to the list of responses
-                        responses.append(response_data)
+        # Loop through the responses that don't have feedback yet
+        for pid, cid, model, rid, response in self._iter_responses(unlabeled=True):
+            # Create a dictionary to hold the response data
+            response_data = {
+                'pid': pid,
+                'cid': cid,
+                'model': model,
+                'rid': rid,
+                'content': response["content"],
+            }
+            
+            # Add the response data to the list of responses
+            responses.append(response_data)
         
         # shuffle the order of the responses
         random.shuffle(responses)
@@ -429,49 +1021,408 @@ class ThumbTest:
         value = 1 if label.description == "👍" else 0
 
         # Update the response based on the provided index
-        self.data[pid][cid][model][rid]['feedback'] = value
+        self._feedback_version += 1
+        if self.store is not None:
+            self.store.set_feedback(pid, cid, model, rid, value)
+        else:
+            self.data[pid][cid][model][rid]['feedback'] = value
+
+        return value
+
+    def _aggregator(self):
+        if self.store is not None:
+            return ResultsAggregator.from_totals(self.store.group_totals())
+        return ResultsAggregator.from_responses(self._iter_responses())
+
+    def _describe_model(self, model):
+        # the model name and sampling parameters a response was generated with
+        name = self._model_name(model)
+        if name == model:
+            return {"model": model}
+        return {"model": name, "psid": model.rpartition("@")[2], **self.params[model.rpartition("@")[2]]}
+
+    def stats(self, by=None):
+        """
+        Average score, tokens and cost by prompt. Pass by to slice the results instead, by any of "pid", "cid", "model"
+        (the name), "psid" or a sampling parameter like "temperature", which returns a DataFrame.
+        """
+        if by is not None:
+            by = [by] if isinstance(by, str) else list(by)
+            totals_df = self._aggregator().totals_frame(self._describe_model)
+            unknown = [column for column in by if column not in totals_df.columns]
+            if unknown:
+                raise ValueError(f"Can't slice the stats by {unknown}, they aren't ids or sampling parameters of this test.")
+            return summarize_totals(totals_df, by)
 
-    def stats(self):
         # Create a list to hold the scores by prompt
         scores = {}
-        
-        # Loop through the prompts
-        for pid in self.data.keys():
-            # Add the prompt to the dictionary
-            prompt = self.prompts[pid]
-            scores[pid] = {
-                'prompt': prompt,
-                'feedback': [],
-                'tokens': [],
-                'cost': [],
-            }
-            # Loop through the cases
-            for cid in self.data[pid].keys():
-                # Loop through the models
-                for model in self.data[pid][cid].keys():
-                    # Loop through the responses
-                    for response in self.data[pid][cid][model].values():
-
-                        # Add the feedback to the list of scores
-                        scores[pid]['feedback'].append(response['feedback'])
 
-                        # Add the tokens to the total
-                        scores[pid]['tokens'].append(response['tokens']) 
+        if self.store is not None:
+            for pid, values in self.store.pid_values().items():
+                scores[pid] = {'prompt': self.prompts[pid], **values}
+        else:
+            # Loop through the responses
+            for pid, _, _, _, response in self._iter_responses():
+                if pid not in scores:
+                    scores[pid] = {
+                        'prompt': self.prompts[pid],
+                        'feedback': [],
+                        'tokens': [],
+                        'cost': [],
+                    }
+
+                # Add the feedback, tokens and cost to the lists
+                scores[pid]['feedback'].append(response.get('feedback'))
+                scores[pid]['tokens'].append(response.get('tokens'))
+                scores[pid]['cost'].append(response.get('cost'))
+
+        # Calculate the average score, of the responses that have been rated
+        def average(values):
+            values = [value for value in values if value is not None]
+            return sum(values) / len(values) if values else None
 
-                        # Add the cost to the total                            
-                        scores[pid]['cost'].append(response['cost']) 
-        
-        # Calculate the average score
         for pid in scores.keys():
-            scores[pid]['avg_score'] = sum(scores[pid]['feedback']) / len(scores[pid]['feedback'])
-            scores[pid]['avg_tokens'] = sum(scores[pid]['tokens']) / len(scores[pid]['tokens'])
-            scores[pid]['avg_cost'] = sum(scores[pid]['cost']) / len(scores[pid]['cost'])
+            scores[pid]['avg_score'] = average(scores[pid]['feedback'])
+            scores[pid]['avg_tokens'] = average(scores[pid]['tokens'])
+            scores[pid]['avg_cost'] = average(scores[pid]['cost'])
+
+        # Average the automatic scores stored next to feedback
+        for pid, auto_scores in self._auto_scores().items():
+            for key, value in auto_scores.items():
+                scores[pid][f"avg_{key}"] = value
         
         return scores
 
-    def evaluate(self):
+    def _auto_scores(self):
+        """
+        The average of each automatic score (reference metrics and evaluators) for each pid.
+        """
+        if self.store is not None:
+            averages = {}
+            for field in AUTO_SCORE_FIELDS:
+                for pid, values in self.store.field_stats(field).items():
+                    averages.setdefault(pid, {}).update({key: value for key, value in values.items() if key != "hash"})
+            return averages
+
+        totals = {}
+        for pid, _, _, _, response in self._iter_responses():
+            for field in AUTO_SCORE_FIELDS:
+                for key, value in response.get(field, {}).items():
+                    if key != "hash" and isinstance(value, (int, float)):
+                        total = totals.setdefault(pid, {}).setdefault(key, [0, 0])
+                        total[0] += value
+                        total[1] += 1
+        return {pid: {key: total / count for key, (total, count) in values.items()} for pid, values in totals.items()}
+
+    def _feedback_key(self):
+        # other processes can rate responses in a shared sqlite database too
+        return (self._feedback_version, self.store.data_version() if self.store is not None else None)
+
+    def _variant_order(self, by):
+        # prompts or models in the order they were added
+        return list(self.prompts.keys()) if by == "pid" else [model for model, _, _ in self._model_variants()]
+
+    def compare(self, control=None, by="pid", n_boot=2000, confidence=0.95, seed=0):
+        """
+        Compares every prompt (by="pid") or model (by="model") to a control, the first one by default. Returns a DataFrame
+        with the lift in score over the control, a bootstrap confidence interval for it, and the probability each one beats
+        the control. Responses are resampled within each case, and results are cached until the feedback changes.
+        """
+        if by not in ["pid", "model"]:
+            raise ValueError("by must be 'pid' or 'model'")
+
+        key = (control, by, n_boot, confidence, seed)
+        feedback_key = self._feedback_key()
+        if self._comparisons.get("feedback_key") != feedback_key:
+            self._comparisons = {"feedback_key": feedback_key}
+        if key in self._comparisons:
+            return self._comparisons[key].copy()
+
+        # labeled responses and thumbs up for every variant and case
+        groups = self._aggregator().groups["full"]
+        order = self._variant_order(by)
+        seen = {pid if by == "pid" else model for pid, _, model in groups.keys()}
+        variants = [variant for variant in order if variant in seen] + sorted(seen - set(order))
+        cids = sorted({cid for _, cid, _ in groups.keys()})
+        if not variants:
+            raise ValueError("There are no responses to compare yet.")
+
+        if control is None:
+            control = variants[0]
+        if control not in variants:
+            raise ValueError(f"Control {control} has no responses, choose one of {variants}")
+
+        variant_index = {variant: i for i, variant in enumerate(variants)}
+        cid_index = {cid: i for i, cid in enumerate(cids)}
+        successes = np.zeros((len(variants), len(cids)))
+        trials = np.zeros((len(variants), len(cids)))
+        for (pid, cid, model), totals in groups.items():
+            i, j = variant_index[pid if by == "pid" else model], cid_index[cid]
+            successes[i, j] += totals.feedback
+            trials[i, j] += totals.labeled
+
+        results = bootstrap_lift(successes, trials, variant_index[control], n_boot=n_boot, confidence=confidence, seed=seed)
+        comparison = pd.DataFrame({by: variants, "control": control, **results})
+        self._comparisons[key] = comparison
+        return comparison.copy()
+
+    def ratings(self, by="pid"):
+        """
+        Elo style ratings of every prompt (by="pid") or model (by="model") from the pairwise judgments, with a range of
+        two standard deviations either side, sorted best first.
+        """
+        if by not in ["pid", "model"]:
+            raise ValueError("by must be 'pid' or 'model'")
+        position = 0 if by == "pid" else 2
+        judged = {judgment[side][position] for judgment in self.judgments if judgment.get('by', "pid") == by for side in "ab"}
+        order = self._variant_order(by)
+        variants = order + sorted(judged - set(order))
+        return replay_judgments(self.judgments, variants, by).to_frame(name=by)
+
+    def _step_model(self, pid, name, model):
+        # the model a chain step ran on, for responses from before steps recorded it
+        step = self.prompts[pid]["steps"].get(name) or {}
+        return split_model(step.get("model") or self._model_name(model))[0]
+
+    def _token_totals(self):
+        """
+        Model calls and the summed prompt, cached and completion tokens for each pid, cid, model, the name of the model
+        that was billed and the pricing tier. Chain runs are split into their steps, which can run on different models.
+        """
+        totals = defaultdict(lambda: [0, 0, 0, 0])
+
+        def add(key, calls, prompt_tokens, cached_tokens, completion_tokens):
+            total = totals[key]
+            total[0] += calls
+            total[1] += prompt_tokens or 0
+            total[2] += cached_tokens or 0
+            total[3] += completion_tokens or 0
+
+        if self.store is not None:
+            # the database adds up everything but the chains
+            for pid, cid, model, tier, *counts in self.store.token_totals():
+                add((pid, cid, model, self._model_name(model), tier), *counts)
+            responses = (row for pid, prompt in self.prompts.items() if is_chain(prompt) for row in self._iter_responses(pid=pid))
+        else:
+            responses = self._iter_responses()
+
+        for pid, cid, model, _, response in responses:
+            tier = response.get('tier') or "standard"
+            steps = response.get('steps')
+            if steps is None:
+                add((pid, cid, model, self._model_name(model), tier), 1, response.get('prompt_tokens'), response.get('cached_tokens'), response.get('completion_tokens'))
+                continue
+            for name, step in steps.items():
+                if step.get('error'):
+                    continue
+                step_model = step.get('model') or self._step_model(pid, name, model)
+                add((pid, cid, model, step_model, tier), 1, step.get('prompt_tokens'), step.get('cached_tokens'), step.get('completion_tokens'))
+        return [(*key, *total) for key, total in totals.items()]
+
+    def costs(self, by="pid", version=None, tier=None):
+        """
+        The cost of the test worked out from its token counts, with a version of the prices (a date like "2023-11-06",
+        the latest by default) and optionally as if every call was billed at one tier, like "batch". Group by any of
+        "pid", "cid", "model" (the model and its parameter set), "name" (the model billed) and "tier". Prices are looked
+        up once per model, so repricing a big test is a single multiplication of the token totals. Calls to a model without
+        a price have a cost of NaN.
+        """
+        by = [by] if isinstance(by, str) else list(by)
+        columns = ["pid", "cid", "model", "name", "tier", "calls", "prompt_tokens", "cached_tokens", "completion_tokens"]
+        unknown = [column for column in by if column not in columns[:5]]
+        if unknown:
+            raise ValueError(f"Can't group the costs by {unknown}, choose from {columns[:5]}")
+
+        totals_df = pd.DataFrame(self._token_totals(), columns=columns)
+        totals_df["cost"] = pricing.costs(
+            totals_df["name"], totals_df["prompt_tokens"], totals_df["completion_tokens"],
+            tiers=totals_df["tier"] if tier is None else tier, cached_tokens=totals_df["cached_tokens"], version=version,
+        )
+        # min_count keeps a group that's all unpriced as NaN instead of 0
+        return totals_df.groupby(by).agg(
+            calls=("calls", "sum"),
+            prompt_tokens=("prompt_tokens", "sum"),
+            cached_tokens=("cached_tokens", "sum"),
+            completion_tokens=("completion_tokens", "sum"),
+            cost=("cost", lambda cost: cost.sum(min_count=1)),
+        ).reset_index()
+
+    def _reprice_steps(self, pid, model, response, version):
+        # a chain's cost is the sum of its steps, each priced on its own model
+        steps = {}
+        for name, step in response['steps'].items():
+            step = dict(step)
+            if not step.get('error'):
+                cost = pricing.cost(step.get('prompt_tokens'), step.get('completion_tokens'), step.get('model') or self._step_model(pid, name, model),
+                                    tier=response.get('tier'), cached_tokens=step.get('cached_tokens'), version=version)
+                if cost is not None:
+                    step['cost'] = cost
+            steps[name] = step
+        return {'steps': steps, 'cost': sum(step.get('cost') or 0 for step in steps.values())}
+
+    def reprice(self, version=None):
+        """
+        Recomputes the cost stored with every response from its token counts, with a version of the prices (the latest
+        by default). Responses from models without a price keep the cost they had.
+        """
+        if self.store is not None:
+            # one update per model and tier, run by the database
+            variants = {(model, tier) for _, _, model, tier, *_ in self.store.token_totals()}
+            rates = [(model, tier, *pricing.rates(self._model_name(model), tier, version)) for model, tier in variants]
+            self.store.set_costs([rate for rate in rates if not np.isnan(rate[2])])
+            responses = (row for pid, prompt in self.prompts.items() if is_chain(prompt) for row in self._iter_responses(pid=pid))
+        else:
+            responses = self._iter_responses()
+
+        updates, calls = [], []
+        for pid, cid, model, rid, response in responses:
+            if response.get('steps') is not None:
+                updates.append((pid, cid, model, rid, self._reprice_steps(pid, model, response, version)))
+            else:
+                calls.append((pid, cid, model, rid, response))
+
+        if calls:
+            costs = pricing.costs(
+                [self._model_name(model) for _, _, model, _, _ in calls],
+                [response.get('prompt_tokens') for *_, response in calls],
+                [response.get('completion_tokens') for *_, response in calls],
+                tiers=[response.get('tier') for *_, response in calls],
+                cached_tokens=[response.get('cached_tokens') for *_, response in calls],
+                version=version,
+            )
+            updates += [(pid, cid, model, rid, {'cost': float(cost)}) for (pid, cid, model, rid, _), cost in zip(calls, costs) if not np.isnan(cost)]
+
+        if updates:
+            self._update_responses(updates)
+        self._save_data()
+        if self.verbose: print(f"Repriced the responses with the {version or pricing.latest} prices")
+
+    def score_references(self):
+        """
+        Scores every response against the reference answer of its case (the __ref__ key) with exact match, BLEU and ROUGE.
+        Scores are stored under metrics next to feedback, and only recomputed when the response or reference changes.
+        """
+        references = {cid: case["__ref__"] for cid, case in self.cases.items() if case and case.get("__ref__") is not None}
+        if not references:
+            raise ValueError("No test cases have a reference answer. Add a __ref__ key to your cases.")
+
+        scored = 0
+        cache = {}
+        # one pid at a time, so large tests don't need every response in memory
+        for pid in self.prompts.keys():
+            items = []
+            for _, cid, model, rid, response in self._iter_responses(pid=pid):
+                if cid not in references or response.get("error"):
+                    continue
+                # skip the responses whose scores are already up to date
+                if (response.get("metrics") or {}).get("hash") == reference_hash(response["content"], references[cid]):
+                    continue
+                items.append(((pid, cid, model, rid), response["content"], references[cid]))
+
+            results = score_responses(items, cache=cache)
+            updates = [(*key, {"metrics": results[key]}) for key, _, _ in items]
+            self._update_responses(updates)
+            scored += len(updates)
+
+        self._save_data()
+        if self.verbose: print(f"Scored {scored} responses against their references")
+        return scored
+
+    def run_evaluators(self, processes=None, chunksize=256):
+        """
+        Runs every evaluator over the responses in a process pool, storing the scores under evals next to feedback.
+        Responses an evaluator has already scored are skipped, unless the response or the evaluator version has changed.
+        """
+        if not self.evaluators:
+            raise ValueError("No evaluators have been added. Use add_evaluator first.")
+
+        items = []
+        previous_scores = {}
+        for pid, cid, model, rid, response in self._iter_responses():
+            if response.get("error"):
+                continue
+            key = (pid, cid, model, rid)
+            items.append((key, response["content"], response.get("eval_keys", {})))
+            previous_scores[key] = response.get("evals", {})
+
+        results = run_evaluators(self.evaluators, items, processes=processes, chunksize=chunksize, verbose=self.verbose)
+
+        # merge the new scores with any the response already has
+        updates = []
+        for key, _, cached_keys in items:
+            if key not in results:
+                continue
+            new_scores, new_keys = results[key]
+            updates.append((*key, {
+                "evals": {**previous_scores[key], **new_scores},
+                "eval_keys": {**cached_keys, **new_keys},
+            }))
+        self._update_responses(updates)
+        self._save_data()
+
+        if self.verbose: print(f"Evaluated {len(updates)} responses with {len(self.evaluators)} evaluators")
+        return len(updates)
+
+    def _flatten(self):
+        """
+        Yields one row per response with the prompt and case it was generated from.
+        """
+        for pid, cid, model, rid, details in self._iter_responses():
+            prompt = self.prompts.get(pid, None)
+            case = json.dumps(self.cases.get(cid, None))
+
+            content = details.get('content', None)
+            tokens = details.get('tokens', None)
+            cost = details.get('cost', None)
+            feedback = details.get('feedback', None)
+            latency = details.get('latency', None)
+            prompt_tokens = details.get('prompt_tokens', None)
+            completion_tokens = details.get('completion_tokens', None)
+
+            yield [pid, prompt, cid, case, model, rid, content, tokens, prompt_tokens, completion_tokens, cost, latency, feedback]
+
+    def _group_stats(self):
+        """
+        Runs, feedback, score, tokens, cost and latency for every pid, cid and model combination.
+        """
+        columns = ['PID', 'CID', 'Model', 'runs', 'feedback', 'score', 'tokens', 'cost', 'latency']
+        if self.store is not None:
+            return pd.DataFrame(data=self.store.group_stats(), columns=columns)
+
+        df = pd.DataFrame(data=list(self._flatten()), columns=CSV_COLUMNS)
+        
+        stats_df = df.groupby(['PID', 'CID', 'Model']).agg(
+                        runs=('PID', 'size'),
+                        feedback=('Feedback', 'sum'),
+                        score=('Feedback', 'mean'),
+                        tokens=('Tokens', 'mean'),
+                        cost=('Cost', 'mean'),
+                        latency=('Latency', 'mean'),
+                        ).reset_index()
+        return stats_df[columns]
+
+    def evaluate(self, refresh_interval=0.5, mode="absolute", by="pid", max_judgments=None, order="random", stop_at=0.95):
+        """
+        Rate the responses with thumbs up / down, or with mode="pairwise" pick the better of two responses at a time.
+        With order="active", the next response is the one that does the most to settle which prompt (by="pid") or
+        model (by="model") is best, and rating stops once one is the best with probability stop_at (None to keep going).
+        """
+        if mode == "pairwise":
+            return self.evaluate_pairwise(by=by, max_judgments=max_judgments)
+        if mode != "absolute":
+            raise ValueError("mode must be 'absolute' or 'pairwise'")
+        if order not in ["random", "active"]:
+            raise ValueError("order must be 'random' or 'active'")
+        if by not in ["pid", "model"]:
+            raise ValueError("by must be 'pid' or 'model'")
+
         prepped_data = self._prep_for_eval()
         data_len = len(prepped_data)
+        # totals are kept up to date on every click, rather than recalculated from every response at the end
+        aggregator = self._aggregator()
+        queue = ActiveQueue(prepped_data, aggregator.groups["full"], by=by) if order == "active" else None
+        current = None
+        labeled = 0
         labels = ["👎", "👍"]
         label_widgets = [widgets.Button(description=label) for label in labels]
 
@@ -481,163 +1432,73 @@ class ThumbTest:
         response_box = widgets.HTML()
         case_box = widgets.HTML()
         progress_bar = widgets.IntProgress(min=0, max=data_len, description="Progress:")
+        leader_box = widgets.HTML()
 
-        def update_response():
-            nonlocal prepped_data
-            if not prepped_data:
-                self.export_to_csv()
-                stats = ""
-                
-                # TODO abstract this out into a function
-                flattened_data = []
-                for pid, pid_data in self.data.items():
-                    prompt = self.prompts.get(pid, None)
-
-                    for cid, cid_data in pid_data.items():
-                        case = self.cases.get(cid, None)
-                        case = json.dumps(case)
-
-                        for model, model_data in cid_data.items():
-                            for rid, details in model_data.items():
-                                content = details.get('content', None)
-                                tokens = details.get('tokens', None)
-                                cost = details.get('cost', None)
-                                feedback = details.get('feedback', None)
-                                latency = details.get('latency', None)
-                                prompt_tokens = details.get('prompt_tokens', None)
-                                completion_tokens = details.get('completion_tokens', None)
-
-                                flattened_data.append([pid, prompt, cid, case, model, rid, content, tokens, prompt_tokens, completion_tokens, cost, latency, feedback])
-
-                df = pd.DataFrame(data=flattened_data, columns=["PID", "Prompt", "CID", "Case", "Model", "RID", "Content", "Tokens", "Prompt Tokens", "Completion Tokens", "Cost", "Latency", "Feedback"])
-                
-                stats_df = df.groupby(['PID', 'CID', 'Model']).agg(
-                                runs=('PID', 'size'),
-                                feedback=('Feedback', 'sum'),
-                                score=('Feedback', 'mean'),
-                                tokens=('Tokens', 'mean'),
-                                cost=('Cost', 'mean'),
-                                latency=('Latency', 'mean'),
-                                ).reset_index()
-
-                full_stats_df = stats_df.pivot_table(index=['PID', 'CID', 'Model'],
-                                                      values=['runs', 'tokens', 'cost', 'latency', 'feedback', 'score'], 
-                                                      aggfunc={
-                                                        'runs': 'sum',
-                                                        'tokens': 'mean',
-                                                        'cost': 'mean',
-                                                        'latency': 'mean',
-                                                        'feedback': 'sum',
-                                                        'score': 'mean'
-                                                    })
-                
-                pid_stats_df = stats_df.pivot_table(index=['PID'],
-                                                      values=['runs', 'tokens', 'cost', 'latency', 'feedback', 'score'], 
-                                                      aggfunc={
-                                                        'runs': 'sum',
-                                                        'tokens': 'mean',
-                                                        'cost': 'mean',
-                                                        'latency': 'mean',
-                                                        'feedback': 'sum',
-                                                        'score': 'mean'
-                                                    }).reset_index()
-
-                cid_stats_df = stats_df.pivot_table(index=['CID'],
-                                                      values=['runs', 'tokens', 'cost', 'latency', 'feedback', 'score'], 
-                                                      aggfunc={
-                                                        'runs': 'sum',
-                                                        'tokens': 'mean',
-                                                        'cost': 'mean',
-                                                        'latency': 'mean',
-                                                        'feedback': 'sum',
-                                                        'score': 'mean'
-                                                    }).reset_index()
-                
-                model_stats_df = stats_df.pivot_table(index=['Model'],
-                                                      values=['runs', 'tokens', 'cost', 'latency', 'feedback', 'score'], 
-                                                      aggfunc={
-                                                        'runs': 'sum',
-                                                        'tokens': 'mean',
-                                                        'cost': 'mean',
-                                                        'latency': 'mean',
-                                                        'feedback': 'sum',
-                                                        'score': 'mean'
-                                                    }).reset_index()
-
-                # always show pid table
-                pid_table_output = pid_stats_df.to_html()
-                stats += f"<br>{pid_table_output}"
-
-                # - don't show the CID breakdown if base case
-                if len(self.cases) == 1:
-                    # Reset the multi-index to columns
-                    full_stats_df_reset = full_stats_df.reset_index()
-
-                    # Set the index again without 'CID'
-                    full_stats_df = full_stats_df_reset.set_index(['PID', 'Model'])
-
-                else:
-                    cid_table_output = cid_stats_df.to_html()
-                    stats += f"<br>{cid_table_output}"
-
-                # - don't show the model breakdown if only one model
-                if len(self.models) == 1:
-                    # Reset the multi-index to columns
-                    full_stats_df_reset = full_stats_df.reset_index()
-
-                    # Set the index again without 'CID'
-                    full_stats_df = full_stats_df_reset.set_index(['PID', 'CID'])
-
-                else:
-                    model_table_output = model_stats_df.to_html()
-                    stats += f"<br>{model_table_output}"
-                
-                # only show full stats if there's more than one model or more than one case
-                if len(self.models) > 1 or len(self.cases) > 1:
-                    full_table_output = full_stats_df.to_html()
-                    stats += f"<br>{full_table_output}"
-                
-                # add the prompt and case key to the end of the stats
-                stats += f"<br><br><b>Prompts</b>:<br>"
-                for pid, prompt in self.prompts.items():
-                    stats += f"{pid}: {prompt}<br>"
-
-                # if there are cases, add them to the stats
-                if len(self.cases) > 1:
-                    stats += f"<br><b>Cases</b>:<br>"
-                    for cid, case in self.cases.items():
-                        stats += f"{cid}: {case}<br>"
+        levels = ["pid"]
+        if len(self.models) > 1:
+            levels.append("model")
+        if len(self.cases) > 1:
+            levels.append("cid")
+        live_results = LiveResults(aggregator, levels=levels, refresh_interval=refresh_interval)
 
+        def finish():
+            # saving, exporting and rendering the full tables can take a while on big tests, so it happens off the UI thread
+            try:
+                self._save_data()
+                self.export_to_csv()
+                stats = summary_html(aggregator, self.prompts, self.cases, self.models)
                 response_box.value = f"Evaluation complete! 🎉<br><b>Results</b>: <br>{stats}<br>"
-                # Update children of main_box to exclude the label_widget
                 main_box.children = [response_box, test_id]
-                # cache the feedback
-                self._save_data()
+            except Exception as e:
+                response_box.value = f"Evaluation complete! 🎉<br>Saving the results failed due to: {e}"
+
+        def update_response():
+            nonlocal current
+            if queue is not None:
+                leader, probability = queue.leader()
+                leader_box.value = f"Most likely best: <b>{leader}</b> ({probability:.0%})" if len(queue.variants) > 1 else ""
+                # stop once the ranking is settled, there's no need to rate the rest
+                stable = stop_at is not None and queue.stable(stop_at)
+                current = None if stable else queue.pop()
+            else:
+                current = prepped_data.pop(0) if prepped_data else None
+
+            if current is None:
+                live_results.close()
+                response_box.value = "Evaluation complete! 🎉<br>Saving the results..."
+                if queue is not None and stop_at is not None and queue.stable(stop_at):
+                    response_box.value = f"The ranking is settled after {labeled} ratings 🎉<br>Saving the results..."
+                # Update children of main_box to exclude the label_widget
+                main_box.children = [response_box, leader_box, live_results.widget, test_id]
+                threading.Thread(target=finish, daemon=True).start()
                 return
             
-            next_response = prepped_data[0]["content"]
-            case = self.cases.get(prepped_data[0]['cid'], None)
-            progress_value = data_len - len(prepped_data)
+            next_response = current["content"]
+            case = self.cases.get(current['cid'], None)
 
             response_box.value = next_response
             # show each value in the case if show_cases is True in html
             if self.show_cases:
                 case_html = "<br>".join([f"<b>{key}</b>: {value}" for key, value in case.items()])
                 case_box.value = case_html
-            progress_bar.value = progress_value
+            progress_bar.value = labeled
 
         def on_button_clicked(b):
-            nonlocal prepped_data
-            if not prepped_data:
+            nonlocal labeled
+            if current is None:
                 return
 
-            response = prepped_data.pop(0)
+            response = current
             pid = response['pid']
             cid = response['cid']
             model = response['model']
             rid = response['rid']
 
-            self._receive_feedback(b, pid, cid, model, rid)
+            value = self._receive_feedback(b, pid, cid, model, rid)
+            labeled += 1
+            live_results.update(aggregator.add_feedback(pid, cid, model, value))
+            if queue is not None:
+                queue.add_feedback(pid, cid, model, value)
             update_response()
 
         # add on_click to buttons
@@ -648,15 +1509,108 @@ class ThumbTest:
         html_br = widgets.HTML("<br>")
         
         if self.show_cases:
-            main_box.children = [progress_bar, html_br, label_box, case_box, response_box, test_id]
+            main_box.children = [progress_bar, leader_box, html_br, label_box, case_box, response_box, live_results.widget, test_id]
         else:
-            main_box.children = [progress_bar, html_br, label_box, response_box, test_id]
+            main_box.children = [progress_bar, leader_box, html_br, label_box, response_box, live_results.widget, test_id]
 
         clear_output(wait=True)
 
         update_response()
         display(main_box)
         
+    def evaluate_pairwise(self, by="pid", max_judgments=None):
+        """
+        Shows two responses to the same case from different prompts (by="pid") or models (by="model") and asks which
+        is better. The ratings are updated after every judgment, and the next pair is the one whose outcome is the
+        most uncertain, so the ranking settles with far fewer judgments than rating every response.
+        """
+        if by not in ["pid", "model"]:
+            raise ValueError("by must be 'pid' or 'model'")
+
+        pool = PairPool(self._iter_responses(), by=by)
+        variants = pool.variants(self._variant_order(by))
+        if len(variants) < 2:
+            raise ValueError(f"Pairwise evaluation needs responses from at least two {'prompts' if by == 'pid' else 'models'}.")
+
+        ratings = replay_judgments(self.judgments, variants, by)
+        available = pool.available(variants)
+        made = 0
+        current = None
+
+        test_id = widgets.Label(value=f"ThumbTest: {self.tid}")
+        progress = widgets.Label()
+        case_box = widgets.HTML()
+        left_box = widgets.HTML(layout=widgets.Layout(width="50%", padding="0 8px"))
+        right_box = widgets.HTML(layout=widgets.Layout(width="50%", padding="0 8px"))
+        ratings_box = widgets.HTML()
+        buttons = [widgets.Button(description=label) for label in ["👈 Left is better", "Tie", "Right is better 👉", "Done"]]
+        main_box = widgets.VBox()
+
+        def show_ratings():
+            ratings_box.value = ratings.to_frame(name=by).to_html(index=False, float_format="{:.0f}".format)
+
+        def finish():
+            try:
+                self._save_data()
+                progress.value = f"Evaluation complete! 🎉 {made} judgments"
+            except Exception as e:
+                progress.value = f"Evaluation complete! 🎉 Saving the results failed due to: {e}"
+
+        def next_pair():
+            nonlocal current
+            pair = ratings.select_pair(available) if max_judgments is None or made < max_judgments else None
+            if pair is None:
+                current = None
+                progress.value = "Evaluation complete! 🎉 Saving the results..."
+                main_box.children = [progress, ratings_box, test_id]
+                threading.Thread(target=finish, daemon=True).start()
+                return
+
+            left, right = pool.sample(*pair)
+            # show them in a random order, so position doesn't give away which is which
+            if random.random() < 0.5:
+                left, right = right, left
+            current = (left, right)
+
+            progress.value = f"Judgments: {made}" + (f" / {max_judgments}" if max_judgments else "")
+            left_box.value = left[4]
+            right_box.value = right[4]
+            if self.show_cases:
+                case = self.cases.get(left[1]) or {}
+                case_box.value = "<br>".join([f"<b>{key}</b>: {value}" for key, value in case.items()])
+
+        def on_button_clicked(b):
+            nonlocal made, max_judgments
+            if current is None:
+                return
+            if b.description == "Done":
+                max_judgments = made
+                next_pair()
+                return
+
+            left, right = current
+            score = {"👈 Left is better": 1, "Tie": 0.5}.get(b.description, 0)
+            self.judgments.append({'id': uuid4().hex[0:8], 'by': by, 'a': list(left[:4]), 'b': list(right[:4]), 'score': score})
+            ratings.update(left[0] if by == "pid" else left[2], right[0] if by == "pid" else right[2], score)
+            made += 1
+            show_ratings()
+            next_pair()
+
+        for button in buttons:
+            button.on_click(on_button_clicked)
+
+        children = [progress, widgets.HBox(buttons)]
+        if self.show_cases:
+            children.append(case_box)
+        children += [widgets.HBox([left_box, right_box]), ratings_box, test_id]
+        main_box.children = children
+
+        clear_output(wait=True)
+
+        show_ratings()
+        next_pair()
+        display(main_box)
+
     def export_to_csv(self, filename=None):
 
         # set the filename
@@ -668,38 +1622,35 @@ class ThumbTest:
                 os.makedirs(f"thumb-tests/{today}/")
             filename = f"thumb-tests/{today}/ThumbTest-{self.tid}.csv"
         
-        # Flattening the data for CSV export
-        flattened_data = []
-
-        for pid, pid_data in self.data.items():
-            prompt = self.prompts.get(pid, None)
-
-            for cid, cid_data in pid_data.items():
-                case = self.cases.get(cid, None)
-                case = json.dumps(case)
-
-                for model, model_data in cid_data.items():
-                    for rid, details in model_data.items():
-                        content = details.get('content', None)
-                        tokens = details.get('tokens', None)
-                        cost = details.get('cost', None)
-                        feedback = details.get('feedback', None)
-                        latency = details.get('latency', None)
-                        prompt_tokens = details.get('prompt_tokens', None)
-                        completion_tokens = details.get('completion_tokens', None)
-
-                        flattened_data.append([pid, prompt, cid, case, model, rid, content, tokens, prompt_tokens, completion_tokens, cost, latency, feedback])
-
-        # Write to CSV
+        # Write to CSV, streaming the flattened responses
         with open(filename, 'w', newline='') as csvfile:
             writer = csv.writer(csvfile)
             # Writing header
-            writer.writerow(["PID", "Prompt", "CID", "Case", "Model", "RID", "Content", "Tokens", "Prompt Tokens", "Completion Tokens", "Cost", "Latency", "Feedback"])
+            writer.writerow(CSV_COLUMNS)
             # Writing data
-            writer.writerows(flattened_data)
+            writer.writerows(self._flatten())
         
         return filename
 
+    def report(self, directory=None, page_size=200):
+        """
+        Writes a static HTML report of the results to a directory, to share without a notebook. Tables are split into pages
+        that load as you go, and each prompt has its own page of responses. Returns the path to the report's index.html.
+        """
+        if not directory:
+            today = datetime.date.today().strftime("%Y-%m-%d")
+            directory = f"thumb-tests/{today}/ThumbTest-{self.tid}-report"
+        path = write_report(self, directory, page_size=page_size)
+        if self.verbose: print(f"Wrote the report to {path}")
+        return path
+
+    def _task_text(self, prompt_template=None):
+        # the task description as text, falling back to a prompt template's messages when the test doesn't have one
+        task_description = self.task_description or prompt_template
+        if isinstance(task_description, list):
+            return "\n\n".join(task_description)
+        return task_description
+
     def generate_prompt(self):
         # there's no task description and no prompts, throw error
         if not self.task_description and not len(self.prompts) > 0:
@@ -707,34 +1658,145 @@ class ThumbTest:
 
         # there is a task description but no prompts, use task description
         elif self.task_description and not len(self.prompts) > 0:
-            prompt_candidate = build_candidate_prompt(self.task_description, prompt_template=None, 
+            prompt_candidate = build_candidate_prompt(self._task_text(), prompt_template=None, 
                 test_cases=self.cases, criteria=self.criteria)
 
         # there is a prompt, use prompt
         elif len(self.prompts) > 0:
             # choose a prompt template at random
-            prompt_template = random.choice(list(self.prompts.values()))
-            prompt_candidate = build_candidate_prompt(self.task_description, prompt_template=prompt_template, 
+            prompt_template = random.choice(self._prompt_templates(include_steps=True))
+            prompt_candidate = build_candidate_prompt(self._task_text(prompt_template), prompt_template=prompt_template, 
                 test_cases=self.cases, criteria=self.criteria)
 
-        new_prompt_template = call(prompt_candidate)
-        # add the new prompt to the list of prompts
-        self.prompts.append(new_prompt_template)
-        if self.verbose: print(f"Added prompt: {new_prompt_template}")
+        response = call(prompt_candidate)
+        if response.get("error"):
+            raise RuntimeError(f"Prompt generation failed: {response['content']}")
 
-    def generate_case(self):
-        # if base case is in the keys, none
-        if "base-case" in self.cases.keys():
-            test_cases = None
-        else:
-            test_cases = self.cases
+        # add the new prompt to the test
+        new_prompt_template = response["content"].strip()
+        self.add_prompts([new_prompt_template])
+        return new_prompt_template
 
-        prompt_template = build_case_prompt(prompt_template, test_cases=test_cases)
-        new_case = call(prompt_template)
+    async def async_optimize_prompts(self, generations=3, candidates=8, min_cases=2, runs=1, eta=2, keep=1,
+                                     model=None, optimizer_model="gpt-4", scorer=None, max_concurrency=10):
+        """
+        Automatically engineers prompts: each generation writes candidates from the best prompts so far,
+        then uses successive halving to score them, starting on a few cases and runs and only spending more on the survivors.
+        The best prompts of every generation are added to the test. A scorer(content, case) function can replace the default GPT-4 rating.
+        """
+        if not self.task_description and not len(self.prompts) > 0:
+            raise ValueError("Please provide a task description or prompt template.")
+
+        # chains are left alone, their steps only make sense together
+        if not self._prompt_templates():
+            raise ValueError("Prompt optimization needs at least one prompt that isn't a chain.")
+
+        optimizer = PromptOptimizer(
+            self._task_text(self._prompt_templates(include_steps=True)[0]),
+            self.cases,
+            criteria=self.criteria,
+            model=model or (self._model_name(self.models[0]) if self.models else "gpt-3.5-turbo"),
+            optimizer_model=optimizer_model,
+            scorer=scorer,
+            max_concurrency=max_concurrency,
+            verbose=self.verbose,
+        )
+        history = await optimizer.optimize(self._prompt_templates(), generations=generations, candidates=candidates,
+                                           min_cases=min_cases, runs=runs, eta=eta, keep=keep)
+
+        best_prompts = []
+        for best in history:
+            for prompt, _ in best:
+                if prompt not in best_prompts:
+                    best_prompts.append(prompt)
+        self.add_prompts(best_prompts)
+        self._save_data()
+
+        if self.verbose: print(f"Prompt optimization used {optimizer.calls} calls")
+        return history
+
+    def optimize_prompts(self, **kwargs):
+        return run_async(self.async_optimize_prompts(**kwargs))
 
-        # add the new case to the list of cases
-        self.cases.append(new_case)
-        if self.verbose: print(f"Added case: {new_case}")
+    def generate_case(self):
+        new_cases = self.generate_cases(1)
+        return new_cases[0] if new_cases else None
+
+    def _prompt_templates(self, include_steps=False):
+        # the prompts that are a single template, and optionally the steps of every chain
+        templates = []
+        for prompt in self.prompts.values():
+            if not is_chain(prompt):
+                templates.append(prompt)
+            elif include_steps:
+                templates += [step["prompt"] for step in prompt["steps"].values()]
+        return templates
+
+    def _input_variables(self):
+        # every variable used across the prompt templates
+        variables = []
+        for prompt in self.prompts.values():
+            for variable in (input_variables(prompt) if is_chain(prompt) else get_input_variables(prompt)):
+                if variable not in variables:
+                    variables.append(variable)
+        return variables
+
+    async def async_generate_cases(self, n, batch_size=10, threshold=0.7, model=None, max_attempts=None):
+        """
+        Generates n new test cases concurrently from the prompt templates, in batches of batch_size calls.
+        Cases that aren't valid JSON with a value for every input variable, or that are near-duplicates of an existing case, are discarded.
+        """
+        if not len(self.prompts) > 0:
+            raise ValueError("Please add a prompt template before generating cases.")
+
+        if model is None:
+            model = {"model": "gpt-4", "temperature": 1.0}
+        if max_attempts is None:
+            max_attempts = n * 3
+
+        input_variables = self._input_variables()
+        if not input_variables:
+            raise ValueError("The prompt templates don't have any input variables to generate cases for.")
+
+        # index the existing cases so new ones have to be different from them too
+        index = NearDuplicateIndex(threshold=threshold)
+        existing = [case for case in self.cases.values() if case]
+        for case in existing:
+            index.add(" ".join(str(case.get(variable, "")) for variable in input_variables))
+
+        new_cases = []
+        attempts = 0
+        while len(new_cases) < n and attempts < max_attempts:
+            calls = min(batch_size, max_attempts - attempts, n - len(new_cases))
+            attempts += calls
+
+            tasks = []
+            for _ in range(calls):
+                prompt_template = random.choice(self._prompt_templates(include_steps=True))
+                case_prompt = build_case_prompt(prompt_template, test_cases=existing + new_cases)
+                tasks.append(acall(case_prompt, model=model))
+            responses = await asyncio.gather(*tasks)
+
+            for response in responses:
+                if response.get("error"):
+                    continue
+                case = parse_case(response["content"], input_variables)
+                if case is None:
+                    if self.verbose: print(f"Discarded invalid case: {response['content']}")
+                    continue
+                if not index.add(" ".join(str(case[variable]) for variable in input_variables)):
+                    if self.verbose: print(f"Discarded near-duplicate case: {case}")
+                    continue
+                new_cases.append(case)
+
+        new_cases = new_cases[:n]
+        self.add_cases(new_cases)
+        self._save_data()
+        if self.verbose: print(f"Generated {len(new_cases)} cases from {attempts} calls")
+        return new_cases
+
+    def generate_cases(self, n, **kwargs):
+        return run_async(self.async_generate_cases(n, **kwargs))
 
     # def generate_ratings(self, is_async=True):
     #     # run through the self.data and give a rating for each response
@@ -0,0 +1,260 @@
+import math
+import time
+import threading
+
+import pandas as pd
+import ipywidgets as widgets
+
+COLUMNS = ["runs", "feedback", "score", "tokens", "cost", "latency"]
+
+# the index columns of each breakdown
+LEVELS = {
+    "pid": ["PID"],
+    "cid": ["CID"],
+    "model": ["Model"],
+    "full": ["PID", "CID", "Model"],
+}
+
+
+class GroupTotals:
+    """
+    Running totals for one group of responses, so averages can be updated one response at a time.
+    """
+
+    __slots__ = ("runs", "labeled", "feedback", "tokens", "tokens_count", "cost", "cost_count", "latency", "latency_count")
+
+    def __init__(self):
+        for key in self.__slots__:
+            setattr(self, key, 0)
+
+    def add(self, totals):
+        for key, value in zip(self.__slots__, totals):
+            setattr(self, key, getattr(self, key) + (value or 0))
+
+    def row(self):
+        def mean(total, count):
+            return total / count if count else None
+
+        return {
+            "runs": self.runs,
+            "feedback": self.feedback,
+            "score": mean(self.feedback, self.labeled),
+            "tokens": mean(self.tokens, self.tokens_count),
+            "cost": mean(self.cost, self.cost_count),
+            "latency": mean(self.latency, self.latency_count),
+        }
+
+
+class ResultsAggregator:
+    """
+    Keeps the totals for every prompt, case, model and combination of the three, and updates only the
+    groups a new piece of feedback belongs to.
+    """
+
+    def __init__(self):
+        self.groups = {level: {} for level in LEVELS}
+
+    @classmethod
+    def from_totals(cls, rows):
+        """
+        Builds the aggregator from (pid, cid, model, runs, labeled, feedback, tokens, tokens count, cost, cost count,
+        latency, latency count) rows, like the ones SQLiteStore.group_totals returns.
+        """
+        aggregator = cls()
+        for row in rows:
+            for level, key in aggregator._keys(*row[:3]):
+                aggregator.groups[level].setdefault(key, GroupTotals()).add(row[3:])
+        return aggregator
+
+    @classmethod
+    def from_responses(cls, responses):
+        """
+        Builds the aggregator from (pid, cid, model, rid, response) tuples in a single pass.
+        """
+        totals = {}
+        for pid, cid, model, _, response in responses:
+            group = totals.setdefault((pid, cid, model), [0] * 9)
+            feedback = response.get('feedback')
+            group[0] += 1
+            if feedback is not None:
+                group[1] += 1
+                group[2] += feedback
+            for i, field in [(3, 'tokens'), (5, 'cost'), (7, 'latency')]:
+                value = response.get(field)
+                if value is not None and not (isinstance(value, float) and math.isnan(value)):
+                    group[i] += value
+                    group[i + 1] += 1
+        return cls.from_totals(key + tuple(group) for key, group in totals.items())
+
+    def _keys(self, pid, cid, model):
+        return [("pid", (pid,)), ("cid", (cid,)), ("model", (model,)), ("full", (pid, cid, model))]
+
+    def add_feedback(self, pid, cid, model, value):
+        """
+        Counts a new piece of feedback, returning the (level, key) of every group that changed.
+        """
+        changed = self._keys(pid, cid, model)
+        for level, key in changed:
+            group = self.groups[level].setdefault(key, GroupTotals())
+            group.labeled += 1
+            group.feedback += value
+        return changed
+
+    def row(self, level, key):
+        return self.groups[level][key].row()
+
+    def totals_frame(self, describe_model=None):
+        """
+        The raw totals of every pid, cid and model combination as a DataFrame. describe_model(model) can return a dict of
+        extra columns for each model, like its sampling parameters.
+        """
+        rows = []
+        for (pid, cid, model), totals in self.groups["full"].items():
+            row = {"pid": pid, "cid": cid, "model": model}
+            if describe_model is not None:
+                row.update(describe_model(model))
+            row.update({key: getattr(totals, key) for key in GroupTotals.__slots__})
+            rows.append(row)
+        return pd.DataFrame(data=rows)
+
+    def to_frame(self, level):
+        index = LEVELS[level]
+        rows = [dict(zip(index, key), **totals.row()) for key, totals in self.groups[level].items()]
+        return pd.DataFrame(data=rows, columns=index + COLUMNS)
+
+
+def summarize_totals(totals_df, by):
+    """
+    Adds up a DataFrame of group totals (the GroupTotals fields plus the columns to group by) and works out the averages.
+    """
+    sums = totals_df.groupby(by, dropna=False)[list(GroupTotals.__slots__)].sum()
+    summary = pd.DataFrame(index=sums.index)
+    summary["runs"] = sums["runs"]
+    summary["feedback"] = sums["feedback"]
+    summary["score"] = sums["feedback"] / sums["labeled"].where(sums["labeled"] > 0)
+    for column in ["tokens", "cost", "latency"]:
+        summary[column] = sums[column] / sums[f"{column}_count"].where(sums[f"{column}_count"] > 0)
+    return summary.reset_index()
+
+
+def _format(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return str(value)
+
+
+def _table_row(cells, tag="td"):
+    # every row is its own fixed layout table, so rows in separate widgets still line up
+    columns = "".join(f"<{tag} style='width: 110px; text-align: right; padding: 2px 6px'>{cell}</{tag}>" for cell in cells)
+    return f"<table style='table-layout: fixed; border-collapse: collapse'><tr>{columns}</tr></table>"
+
+
+class LiveResults:
+    """
+    A results panel that updates while responses are rated. Each row is its own widget so a click only re-renders
+    the rows it changed, and changes are batched so the panel redraws at most once per refresh interval.
+    """
+
+    def __init__(self, aggregator, levels=("pid",), refresh_interval=0.5):
+        self.aggregator = aggregator
+        self.refresh_interval = refresh_interval
+
+        self._rows = {level: {} for level in levels}
+        self._dirty = set()
+        self._last_refresh = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+        sections = []
+        for level in levels:
+            index = LEVELS[level]
+            header = widgets.HTML(_table_row(index + COLUMNS, tag="th"))
+            for key in sorted(aggregator.groups[level].keys()):
+                self._rows[level][key] = widgets.HTML(self._render(level, key))
+            sections.append(widgets.VBox([header] + list(self._rows[level].values())))
+        self.widget = widgets.VBox(sections)
+
+    def _render(self, level, key):
+        row = self.aggregator.row(level, key)
+        return _table_row(list(key) + [_format(row[column]) for column in COLUMNS])
+
+    def update(self, changed):
+        """
+        Marks the changed rows to be redrawn, now if the refresh interval has passed or otherwise once it has.
+        """
+        with self._lock:
+            self._dirty.update((level, key) for level, key in changed if level in self._rows)
+            wait = self.refresh_interval - (time.monotonic() - self._last_refresh)
+            if wait > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            for level, key in self._dirty:
+                if key not in self._rows[level]:
+                    # a group that had no responses when the panel was built
+                    continue
+                self._rows[level][key].value = self._render(level, key)
+            self._dirty.clear()
+            self._last_refresh = time.monotonic()
+            self._timer = None
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+        self.flush()
+
+
+def summary_html(aggregator, prompts, cases, models, max_rows=50):
+    """
+    The results tables shown when the evaluation is complete, with the prompt and case keys. The full breakdown and
+    the keys are cut off at max_rows, so a big test doesn't produce more HTML than the notebook can show.
+    """
+    stats = ""
+
+    # always show pid table
+    stats += f"<br>{aggregator.to_frame('pid').to_html()}"
+
+    full_stats_df = aggregator.to_frame("full")
+
+    # - don't show the CID breakdown if base case
+    if len(cases) == 1:
+        full_stats_df = full_stats_df.drop(columns=['CID'])
+    else:
+        stats += f"<br>{aggregator.to_frame('cid').to_html()}"
+
+    # - don't show the model breakdown if only one model
+    if len(models) == 1:
+        full_stats_df = full_stats_df.drop(columns=['Model'])
+    else:
+        stats += f"<br>{aggregator.to_frame('model').to_html()}"
+
+    # only show full stats if there's more than one model or more than one case
+    if len(models) > 1 or len(cases) > 1:
+        index = [column for column in LEVELS["full"] if column in full_stats_df.columns]
+        stats += f"<br>{full_stats_df.set_index(index).sort_index().head(max_rows).to_html()}"
+        if len(full_stats_df) > max_rows:
+            stats += f"<i>Showing {max_rows} of {len(full_stats_df)} rows, use test.report() for the rest</i><br>"
+
+    # add the prompt and case key to the end of the stats
+    stats += f"<br><br><b>Prompts</b>:<br>"
+    for pid, prompt in list(prompts.items())[:max_rows]:
+        stats += f"{pid}: {prompt}<br>"
+
+    # if there are cases, add them to the stats
+    if len(cases) > 1:
+        stats += f"<br><b>Cases</b>:<br>"
+        for cid, case in list(cases.items())[:max_rows]:
+            stats += f"{cid}: {case}<br>"
+        if len(cases) > max_rows:
+            stats += f"<i>and {len(cases) - max_rows} more cases</i><br>"
+
+    return stats
@@ -0,0 +1,81 @@
+import re
+import random
+import hashlib
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def shingles(text, k=3):
+    """
+    The set of word k-grams in a text, or the whole text for texts shorter than k words.
+    """
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < k:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i+k]) for i in range(len(words) - k + 1)}
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def _hash_shingle(shingle):
+    # stable across processes, unlike the builtin hash
+    return int.from_bytes(hashlib.md5(shingle.encode()).digest()[:4], "little")
+
+
+class NearDuplicateIndex:
+    """
+    Finds near-duplicate texts with MinHash signatures and locality sensitive hashing.
+    Candidates that share a band are checked against the exact shingle Jaccard similarity.
+    """
+
+    def __init__(self, threshold=0.7, num_perm=64, bands=16, k=3, seed=1):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.k = k
+
+        rng = random.Random(seed)
+        self.permutations = [(rng.randint(1, MERSENNE_PRIME - 1), rng.randint(0, MERSENNE_PRIME - 1)) for _ in range(num_perm)]
+
+        self.buckets = [{} for _ in range(bands)]
+        self.items = []
+
+    def signature(self, shingle_set):
+        hashes = [_hash_shingle(shingle) for shingle in shingle_set] or [0]
+        return [min(((a * h + b) % MERSENNE_PRIME) & MAX_HASH for h in hashes) for a, b in self.permutations]
+
+    def _band_keys(self, signature):
+        return [tuple(signature[i * self.rows:(i + 1) * self.rows]) for i in range(self.bands)]
+
+    def find(self, text):
+        """
+        Returns the index of an existing near-duplicate of the text, or None.
+        """
+        shingle_set = shingles(text, self.k)
+        signature = self.signature(shingle_set)
+        for band, key in zip(self.buckets, self._band_keys(signature)):
+            for idx in band.get(key, []):
+                if jaccard(shingle_set, self.items[idx]) >= self.threshold:
+                    return idx
+        return None
+
+    def add(self, text):
+        """
+        Adds the text unless it's a near-duplicate, returning whether it was added.
+        """
+        if self.find(text) is not None:
+            return False
+        shingle_set = shingles(text, self.k)
+        idx = len(self.items)
+        self.items.append(shingle_set)
+        for band, key in zip(self.buckets, self._band_keys(self.signature(shingle_set))):
+            band.setdefault(key, []).append(idx)
+        return True
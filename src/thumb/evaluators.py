@@ -0,0 +1,205 @@
+import re
+import json
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+from .utils import content_hash
+
+
+class Evaluator:
+    """
+    Scores the content of a response without an LLM, returning a number (usually 1 for pass and 0 for fail).
+    Bump the version when the evaluator changes, so responses it has already scored are scored again.
+    """
+
+    def __init__(self, name, fn=None, version="1"):
+        self.name = name
+        self.fn = fn
+        self.version = str(version)
+
+    def evaluate(self, content):
+        return self.fn(content)
+
+    def __call__(self, content):
+        try:
+            score = self.evaluate(content)
+        except Exception:
+            # a validator that raises has failed
+            return 0
+        if isinstance(score, bool):
+            return int(score)
+        return score
+
+    def cache_key(self, hashed_content):
+        return f"{self.version}:{hashed_content}"
+
+
+class RegexEvaluator(Evaluator):
+    """
+    Passes if the pattern is found in the response, or if it isn't when fail_on_match is True.
+    """
+
+    def __init__(self, name, pattern, fail_on_match=False, flags=0, version="1"):
+        super().__init__(name, version=version)
+        self.pattern = pattern
+        self.fail_on_match = fail_on_match
+        self.regex = re.compile(pattern, flags)
+
+    def evaluate(self, content):
+        found = self.regex.search(content) is not None
+        return int(found != self.fail_on_match)
+
+
+class AutoFailEvaluator(RegexEvaluator):
+    """
+    Fails any response that contains one of the words.
+    """
+
+    def __init__(self, name, words, case_sensitive=False, version="1"):
+        pattern = r"\b(" + "|".join(re.escape(word) for word in words) + r")\b"
+        super().__init__(name, pattern, fail_on_match=True, flags=0 if case_sensitive else re.IGNORECASE, version=version)
+
+
+class ParserEvaluator(Evaluator):
+    """
+    Passes if the parser (a function or an object with a parse method, like a langchain output parser) doesn't raise.
+    """
+
+    def __init__(self, name, parser, version="1"):
+        super().__init__(name, version=version)
+        self.parser = parser
+
+    def evaluate(self, content):
+        if hasattr(self.parser, "parse"):
+            self.parser.parse(content)
+        else:
+            self.parser(content)
+        return 1
+
+
+class JSONEvaluator(Evaluator):
+    """
+    Passes if the response is valid JSON.
+    """
+
+    def __init__(self, name="valid_json", version="1"):
+        super().__init__(name, version=version)
+
+    def evaluate(self, content):
+        json.loads(content)
+        return 1
+
+
+class JSONSchemaEvaluator(Evaluator):
+    """
+    Passes if the response is JSON that matches the schema. The validator is compiled once per process.
+    """
+
+    def __init__(self, name, schema, version="1"):
+        super().__init__(name, version=version)
+        self.schema = schema
+        self.schema_hash = content_hash(json.dumps(schema, sort_keys=True))
+        self._validator = None
+
+    @property
+    def validator(self):
+        if self._validator is None:
+            try:
+                import jsonschema
+            except ImportError:
+                raise ImportError("JSON schema evaluators require jsonschema: pip install jsonschema")
+            validator_class = jsonschema.validators.validator_for(self.schema)
+            validator_class.check_schema(self.schema)
+            self._validator = validator_class(self.schema)
+        return self._validator
+
+    def evaluate(self, content):
+        return int(self.validator.is_valid(json.loads(content)))
+
+    def __getstate__(self):
+        # compiled validators don't pickle, each worker process compiles its own
+        state = self.__dict__.copy()
+        state["_validator"] = None
+        return state
+
+    def cache_key(self, hashed_content):
+        # changing the schema rescores the responses too
+        return f"{self.version}:{self.schema_hash}:{hashed_content}"
+
+
+# evaluators are sent to each worker once, rather than with every chunk
+_worker_evaluators = []
+
+
+def _init_worker(evaluators):
+    global _worker_evaluators
+    _worker_evaluators = evaluators
+
+
+def _run_chunk(chunk):
+    index, _, contents = chunk
+    evaluator = _worker_evaluators[index]
+    return [evaluator(content) for content in contents]
+
+
+def _is_picklable(evaluators):
+    try:
+        pickle.dumps(evaluators)
+        return True
+    except Exception:
+        return False
+
+
+def run_evaluators(evaluators, items, processes=None, chunksize=256, verbose=False):
+    """
+    Runs each evaluator over the (key, content, cached keys) items that it hasn't scored yet, where cached keys is
+    the {evaluator name: cache key} a response was last scored with. Returns {key: ({name: score}, {name: cache key})}
+    for every item with new scores. Identical contents are only scored once per evaluator.
+    """
+    hashes = [content_hash(content) for _, content, _ in items]
+
+    # work out which contents each evaluator still needs to score
+    pending = []
+    for index, evaluator in enumerate(evaluators):
+        contents = {}
+        for (_, content, cached_keys), hashed_content in zip(items, hashes):
+            cache_key = evaluator.cache_key(hashed_content)
+            if cached_keys.get(evaluator.name) != cache_key:
+                contents.setdefault(cache_key, content)
+        pending.append(contents)
+
+    chunks = []
+    for index, contents in enumerate(pending):
+        cache_keys = list(contents.keys())
+        for i in range(0, len(cache_keys), chunksize):
+            chunk_keys = cache_keys[i:i+chunksize]
+            chunks.append((index, chunk_keys, [contents[cache_key] for cache_key in chunk_keys]))
+
+    if not chunks:
+        return {}
+
+    # lambdas and local functions can't be sent to other processes
+    if processes != 1 and len(chunks) > 1 and _is_picklable(evaluators):
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(evaluators,)) as executor:
+            chunk_scores = list(executor.map(_run_chunk, chunks))
+    else:
+        if verbose and processes != 1 and len(chunks) > 1: print("Evaluators can't be pickled, running them in this process")
+        _init_worker(evaluators)
+        chunk_scores = [_run_chunk(chunk) for chunk in chunks]
+
+    scores = [{} for _ in evaluators]
+    for (index, cache_keys, _), results in zip(chunks, chunk_scores):
+        for cache_key, score in zip(cache_keys, results):
+            scores[index][cache_key] = score
+
+    results = {}
+    for (key, content, cached_keys), hashed_content in zip(items, hashes):
+        new_scores, new_keys = {}, {}
+        for index, evaluator in enumerate(evaluators):
+            cache_key = evaluator.cache_key(hashed_content)
+            if cache_key in scores[index] and cached_keys.get(evaluator.name) != cache_key:
+                new_scores[evaluator.name] = scores[index][cache_key]
+                new_keys[evaluator.name] = cache_key
+        if new_scores:
+            results[key] = (new_scores, new_keys)
+    return results
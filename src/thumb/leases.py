@@ -0,0 +1,152 @@
+import os
+import time
+from uuid import uuid4
+from contextlib import contextmanager
+
+
+class RunLeases:
+    """
+    Marks runs as in-flight with one marker file per rid, so two processes resuming the same test don't both generate them.
+    A marker older than the ttl is treated as abandoned by a crashed process and can be claimed again.
+    """
+
+    def __init__(self, directory, ttl=600):
+        self.directory = directory
+        self.ttl = ttl
+        self.owner = uuid4().hex
+        self.held = set()
+
+    def _path(self, rid):
+        return os.path.join(self.directory, f"{rid}.lease")
+
+    def _is_expired(self, path):
+        try:
+            return time.time() - os.path.getmtime(path) > self.ttl
+        except FileNotFoundError:
+            return True
+
+    def _read_owner(self, path):
+        try:
+            with open(path, 'r') as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def claim(self, rid):
+        """
+        Returns True if this process now holds the lease for the rid.
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+
+        path = self._path(rid)
+        try:
+            # O_EXCL makes creating the marker atomic, only one process can win
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w') as file:
+                file.write(self.owner)
+        except FileExistsError:
+            if self._read_owner(path) == self.owner:
+                self.held.add(rid)
+                return True
+            if not self._is_expired(path):
+                return False
+            # take over the stale lease, then check no one else took it at the same time
+            tmp_path = f"{path}.{self.owner}"
+            with open(tmp_path, 'w') as file:
+                file.write(self.owner)
+            os.replace(tmp_path, path)
+            if self._read_owner(path) != self.owner:
+                return False
+
+        self.held.add(rid)
+        return True
+
+    def claim_many(self, rids):
+        """
+        Claims each rid, returning the ones this process now holds.
+        """
+        return [rid for rid in rids if self.claim(rid)]
+
+    def renew(self):
+        """
+        Pushes back the expiry of every lease held by this process.
+        """
+        for rid in self.held:
+            try:
+                os.utime(self._path(rid))
+            except FileNotFoundError:
+                pass
+
+    def release(self, rids):
+        for rid in rids:
+            path = self._path(rid)
+            if self._read_owner(path) == self.owner:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.held.discard(rid)
+
+    def release_all(self):
+        self.release(list(self.held))
+        # don't leave an empty claims directory behind, another process may still be using it if it isn't empty
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            pass
+
+
+@contextmanager
+def file_lock(path, timeout=60, stale=300):
+    """
+    Holds an exclusive lock file while the block runs, breaking locks left behind by crashed processes.
+    """
+    lock_path = f"{path}.lock"
+    start = time.time()
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.close(fd)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > stale:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.time() - start > timeout:
+                raise TimeoutError(f"Timed out waiting for lock on {path}")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def atomic_file(file_path, mode='w'):
+    """
+    Opens a temporary file next to the target and renames it into place once the block finishes,
+    so a crash never leaves a half-written file.
+    """
+    directory = os.path.dirname(file_path) or "."
+    tmp_path = os.path.join(directory, f".{os.path.basename(file_path)}.{uuid4().hex[0:8]}.tmp")
+    try:
+        with open(tmp_path, mode) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def atomic_write(file_path, data, mode='w'):
+    with atomic_file(file_path, mode) as file:
+        file.write(data)
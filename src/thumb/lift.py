@@ -0,0 +1,81 @@
+import warnings
+
+import numpy as np
+
+# cells whose binomial variance is at least this are resampled with a normal approximation
+NORMAL_MIN_VARIANCE = 9
+
+
+def bootstrap_lift(successes, trials, control, n_boot=2000, confidence=0.95, seed=0, max_cells=4_000_000):
+    """
+    Compares every variant to the control, given (variants x cases) arrays of thumbs up and labeled responses.
+    Only cases both the variant and the control have feedback for are compared, weighted by how many responses they have,
+    so a variant isn't helped or hurt by being rated on easier or harder cases. Each bootstrap sample resamples the
+    responses within each case, which for thumbs up / down is a binomial draw (approximated by a normal draw for cells
+    with lots of responses), so every variant, case and sample is drawn at once. Returns a dict of arrays with one value per variant.
+    """
+    successes = np.asarray(successes, dtype=float)
+    trials = np.asarray(trials, dtype=float)
+    num_variants, num_cases = trials.shape
+
+    rates = np.divide(successes, trials, out=np.zeros_like(trials), where=trials > 0)
+    shared = (trials > 0) & (trials[control] > 0)
+    weights = np.where(shared, trials + trials[control], 0.0)
+    total_weight = weights.sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        score = (weights * rates).sum(axis=1) / total_weight
+        control_score = (weights * rates[control]).sum(axis=1) / total_weight
+        lift = (score - control_score) / control_score
+
+    rng = np.random.default_rng(seed)
+    counts = trials.astype(np.int64)
+    # binomial draws are slow, so cells with plenty of responses use the normal approximation to the binomial
+    variance = trials * rates * (1 - rates)
+    exact = (trials > 0) & (variance < NORMAL_MIN_VARIANCE)
+    std = np.sqrt(variance) / np.maximum(trials, 1)
+
+    # draw the samples in chunks so memory stays bounded however many variants and cases there are
+    chunk = max(1, max_cells // max(num_variants * num_cases, 1))
+    differences, lifts = [], []
+    wins = np.zeros(num_variants)
+    for start in range(0, n_boot, chunk):
+        size = min(chunk, n_boot - start)
+        sampled_rates = rates + std * rng.standard_normal((size, num_variants, num_cases))
+        np.clip(sampled_rates, 0, 1, out=sampled_rates)
+        if exact.any():
+            sampled_rates[:, exact] = rng.binomial(counts[exact], rates[exact], size=(size, int(exact.sum()))) / trials[exact]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            variant_scores = np.einsum("bvc,vc->bv", sampled_rates, weights) / total_weight
+            control_scores = sampled_rates[:, control, :] @ weights.T / total_weight
+            differences.append(variant_scores - control_scores)
+            lifts.append((variant_scores - control_scores) / control_scores)
+        # ties count as half a win
+        wins += (variant_scores > control_scores).sum(axis=0) + 0.5 * (variant_scores == control_scores).sum(axis=0)
+
+    differences = np.concatenate(differences)
+    lifts = np.concatenate(lifts)
+    lifts[~np.isfinite(lifts)] = np.nan
+
+    tail = (1 - confidence) / 2 * 100
+    with warnings.catch_warnings():
+        # variants with no cases in common with the control have no samples
+        warnings.simplefilter("ignore", RuntimeWarning)
+        lift_low, lift_high = np.nanpercentile(lifts, [tail, 100 - tail], axis=0)
+        difference_low, difference_high = np.nanpercentile(differences, [tail, 100 - tail], axis=0)
+
+    win_probability = np.where(total_weight > 0, wins / n_boot, np.nan)
+    win_probability[control] = np.nan
+    return {
+        "cases": shared.sum(axis=1),
+        "labeled": trials.sum(axis=1).astype(int),
+        "score": score,
+        "control_score": control_score,
+        "difference": score - control_score,
+        "difference_low": difference_low,
+        "difference_high": difference_high,
+        "lift": lift,
+        "lift_low": lift_low,
+        "lift_high": lift_high,
+        "win_probability": win_probability,
+    }
@@ -2,14 +2,77 @@ from langchain.chat_models import ChatOpenAI
 from langchain.prompts import HumanMessagePromptTemplate, SystemMessagePromptTemplate, AIMessagePromptTemplate, ChatPromptTemplate
 from tqdm.auto import tqdm
 import time
-from langchain.callbacks.openai_info import standardize_model_name, MODEL_COST_PER_1K_TOKENS, get_openai_token_cost_for_model
 import asyncio
+import re
+import warnings
+from string import Formatter
 from langchain.schema.messages import SystemMessage, HumanMessage, AIMessage
 
+from .pricing import estimate_cost, cached_tokens
+
+# a {variable} in a prompt template
+VARIABLE = re.compile(r"\{[A-Za-z_][A-Za-z0-9_]*\}")
+
+def escape_template(template):
+    """
+    Escapes the curly brackets in a template that aren't {variables}, so prompts can contain JSON examples.
+    Brackets that are already escaped as {{ }} are left alone.
+    """
+    escaped = []
+    # whether each open bracket was escaped in the template already
+    opened = []
+    i = 0
+    while i < len(template):
+        char = template[i]
+        if char == "{":
+            if template.startswith("{{", i):
+                opened.append(True)
+                escaped.append("{{")
+                i += 2
+                continue
+            match = VARIABLE.match(template, i)
+            if match:
+                escaped.append(match.group())
+                i = match.end()
+                continue
+            opened.append(False)
+            escaped.append("{{")
+        elif char == "}":
+            if template.startswith("}}", i) and (not opened or opened[-1]):
+                if opened:
+                    opened.pop()
+                escaped.append("}}")
+                i += 2
+                continue
+            if opened:
+                opened.pop()
+            escaped.append("}}")
+        else:
+            escaped.append(char)
+        i += 1
+    return "".join(escaped)
+
+def get_input_variables(messages):
+    # the names of the {variables} used in a prompt template, ignoring escaped {{ }} and other brackets
+    if isinstance(messages, str):
+        messages = [messages]
+    variables = []
+    for message in messages:
+        for _, field_name, _, _ in Formatter().parse(escape_template(message)):
+            if field_name and field_name not in variables:
+                variables.append(field_name)
+    return variables
+
 def format_chat_prompt(messages, test_case=None):
     message_templates = []
     
     # if there is only one messages in the array, make it a HumanMessage
+    # brackets that aren't variables (like JSON in the prompt) are escaped, so they're sent as they are
+    if isinstance(messages, str):
+        messages = escape_template(messages)
+    else:
+        messages = [escape_template(message) for message in messages]
+
     if isinstance(messages, list) and len(messages) == 1:
         human_template = HumanMessagePromptTemplate.from_template(messages[0])
 
@@ -35,22 +98,39 @@ def format_chat_prompt(messages, test_case=None):
     chat_prompt_template = ChatPromptTemplate.from_messages(message_templates)
     if test_case:
         formatted_prompt = chat_prompt_template.format_prompt(**test_case)
-        print(formatted_prompt)
     else:
         formatted_prompt = chat_prompt_template.format_prompt()
     
     return formatted_prompt.to_messages()
 
-def estimate_openai_cost(prompt_tokens, completion_tokens, model_name):
-    total_cost = 0
-    model_name = standardize_model_name(model_name)
-    if model_name in MODEL_COST_PER_1K_TOKENS:
-        completion_cost = get_openai_token_cost_for_model(
-            model_name, completion_tokens, is_completion=True
-        )
-        prompt_cost = get_openai_token_cost_for_model(model_name, prompt_tokens)
-        total_cost += prompt_cost + completion_cost
-    return total_cost
+def messages_to_openai(messages):
+    # langchain messages to the role / content dicts the OpenAI API takes
+    roles = {SystemMessage: "system", HumanMessage: "user", AIMessage: "assistant"}
+    return [{"role": roles.get(type(message), "user"), "content": message.content} for message in messages]
+
+def function_call_fields(message, content):
+    """
+    The function or tool calls in an OpenAI message (or langchain's additional_kwargs, which has the same shape).
+    A call without any text is rated on its arguments, so they become the content.
+    """
+    calls = [call["function"] for call in message.get("tool_calls") or [] if call.get("function")]
+    if message.get("function_call"):
+        calls = [message["function_call"]] + calls
+    if not calls:
+        return {}
+
+    calls = [{"name": call.get("name"), "arguments": call.get("arguments")} for call in calls]
+    fields = {"function_call": calls[0]}
+    if len(calls) > 1:
+        fields["tool_calls"] = calls
+    if not content:
+        fields["content"] = calls[0]["arguments"] or ""
+    return fields
+
+def _generation_fields(generation):
+    # chat generations keep any function call in the message's additional_kwargs
+    message = getattr(generation, "message", None)
+    return function_call_fields(getattr(message, "additional_kwargs", None) or {}, generation.text)
 
 def parse_generate_response(resp):
     response_content = resp.generations[0][0].text
@@ -59,7 +139,8 @@ def parse_generate_response(resp):
     tokens = token_usage["total_tokens"]
     prompt_tokens = token_usage["prompt_tokens"]
     completion_tokens = token_usage["completion_tokens"]
-    cost = estimate_openai_cost(prompt_tokens, completion_tokens, model_name)
+    cached = cached_tokens(token_usage)
+    cost = estimate_cost(prompt_tokens, completion_tokens, model_name, cached_tokens=cached)
 
     response_data = {
         "content": response_content,
@@ -67,35 +148,142 @@ def parse_generate_response(resp):
         "cost": cost or 0,
         "prompt_tokens": prompt_tokens or 0,
         "completion_tokens": completion_tokens or 0,
+        **_generation_fields(resp.generations[0][0]),
     }
+    if cached:
+        response_data["cached_tokens"] = cached
     return response_data
 
-def get_responses(prompt, test_case, model, runs, pid, cid):
+def split_evenly(total, weights):
+    """
+    Splits an integer total in proportion to the weights, so the parts always add up to exactly the total.
+    """
+    total = total or 0
+    if sum(weights) <= 0:
+        weights = [1] * len(weights)
+    shares = [total * weight / sum(weights) for weight in weights]
+    parts = [int(share) for share in shares]
+    # hand out what's left to the parts that were rounded down the most
+    by_remainder = sorted(range(len(shares)), key=lambda i: shares[i] - parts[i], reverse=True)
+    for i in by_remainder[:total - sum(parts)]:
+        parts[i] += 1
+    return parts
 
-    if isinstance(model, dict):
-        model = model["name"]
-        temperature = model["temperature"]
-        chat = ChatOpenAI(model=model, temperature=temperature)
+def parse_multi_generate_response(resp):
+    """
+    Parses a response with several completions into one response per completion. Usage is only reported for the whole
+    call, so each completion gets an even share of the prompt and completion tokens, and its cost is worked out from
+    that share. The shares add up to exactly what was billed, but a single response's tokens and cost are an average.
+    """
+    fields = [_generation_fields(generation) for generation in resp.generations[0]]
+    contents = [field.get("content", generation.text) for field, generation in zip(fields, resp.generations[0])]
+    token_usage = resp.llm_output["token_usage"]
+    model_name = resp.llm_output["model_name"]
+
+    prompt_tokens = split_evenly(token_usage["prompt_tokens"], [1] * len(contents))
+    completion_tokens = split_evenly(token_usage["completion_tokens"], [1] * len(contents))
+    cached = split_evenly(cached_tokens(token_usage), [1] * len(contents))
+
+    responses = []
+    for field, content, prompt_part, completion_part, cached_part in zip(fields, contents, prompt_tokens, completion_tokens, cached):
+        response_data = {
+            "content": content,
+            "tokens": prompt_part + completion_part,
+            "cost": estimate_cost(prompt_part, completion_part, model_name, cached_tokens=cached_part) or 0,
+            "prompt_tokens": prompt_part,
+            "completion_tokens": completion_part,
+            **field,
+        }
+        if cached_part:
+            response_data["cached_tokens"] = cached_part
+        responses.append(response_data)
+    return responses
+
+# models that said they don't support several completions in one call, which get single calls from then on
+SINGLE_SAMPLE_MODELS = set()
+
+# errors that say the n parameter isn't supported, like "Unrecognized request argument supplied: n"
+N_UNSUPPORTED = re.compile(r"(argument|parameter|field)[^.\n]*['\"`]?\bn\b['\"`]?|['\"`]n['\"`]|\bn\b (is not supported|is unsupported|must be 1)", re.IGNORECASE)
+
+def _multi_sample_failed(model, error):
+    """
+    Called when a call for several completions fails, before falling back to single calls. Only an error saying n
+    isn't supported makes the model stick to single calls, anything else (like a rate limit) is reported and the
+    next call asks for several completions again.
+    """
+    if N_UNSUPPORTED.search(str(error)):
+        SINGLE_SAMPLE_MODELS.add(model)
     else:
-        chat = ChatOpenAI(model=model)
-        temperature = None
+        warnings.warn(f"Asking {model} for several completions failed, falling back to single calls: {error}")
+
+# sampling parameters ChatOpenAI takes directly, anything else (like top_p) is passed through model_kwargs
+CHAT_FIELDS = ["temperature", "max_tokens", "request_timeout", "max_retries"]
+
+def make_chat(model, params=None, **kwargs):
+    params = dict(params or {})
+    fields = {key: params.pop(key) for key in list(params.keys()) if key in CHAT_FIELDS}
+    if params:
+        fields["model_kwargs"] = params
+    return ChatOpenAI(model=model, **fields, **kwargs)
+
+def split_model(model, params=None):
+    # models can still be given as a dict of the name and its parameters
+    if isinstance(model, dict):
+        params = {**{key: value for key, value in model.items() if key not in ["name", "model"]}, **(params or {})}
+        model = model.get("name", model.get("model"))
+    return model, params or {}
+
+def _record_params(response_data, params, latency=None):
+    if latency is not None:
+        response_data["latency"] = latency or 0
+    if params.get("temperature") is not None:
+        response_data["temperature"] = params["temperature"]
+    return response_data
+
+def get_responses(prompt, test_case, model, runs, pid, cid, samples_per_call=1, params=None, heartbeat=None):
+    """
+    Generates the runs of a prompt, case and model one call at a time. heartbeat is called after every call, so a
+    caller can show it's still working on the runs.
+    """
+
+    model, params = split_model(model, params)
+    chat = make_chat(model, params)
     
     formatted_prompt = format_chat_prompt(prompt, test_case)
+    tags = [f"pid_{pid}", f"cid_{cid}"]
 
-    responses = []
-    for _ in tqdm(range(runs)):
+    def single_call():
         try:
             start_time = time.time()
-            resp = chat.generate([formatted_prompt], tags=[f"pid_{pid}", f"cid_{cid}"])
+            resp = chat.generate([formatted_prompt], tags=tags)
             end_time = time.time()
-            response_data = parse_generate_response(resp)
-            response_data["latency"] = end_time - start_time or 0
-            if temperature is not None:
-                response_data["temperature"] = temperature
+            response_data = _record_params(parse_generate_response(resp), params, end_time - start_time)
         except Exception as e:
             response_data = {"content": str(e), "error": True}
-        finally:                
-            responses.append(response_data)
+        return response_data
+
+    responses = []
+    with tqdm(total=runs) as progress:
+        while len(responses) < runs:
+            n = min(samples_per_call, runs - len(responses))
+            samples = []
+            if n > 1 and model not in SINGLE_SAMPLE_MODELS:
+                # identical runs are sent as one request for n completions
+                try:
+                    start_time = time.time()
+                    resp = make_chat(model, params, n=n).generate([formatted_prompt], tags=tags)
+                    end_time = time.time()
+                    samples = [_record_params(response_data, params, end_time - start_time) for response_data in parse_multi_generate_response(resp)[:n]]
+                except Exception as e:
+                    _multi_sample_failed(model, e)
+                    samples = []
+
+            # backends that don't support n fall back to single calls for the rest
+            fallback = [single_call() for _ in range(n - len(samples))]
+
+            responses += samples + fallback
+            progress.update(n)
+            if heartbeat: heartbeat()
 
     return responses
 
@@ -110,11 +298,38 @@ async def async_generate(chat, formatted_prompt, temperature=None, tags=[]):
         if temperature is not None:
             response_data["temperature"] = temperature
     except Exception as e:
-        response_data = {"content": str(e)}
+        response_data = {"content": str(e), "error": True}
     finally:  
         return response_data
 
+async def async_generate_samples(model, formatted_prompt, n=1, params=None, tags=[]):
+    """
+    Generates n responses to the same prompt, in one call for n completions where the backend supports it.
+    """
+    model, params = split_model(model, params)
+
+    samples = []
+    if n > 1 and model not in SINGLE_SAMPLE_MODELS:
+        try:
+            start_time = time.time()
+            resp = await make_chat(model, params, n=n).agenerate([formatted_prompt], tags=tags)
+            end_time = time.time()
+            samples = [_record_params(response_data, params, end_time - start_time) for response_data in parse_multi_generate_response(resp)[:n]]
+        except Exception as e:
+            _multi_sample_failed(model, e)
+            samples = []
+
+    # backends that don't support n fall back to single calls for the rest
+    chat = make_chat(model, params)
+    fallback = await asyncio.gather(*[async_generate(chat, formatted_prompt, params.get("temperature"), tags=tags) for _ in range(n - len(samples))])
+
+    return samples + list(fallback)
+
 async def async_get_responses(batch, verbose=False):
+    """
+    Generates the responses for a batch of items, returning them in order. An item with n set gets n responses,
+    and model_name and params (if set) say which model and sampling parameters to call.
+    """
     tasks = []
     
     for item in batch:
@@ -127,30 +342,25 @@ async def async_get_responses(batch, verbose=False):
 
         if verbose: print(f"Starting – pid: {pid}, cid: {cid}, model: {model}")
 
-        temperature = item.get('temperature', None)
-
-        if temperature:
-            chat = ChatOpenAI(model=model, temperature=temperature)
-        else:
-            chat = ChatOpenAI(model=model)
+        params = dict(item.get('params') or {})
+        if item.get('temperature') is not None:
+            params['temperature'] = item['temperature']
+        n = item.get('n', 1)
 
         formatted_prompt = format_chat_prompt(prompt, test_case)
 
-        if pid or cid:
-            tags = []
-            if pid:
-                tags.append(f"pid_{pid}")
-            if cid:
-                tags.append(f"cid_{cid}")
-            task = async_generate(chat, formatted_prompt, temperature, tags=tags)
-        else:
-            task = async_generate(chat, formatted_prompt, temperature)
+        tags = []
+        if pid:
+            tags.append(f"pid_{pid}")
+        if cid:
+            tags.append(f"cid_{cid}")
+        task = async_generate_samples(item.get('model_name', model), formatted_prompt, n, params, tags=tags)
 
         tasks.append(task)
 
-    responses = await asyncio.gather(*tasks)
+    samples = await asyncio.gather(*tasks)
     if verbose: print(f"Finished gathering batch responses")
-    return responses
+    return [response for item_samples in samples for response in item_samples]
 
 def call(formatted_prompt, model=None, tags=None, verbose=False):
     if model is None:
@@ -0,0 +1,186 @@
+import os
+import tempfile
+
+from .core import ThumbTest, load, AUTO_SCORE_FIELDS
+from .storage import SQLiteStore
+from .utils import run_id, content_hash
+
+# responses copied from a json test to its temporary sqlite store at a time
+COPY_CHUNK_SIZE = 1000
+
+
+def _majority(votes):
+    # a tie goes to whichever rating came first
+    ups = sum(votes)
+    if ups * 2 == len(votes):
+        return votes[0]
+    return int(ups * 2 > len(votes))
+
+
+# how conflicting ratings of the same response are settled, given them in the order of the tests
+POLICIES = {
+    "majority": _majority,
+    "first": lambda votes: votes[0],
+    "last": lambda votes: votes[-1],
+    # a thumbs down from anyone wins
+    "min": min,
+    # a thumbs up from anyone wins
+    "max": max,
+}
+
+
+def _open(source, directory):
+    """
+    Opens a test to merge. Tests that are passed in are used as they are, anything else is a tid or file path to load.
+    A json test that's loaded here is copied to a temporary sqlite store in directory and its responses let go of,
+    so only one json test is in memory at a time and every test can be read one pid at a time.
+    """
+    if isinstance(source, ThumbTest):
+        return source, False
+    test = load(source)
+    if test.storage == "json":
+        store = SQLiteStore(os.path.join(directory, f"{len(os.listdir(directory))}.db"))
+        rows = []
+        for row in test._iter_responses():
+            rows.append(row)
+            if len(rows) >= COPY_CHUNK_SIZE:
+                store.insert_responses(rows)
+                rows = []
+        store.insert_responses(rows)
+        # the test keeps saying it's json storage, but reads its responses from the copy
+        test.data = {}
+        test.store = store
+    return test, True
+
+
+def _pids(tests):
+    pids = []
+    for test in tests:
+        stored = test.store.pids() if test.store is not None else list(test.data.keys())
+        for pid in list(test.prompts.keys()) + stored:
+            if pid not in pids:
+                pids.append(pid)
+    return pids
+
+
+def _merge_setup(merged, tests):
+    # the union of everything the tests were set up with, the first test wins where they disagree
+    merged.cases = {}
+    for test in tests:
+        for pid, prompt in test.prompts.items():
+            merged.prompts.setdefault(pid, prompt)
+        for cid, case in test.cases.items():
+            merged.cases.setdefault(cid, case)
+        merged.models += [model for model in test.models if model not in merged.models]
+        for psid, params in test.params.items():
+            merged.params.setdefault(psid, params)
+        merged.sweep += [psid for psid in test.sweep if psid not in merged.sweep]
+        batch_ids = {batch['id'] for batch in merged.batches}
+        merged.batches += [batch for batch in test.batches if batch['id'] not in batch_ids]
+        merged.output_schema = merged.output_schema or test.output_schema
+        merged.task_description = merged.task_description or test.task_description
+        merged.runs = max(merged.runs, test.runs)
+    if not merged.cases:
+        merged.cases = {"base-case": None}
+    if merged.output_schema:
+        merged._add_schema_evaluators()
+
+
+def merge_tests(sources, policy="majority", storage=None, verbose=False):
+    """
+    Merges several tests (tids, file paths or ThumbTests) into a new test. Prompts, cases and models are combined,
+    and a response that's in more than one test (the same run with the same content) is only kept once, with its
+    ratings settled by the policy: "majority", "first", "last", "min" (any thumbs down wins), "max" (any thumbs up
+    wins) or a function that takes the list of ratings. Runs of the same prompt, case and model from different tests
+    are all kept, numbered after each other, and the merged test has as many runs as the test with the most. Responses
+    are merged one prompt at a time, and json tests that are loaded here are read one prompt at a time from a temporary
+    copy, so memory doesn't grow with the number of tests. The merged test uses sqlite storage if any of the tests do,
+    unless storage is given.
+    """
+    resolve = POLICIES.get(policy) if isinstance(policy, str) else policy
+    if resolve is None:
+        raise ValueError(f"Unknown policy {policy}, choose one of {list(POLICIES)} or pass a function")
+    if not sources:
+        raise ValueError("Pass at least one test to merge")
+
+    with tempfile.TemporaryDirectory() as directory:
+        opened = []
+        try:
+            for source in sources:
+                opened.append(_open(source, directory))
+            tests = [test for test, _ in opened]
+            if storage is None:
+                storage = "sqlite" if any(test.storage == "sqlite" for test in tests) else "json"
+
+            merged = ThumbTest(storage=storage, verbose=verbose)
+            _merge_setup(merged, tests)
+
+            # runs that had to be given a new id, so the judgments about them can follow
+            renamed = {}
+            counts = {"responses": 0, "duplicates": 0, "conflicts": 0}
+            for pid in _pids(tests):
+                # (cid, model) -> rid -> (response, ratings)
+                cells = {}
+                # (cid, model, rid, content) -> the rid it's merged under
+                seen = {}
+                for index, test in enumerate(tests):
+                    for _, cid, model, rid, response in test._iter_responses(pid=pid):
+                        cell = cells.setdefault((cid, model), {})
+                        key = (cid, model, rid, content_hash(str(response.get('content'))))
+                        feedback = response.get('feedback')
+
+                        if key in seen:
+                            # a copy of a response we already have, from a test it was shared with
+                            kept, votes = cell[seen[key]]
+                            if feedback is not None:
+                                votes.append(feedback)
+                            for field in AUTO_SCORE_FIELDS:
+                                if response.get(field):
+                                    kept[field] = {**response[field], **(kept.get(field) or {})}
+                            if seen[key] != rid:
+                                renamed[(index, pid, cid, model, rid)] = seen[key]
+                            counts["duplicates"] += 1
+                            continue
+
+                        new_rid = rid
+                        if rid in cell:
+                            # the same run number generated separately in another test, so it's kept as the next free
+                            # run. The test's runs stay the most any test had, so the other cells aren't left incomplete
+                            run = 0
+                            while run_id(pid, cid, model, run) in cell:
+                                run += 1
+                            new_rid = run_id(pid, cid, model, run)
+                            renamed[(index, pid, cid, model, rid)] = new_rid
+                        seen[key] = new_rid
+                        cell[new_rid] = ({key: value for key, value in response.items() if key != 'feedback'}, [] if feedback is None else [feedback])
+
+                rows = []
+                for (cid, model), cell in cells.items():
+                    for rid, (response, votes) in cell.items():
+                        if len(set(votes)) > 1:
+                            counts["conflicts"] += 1
+                        response['feedback'] = resolve(votes) if votes else None
+                        rows.append((pid, cid, model, rid, response))
+                counts["responses"] += merged._add_responses(rows)
+
+            # pairwise judgments, pointing at the runs under their merged ids
+            judgment_ids = set()
+            for index, test in enumerate(tests):
+                for judgment in test.judgments:
+                    if judgment['id'] in judgment_ids:
+                        continue
+                    judgment_ids.add(judgment['id'])
+                    judgment = dict(judgment)
+                    for side in ["a", "b"]:
+                        pid, cid, model, rid = judgment[side]
+                        judgment[side] = [pid, cid, model, renamed.get((index, pid, cid, model, rid), rid)]
+                    merged.judgments.append(judgment)
+        finally:
+            # the temporary copies have to be closed before their directory is removed
+            for test, loaded in opened:
+                if loaded:
+                    test.store.close()
+
+    merged._save_data()
+    if verbose: print(f"Merged {len(tests)} tests into {merged.tid}: {counts['responses']} responses, {counts['duplicates']} duplicates removed, {counts['conflicts']} conflicting ratings settled by {policy if isinstance(policy, str) else 'your policy'}")
+    return merged
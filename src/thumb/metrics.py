@@ -0,0 +1,173 @@
+import re
+import math
+
+import numpy as np
+import pandas as pd
+
+from .utils import content_hash
+
+METRICS = ["exact_match", "bleu", "rouge1", "rouge2"]
+
+
+TOKEN_PATTERN = re.compile(r"\w+|\x00")
+HASH_PRIME = np.uint64(1099511628211)
+
+
+def _flatten_tokens(texts):
+    """
+    Tokenizes every text in one pass, returning the flat integer token ids and the document each one belongs to.
+    """
+    # a separator \w+ can't match marks the end of each document
+    tokens = TOKEN_PATTERN.findall("\x00".join(str(text).lower() for text in texts) + "\x00")
+    codes, uniques = pd.factorize(np.array(tokens, dtype=object))
+    is_sep = np.array([token == "\x00" for token in uniques])[codes]
+    docs = np.cumsum(is_sep) - is_sep
+    return codes[~is_sep].astype(np.int64), docs[~is_sep].astype(np.int64)
+
+
+def _exact_match(ids, docs, num_docs):
+    """
+    Whether each candidate has exactly the same tokens as its reference.
+    """
+    lengths = np.bincount(docs, minlength=2 * num_docs)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    cand_len, ref_len = lengths[:num_docs], lengths[num_docs:]
+    same_length = cand_len == ref_len
+
+    # line up each token of a candidate with the token at the same position in its reference
+    aligned = np.flatnonzero(same_length)
+    counts = cand_len[aligned]
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cand_pos = np.repeat(starts[aligned], counts) + offsets
+    ref_pos = np.repeat(starts[aligned + num_docs], counts) + offsets
+    mismatches = np.bincount(np.repeat(aligned, counts), weights=ids[cand_pos] != ids[ref_pos], minlength=num_docs)
+    return (same_length & (mismatches == 0)).astype(float)
+
+
+def _iter_ngram_hashes(ids, docs, max_n):
+    """
+    Yields (n, document, n-gram hash) arrays for n = 1 to max_n. Each n-gram hash is a rolling hash of the
+    (n-1)-gram at the same position and the next token, so no order needs a lookup table.
+    """
+    hashes = ids.astype(np.uint64)
+    valid = np.ones(len(ids), dtype=bool)
+    yield 1, docs, hashes
+    for n in range(2, max_n + 1):
+        length = len(ids) - n + 1
+        if length <= 0:
+            yield n, np.array([], dtype=np.int64), np.array([], dtype=np.uint64)
+            continue
+        # an n-gram is only valid if it doesn't cross into the next document
+        valid = valid[:length] & (docs[:length] == docs[n-1:])
+        hashes = hashes[:length] * HASH_PRIME + ids[n-1:].astype(np.uint64) + np.uint64(1)
+        yield n, docs[:length][valid], hashes[valid]
+
+
+def _ngram_overlap(docs, hashes, num_docs):
+    """
+    The clipped n-gram matches, candidate n-gram count and reference n-gram count of every pair, as arrays.
+    Documents 0 to num_docs - 1 are the candidates and num_docs onwards are their references.
+    """
+    is_ref = docs >= num_docs
+    pair = np.where(is_ref, docs - num_docs, docs).astype(np.uint64)
+
+    # pack the pair index, n-gram hash and a candidate/reference bit into one integer, so counting
+    # every (pair, n-gram) is a single sort
+    pair_bits = max(int(num_docs).bit_length(), 1)
+    hash_bits = 63 - pair_bits - 1
+    keys = (pair << np.uint64(hash_bits + 1)) | ((hashes & np.uint64((1 << hash_bits) - 1)) << np.uint64(1)) | is_ref.astype(np.uint64)
+    keys, counts = np.unique(keys, return_counts=True)
+
+    # a candidate n-gram is immediately followed by the same n-gram in the reference if they share it
+    shared = (keys[:-1] >> np.uint64(1)) == (keys[1:] >> np.uint64(1))
+    clipped = np.minimum(counts[:-1][shared], counts[1:][shared])
+    matches = np.bincount((keys[:-1][shared] >> np.uint64(hash_bits + 1)).astype(np.int64), weights=clipped, minlength=num_docs)
+
+    cand_total = np.bincount(docs[~is_ref], minlength=num_docs).astype(float)
+    ref_total = np.bincount(docs[is_ref] - num_docs, minlength=num_docs).astype(float)
+    return matches, cand_total, ref_total
+
+
+def _f1(matches, cand_total, ref_total):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(cand_total > 0, matches / cand_total, 0.0)
+        recall = np.where(ref_total > 0, matches / ref_total, 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    return f1
+
+
+def score_references(contents, references, max_n=4):
+    """
+    Scores every response against its reference answer, returning a dict of metric name to array of scores.
+    BLEU uses add-one smoothing for the higher order n-grams, so short responses don't all score zero.
+    """
+    num_docs = len(contents)
+    if num_docs == 0:
+        return {metric: np.array([]) for metric in METRICS}
+
+    # tokenize once, then every n-gram order works on the same integer arrays
+    ids, docs = _flatten_tokens(list(contents) + list(references))
+    lengths = np.bincount(docs, minlength=2 * num_docs).astype(float)
+    exact_match = _exact_match(ids, docs, num_docs)
+
+    log_precision = np.zeros(num_docs)
+    orders = np.zeros(num_docs)
+    rouge = {}
+    for n, ngram_docs, ngram_hashes in _iter_ngram_hashes(ids, docs, max_n):
+        matches, cand_total, ref_total = _ngram_overlap(ngram_docs, ngram_hashes, num_docs)
+        if n <= 2:
+            rouge[n] = _f1(matches, cand_total, ref_total)
+        # responses shorter than n words are scored on the orders they have
+        has_ngrams = cand_total > 0
+        smoothing = 0.0 if n == 1 else 1.0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            precision = (matches + smoothing) / (cand_total + smoothing)
+            log_precision += np.where(has_ngrams, np.log(precision), 0.0)
+        orders += has_ngrams
+
+    cand_len, ref_len = lengths[:num_docs], lengths[num_docs:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        brevity_penalty = np.where(cand_len >= ref_len, 1.0, np.exp(1 - ref_len / np.maximum(cand_len, 1)))
+        bleu = np.where(cand_len > 0, brevity_penalty * np.exp(log_precision / np.maximum(orders, 1)), 0.0)
+
+    return {
+        "exact_match": exact_match,
+        "bleu": np.nan_to_num(bleu),
+        "rouge1": rouge[1],
+        "rouge2": rouge[2],
+    }
+
+
+def reference_hash(content, reference):
+    # changes if either the response or the reference changes, so stale scores are recomputed
+    return content_hash(f"{content}\x00{reference}")
+
+
+def score_responses(items, cache=None):
+    """
+    Scores (key, content, reference) items, returning {key: metrics}. Identical content and reference pairs are only scored once,
+    and pairs already in the cache dict of {content hash: metrics} aren't rescored.
+    """
+    if cache is None:
+        cache = {}
+
+    to_score = {}
+    for _, content, reference in items:
+        content_key = reference_hash(content, reference)
+        if content_key not in cache and content_key not in to_score:
+            to_score[content_key] = (content, reference)
+
+    if to_score:
+        keys = list(to_score.keys())
+        scores = score_references([to_score[k][0] for k in keys], [to_score[k][1] for k in keys])
+        for i, content_key in enumerate(keys):
+            cache[content_key] = {metric: float(scores[metric][i]) for metric in METRICS}
+
+    results = {}
+    for key, content, reference in items:
+        content_key = reference_hash(content, reference)
+        metrics = cache[content_key]
+        if not all(math.isfinite(value) for value in metrics.values()):
+            metrics = {metric: 0.0 for metric in METRICS}
+        results[key] = {"hash": content_key, **metrics}
+    return results
@@ -0,0 +1,150 @@
+import asyncio
+import random
+
+from .llm import format_chat_prompt, get_input_variables, acall
+from .ape import build_candidate_prompt, build_rating_prompt
+
+
+def parse_rating(response):
+    # ratings come back as '1' or '0', anything else counts as a fail
+    content = str(response.get("content", "")).strip()
+    return 1 if content.startswith("1") else 0
+
+
+def is_valid_candidate(prompt, case_keys):
+    """
+    Checks a candidate prompt only uses variables the test cases can fill in.
+    """
+    try:
+        variables = get_input_variables(prompt)
+    except ValueError:
+        # unbalanced curly brackets
+        return False
+    return all(variable in case_keys for variable in variables)
+
+
+class PromptOptimizer:
+    """
+    Searches for better prompts by generating candidates from the best prompts so far, then spending
+    the scoring budget on the survivors of successive halving.
+    """
+
+    def __init__(self, task_description, cases, criteria=None, model="gpt-3.5-turbo", optimizer_model="gpt-4",
+                 scorer=None, max_concurrency=10, verbose=False):
+        self.task_description = task_description
+        # case id -> input variables, with None for the base case
+        self.cases = cases
+        self.criteria = criteria or []
+        self.model = model
+        self.optimizer_model = optimizer_model
+        self.scorer = scorer
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.verbose = verbose
+
+        self.case_keys = set()
+        for case in cases.values():
+            if case:
+                self.case_keys.update(key for key in case.keys() if key != "__ref__")
+
+        # (prompt, cid, run) -> score, so rungs reuse the scores of earlier rungs
+        self.scores = {}
+        self.calls = 0
+
+    async def _acall(self, formatted_prompt, model):
+        async with self.semaphore:
+            self.calls += 1
+            return await acall(formatted_prompt, model=model)
+
+    async def generate_candidates(self, parents, n, temperature=1.0):
+        """
+        Generates n candidate prompts concurrently, spread across the parent prompts.
+        """
+        tasks = []
+        for i in range(n):
+            parent = parents[i % len(parents)] if parents else None
+            candidate_prompt = build_candidate_prompt(self.task_description, prompt_template=parent,
+                test_cases=self.cases, criteria=self.criteria)
+            tasks.append(self._acall(candidate_prompt, {"model": self.optimizer_model, "temperature": temperature}))
+
+        responses = await asyncio.gather(*tasks)
+
+        candidates = []
+        for response in responses:
+            if response.get("error"):
+                continue
+            candidate = response["content"].strip()
+            if candidate and candidate not in candidates and is_valid_candidate(candidate, self.case_keys):
+                candidates.append(candidate)
+        if self.verbose: print(f"Generated {len(candidates)} valid candidates from {n} calls")
+        return candidates
+
+    async def _score_run(self, prompt, cid, run):
+        key = (prompt if isinstance(prompt, str) else "\n".join(prompt), cid, run)
+        if key in self.scores:
+            return self.scores[key]
+
+        test_case = self.cases[cid]
+        try:
+            if test_case:
+                test_case = {k: v for k, v in test_case.items() if k != "__ref__"}
+            formatted_prompt = format_chat_prompt(prompt, test_case)
+        except (KeyError, ValueError):
+            self.scores[key] = 0
+            return 0
+
+        response = await self._acall(formatted_prompt, {"model": self.model})
+        if response.get("error"):
+            score = 0
+        elif self.scorer is not None:
+            score = self.scorer(response["content"], self.cases[cid])
+        else:
+            rating_prompt = build_rating_prompt(self.task_description, response["content"], criteria=self.criteria)
+            score = parse_rating(await self._acall(rating_prompt, {"model": self.optimizer_model, "temperature": 0}))
+
+        self.scores[key] = score
+        return score
+
+    async def score(self, prompt, cids, runs):
+        results = await asyncio.gather(*[self._score_run(prompt, cid, run) for cid in cids for run in range(runs)])
+        return sum(results) / len(results) if results else 0
+
+    async def successive_halving(self, candidates, min_cases=2, runs=1, eta=2, keep=1):
+        """
+        Scores every candidate on a few cases, keeps the best 1/eta, and multiplies the cases by eta for the survivors
+        until only keep candidates are left. Scores already computed in earlier rungs are reused.
+        """
+        cids = list(self.cases.keys())
+        random.shuffle(cids)
+
+        survivors = list(candidates)
+        n_cases = min(min_cases, len(cids))
+        ranked = []
+        while True:
+            sample = cids[:n_cases]
+            results = await asyncio.gather(*[self.score(candidate, sample, runs) for candidate in survivors])
+            ranked = sorted(zip(survivors, results), key=lambda x: x[1], reverse=True)
+            if self.verbose: print(f"Scored {len(survivors)} candidates on {len(sample)} cases: best {ranked[0][1]:.2f}")
+
+            if len(survivors) <= keep:
+                break
+            survivors = [candidate for candidate, _ in ranked[:max(keep, len(survivors) // eta)]]
+            n_cases = min(n_cases * eta, len(cids))
+
+        return ranked[:keep]
+
+    async def optimize(self, prompts, generations=3, candidates=8, min_cases=2, runs=1, eta=2, keep=1):
+        """
+        Runs the generations of the search, returning the best (prompt, score) pairs of each generation.
+        """
+        parents = list(prompts)
+        history = []
+        for generation in range(generations):
+            new_candidates = await self.generate_candidates(parents, candidates)
+            pool = parents + [candidate for candidate in new_candidates if candidate not in parents]
+            if not pool:
+                break
+            best = await self.successive_halving(pool, min_cases=min_cases, runs=runs, eta=eta, keep=keep)
+            history.append(best)
+            parents = [prompt for prompt, _ in best]
+            if self.verbose: print(f"Generation {generation + 1}: best score {best[0][1]:.2f} after {self.calls} calls")
+        return history
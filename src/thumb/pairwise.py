@@ -0,0 +1,141 @@
+import math
+import random
+
+import numpy as np
+import pandas as pd
+
+# spread of a variant's rating before any judgments, in Bradley-Terry logit units
+PRIOR_SIGMA = 2.0
+# noise in each judgment, and the smallest factor a variance can shrink by in one update
+BETA = 1.0
+KAPPA = 1e-4
+# logit units to Elo points, so a 400 point gap means 10 to 1 odds
+ELO_SCALE = 400 / math.log(10)
+ELO_BASE = 1500
+
+
+class PairwiseRatings:
+    """
+    Bradley-Terry ratings learned from pairwise judgments. Each variant has a Gaussian belief over its strength that
+    is updated online after every judgment (the Weng-Lin approximation), so the uncertainty of every rating is known
+    and the next pair can be chosen where a judgment is expected to teach the most.
+    """
+
+    def __init__(self, variants):
+        self.variants = list(variants)
+        self.index = {variant: i for i, variant in enumerate(self.variants)}
+        self.mu = np.zeros(len(self.variants))
+        self.sigma2 = np.full(len(self.variants), PRIOR_SIGMA ** 2)
+        self.comparisons = np.zeros(len(self.variants), dtype=int)
+        self.wins = np.zeros(len(self.variants))
+
+    def update(self, a, b, score):
+        """
+        Records a judgment between variants a and b, where score is 1 if a won, 0 if b won and 0.5 for a tie.
+        """
+        i, j = self.index[a], self.index[b]
+        c = math.sqrt(self.sigma2[i] + self.sigma2[j] + 2 * BETA ** 2)
+        p_i = 1 / (1 + math.exp((self.mu[j] - self.mu[i]) / c))
+        p_j = 1 - p_i
+
+        for k, s, p in [(i, score, p_i), (j, 1 - score, p_j)]:
+            self.mu[k] += self.sigma2[k] / c * (s - p)
+            self.sigma2[k] *= max(1 - self.sigma2[k] / c ** 2 * p_i * p_j, KAPPA)
+            self.comparisons[k] += 1
+            self.wins[k] += s
+
+    def win_probability(self):
+        """
+        The (variants x variants) matrix of the probability the row variant beats the column variant.
+        """
+        c = np.sqrt(self.sigma2[:, None] + self.sigma2[None, :] + 2 * BETA ** 2)
+        return 1 / (1 + np.exp((self.mu[None, :] - self.mu[:, None]) / c))
+
+    def select_pair(self, available=None):
+        """
+        Picks the pair whose judgment is expected to reduce the uncertainty the most: the ones whose outcome is closest
+        to a coin flip, weighted by how uncertain their ratings still are. available is an optional boolean
+        (variants x variants) matrix of the pairs that can be compared. Returns (a, b), or None if no pair is left.
+        """
+        p = self.win_probability()
+        information = p * (1 - p) * (self.sigma2[:, None] + self.sigma2[None, :])
+        np.fill_diagonal(information, -np.inf)
+        if available is not None:
+            information = np.where(available, information, -np.inf)
+        if not np.isfinite(information).any():
+            return None
+
+        # break ties at random so equally informative pairs all get their turn
+        best = np.flatnonzero(information >= information.max() * (1 - 1e-9))
+        i, j = np.unravel_index(random.choice(best), information.shape)
+        return self.variants[i], self.variants[j]
+
+    def to_frame(self, name="variant"):
+        sigma = np.sqrt(self.sigma2)
+        frame = pd.DataFrame({
+            name: self.variants,
+            "rating": ELO_BASE + ELO_SCALE * self.mu,
+            "rating_low": ELO_BASE + ELO_SCALE * (self.mu - 2 * sigma),
+            "rating_high": ELO_BASE + ELO_SCALE * (self.mu + 2 * sigma),
+            "comparisons": self.comparisons,
+            "wins": self.wins,
+        })
+        return frame.sort_values("rating", ascending=False).reset_index(drop=True)
+
+
+class PairPool:
+    """
+    The responses that can be shown against each other. Two responses are only compared if they answer the same case,
+    and come from the same model when comparing prompts (or the same prompt when comparing models), so the only thing
+    that differs is the variant being ranked.
+    """
+
+    def __init__(self, responses, by="pid"):
+        self.by = by
+        # context -> variant -> [(pid, cid, model, rid, content)]
+        self.contexts = {}
+        for pid, cid, model, rid, response in responses:
+            if response.get('error'):
+                continue
+            variant, context = (pid, (cid, model)) if by == "pid" else (model, (cid, pid))
+            self.contexts.setdefault(context, {}).setdefault(variant, []).append((pid, cid, model, rid, response['content']))
+
+    def variants(self, order=()):
+        seen = {variant for variants in self.contexts.values() for variant in variants}
+        return [variant for variant in order if variant in seen] + sorted(seen - set(order))
+
+    def available(self, variants):
+        """
+        The (variants x variants) boolean matrix of pairs with at least one case in common.
+        """
+        index = {variant: i for i, variant in enumerate(variants)}
+        available = np.zeros((len(variants), len(variants)), dtype=bool)
+        for variant_responses in self.contexts.values():
+            present = [index[variant] for variant in variant_responses if variant in index]
+            available[np.ix_(present, present)] = True
+        np.fill_diagonal(available, False)
+        return available
+
+    def sample(self, a, b):
+        """
+        A random pair of responses from variants a and b for a case they share.
+        """
+        shared = [responses for responses in self.contexts.values() if a in responses and b in responses]
+        if not shared:
+            return None
+        responses = random.choice(shared)
+        return random.choice(responses[a]), random.choice(responses[b])
+
+
+def replay_judgments(judgments, variants, by="pid"):
+    """
+    Rebuilds the ratings from saved judgments, in the order they were made.
+    """
+    ratings = PairwiseRatings(variants)
+    for judgment in judgments:
+        if judgment.get('by', "pid") != by:
+            continue
+        a, b = judgment['a'][0 if by == "pid" else 2], judgment['b'][0 if by == "pid" else 2]
+        if a in ratings.index and b in ratings.index:
+            ratings.update(a, b, judgment['score'])
+    return ratings
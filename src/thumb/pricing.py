@@ -0,0 +1,171 @@
+import datetime
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# dollars per million (prompt, completion) tokens, by the date the prices changed. Each version only lists what
+# changed, a model keeps its price from earlier versions until it changes again.
+PRICES = {
+    "2023-06-13": {
+        "gpt-4": (30, 60),
+        "gpt-4-32k": (60, 120),
+        "gpt-3.5-turbo": (1.5, 2),
+        "gpt-3.5-turbo-16k": (3, 4),
+        "text-davinci-003": (20, 20),
+        "claude-2": (11.02, 32.68),
+        "claude-instant-1": (1.63, 5.51),
+    },
+    "2023-08-22": {
+        "ft:gpt-3.5-turbo": (12, 16),
+        "babbage-002": (0.4, 0.4),
+        "davinci-002": (2, 2),
+    },
+    "2023-09-18": {
+        "gpt-3.5-turbo-instruct": (1.5, 2),
+    },
+    "2023-11-06": {
+        "gpt-4-1106-preview": (10, 30),
+        "gpt-4-vision-preview": (10, 30),
+        "gpt-3.5-turbo-1106": (1, 2),
+        "ft:gpt-3.5-turbo": (3, 6),
+    },
+    "2023-11-21": {
+        "claude-2": (8, 24),
+        "claude-2.1": (8, 24),
+    },
+}
+
+# what each tier pays for (prompt, completion) tokens, as a share of the standard price
+TIERS = {
+    "standard": (1, 1),
+    "batch": (0.5, 0.5),
+}
+
+# cached prompt tokens cost this share of the prompt price
+CACHED_PROMPT_SHARE = 0.5
+
+# snapshots that cost the same as the model they're a snapshot of. Other snapshots need their own price, since a newer
+# one (like gpt-4-0125-preview) is often priced differently from its base model.
+SNAPSHOTS = {
+    "gpt-4-0314": "gpt-4",
+    "gpt-4-0613": "gpt-4",
+    "gpt-4-32k-0314": "gpt-4-32k",
+    "gpt-4-32k-0613": "gpt-4-32k",
+    "gpt-3.5-turbo-0301": "gpt-3.5-turbo",
+    "gpt-3.5-turbo-0613": "gpt-3.5-turbo",
+    "gpt-3.5-turbo-16k-0613": "gpt-3.5-turbo-16k",
+    "gpt-3.5-turbo-instruct-0914": "gpt-3.5-turbo-instruct",
+    "ft:gpt-3.5-turbo-0613": "ft:gpt-3.5-turbo",
+    "claude-2.0": "claude-2",
+    "claude-instant-1.1": "claude-instant-1",
+    "claude-instant-1.2": "claude-instant-1",
+}
+
+
+class PricingRegistry:
+    """
+    The price of every model over time, so costs can be worked out from the token counts for any version of the prices,
+    in any tier. Add your own models (or price changes) with register.
+    """
+
+    def __init__(self, prices=None, tiers=None, cached_prompt_share=CACHED_PROMPT_SHARE):
+        self.prices = {version: dict(table) for version, table in (prices or PRICES).items()}
+        self.tiers = dict(tiers or TIERS)
+        self.cached_prompt_share = cached_prompt_share
+        self._tables = {}
+        self._warned = set()
+
+    @property
+    def latest(self):
+        return max(self.prices)
+
+    def register(self, model, prompt, completion, version=None):
+        """
+        Sets the price of a model in dollars per million prompt and completion tokens, from version (a date like
+        "2024-01-25", today by default) on.
+        """
+        version = version or datetime.date.today().isoformat()
+        self.prices.setdefault(version, {})[model] = (prompt, completion)
+        self._tables = {}
+
+    def table(self, version=None):
+        """
+        Every model's price as of a version, the latest by default.
+        """
+        version = version or self.latest
+        if version not in self._tables:
+            table = {}
+            for changed in sorted(self.prices):
+                if changed <= version:
+                    table.update(self.prices[changed])
+            self._tables[version] = table
+        return self._tables[version]
+
+    def lookup(self, model, version=None):
+        """
+        The (prompt, completion) price of a model, matching the snapshots in SNAPSHOTS and fine-tunes to their base
+        model. Returns None for a model there's no price for, with a warning the first time.
+        """
+        table = self.table(version)
+        name = str(model).split("/")[-1].replace("gpt-35", "gpt-3.5")
+        if name.startswith("ft:"):
+            # ft:gpt-3.5-turbo-0613:org:suffix:id is priced as a gpt-3.5-turbo fine-tune
+            name = "ft:" + name[3:].split(":")[0]
+        if name not in table:
+            name = SNAPSHOTS.get(name, name)
+        if name not in table:
+            if model not in self._warned:
+                self._warned.add(model)
+                warnings.warn(f"There's no price for {model}, add one with thumb.pricing.registry.register")
+            return None
+        return table[name]
+
+    def rates(self, model, tier="standard", version=None):
+        # dollars per (uncached prompt, cached prompt, completion) token, NaN if there's no price for the model
+        price = self.lookup(model, version)
+        if price is None:
+            return (np.nan, np.nan, np.nan)
+        if tier not in self.tiers:
+            raise ValueError(f"Unknown pricing tier {tier}, choose one of {list(self.tiers)}")
+        prompt_share, completion_share = self.tiers[tier]
+        prompt = price[0] * prompt_share / 1e6
+        return (prompt, prompt * self.cached_prompt_share, price[1] * completion_share / 1e6)
+
+    def cost(self, prompt_tokens, completion_tokens, model, tier=None, cached_tokens=0, version=None):
+        """
+        The cost in dollars of one call, or None if there's no price for the model.
+        """
+        prompt, cached, completion = self.rates(model, tier or "standard", version)
+        if np.isnan(prompt):
+            return None
+        cached_tokens = cached_tokens or 0
+        return ((prompt_tokens or 0) - cached_tokens) * prompt + cached_tokens * cached + (completion_tokens or 0) * completion
+
+    def costs(self, models, prompt_tokens, completion_tokens, tiers=None, cached_tokens=None, version=None):
+        """
+        The cost of many calls (or totals of calls) at once, given equal length sequences. Prices are looked up once for
+        each model and tier, then multiplied by the token counts as arrays. Calls without a price cost NaN.
+        """
+        models = pd.Series(models, dtype=object)
+        tiers = pd.Series("standard" if tiers is None else tiers, index=models.index, dtype=object).fillna("standard")
+        codes, pairs = pd.factorize(pd.MultiIndex.from_arrays([models, tiers]))
+        rates = np.array([self.rates(model, tier, version) for model, tier in pairs], dtype=float).reshape(-1, 3)[codes]
+
+        prompt_tokens = np.nan_to_num(np.asarray(prompt_tokens, dtype=float))
+        completion_tokens = np.nan_to_num(np.asarray(completion_tokens, dtype=float))
+        cached_tokens = np.zeros_like(prompt_tokens) if cached_tokens is None else np.nan_to_num(np.asarray(cached_tokens, dtype=float))
+        return (prompt_tokens - cached_tokens) * rates[:, 0] + cached_tokens * rates[:, 1] + completion_tokens * rates[:, 2]
+
+
+# the prices used unless a test is given its own registry
+registry = PricingRegistry()
+
+
+def estimate_cost(prompt_tokens, completion_tokens, model, tier=None, cached_tokens=0, version=None):
+    return registry.cost(prompt_tokens, completion_tokens, model, tier=tier, cached_tokens=cached_tokens, version=version)
+
+
+def cached_tokens(usage):
+    # prompt tokens that were read from the provider's prompt cache, if it reports them
+    return (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
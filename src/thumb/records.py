@@ -0,0 +1,180 @@
+import sys
+from numbers import Integral, Real
+
+# the fields stored in slots, any other key goes in the extra dict
+FIELDS = ("content", "error", "tokens", "cost", "prompt_tokens", "completion_tokens", "latency", "temperature", "feedback")
+INT_FIELDS = ("tokens", "prompt_tokens", "completion_tokens")
+FLOAT_FIELDS = ("cost", "latency", "temperature")
+
+
+class _Missing:
+    __slots__ = ()
+
+    def __repr__(self):
+        return "MISSING"
+
+
+MISSING = _Missing()
+
+# every distinct order of keys, shared between the records that have it since there are only ever a few
+_ORDERS = {}
+
+
+def _order(keys):
+    keys = tuple(keys)
+    return _ORDERS.setdefault(keys, keys)
+
+
+def _plain(key, value):
+    # numpy scalars become plain python numbers so they serialize, builtin values are left exactly as they are
+    if value is None or type(value) in (bool, int, float, str):
+        return value
+    if key in INT_FIELDS and isinstance(value, Integral):
+        return int(value)
+    if key in FLOAT_FIELDS and isinstance(value, Real):
+        return int(value) if isinstance(value, Integral) else float(value)
+    if key == "feedback" and isinstance(value, Integral):
+        return int(value)
+    return value
+
+
+class Response:
+    """
+    A single response, stored in slots instead of a dict to save memory on large tests.
+    Behaves like the dict it replaces, and serializes to exactly the same JSON, with the keys in the order they were
+    added so a cache file doesn't change when it's loaded and saved again. Keys other than the standard fields (like
+    metrics or evals) are kept in an extra dict.
+    """
+
+    __slots__ = FIELDS + ("extra", "order")
+
+    def __init__(self, fields=None, **kwargs):
+        for key in FIELDS:
+            object.__setattr__(self, key, MISSING)
+        self.extra = None
+        self.order = _order(())
+        if fields:
+            self.update(fields)
+        if kwargs:
+            self.update(kwargs)
+
+    @classmethod
+    def from_dict(cls, fields):
+        if isinstance(fields, cls):
+            return fields
+        return cls(fields)
+
+    def __getitem__(self, key):
+        if key in FIELDS:
+            value = getattr(self, key)
+            if value is MISSING:
+                raise KeyError(key)
+            return value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.order = _order(self.order + (key,))
+        if key in FIELDS:
+            setattr(self, key, _plain(key, value))
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in FIELDS:
+            if getattr(self, key) is MISSING:
+                raise KeyError(key)
+            setattr(self, key, MISSING)
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+            if not self.extra:
+                self.extra = None
+        else:
+            raise KeyError(key)
+        self.order = _order(existing for existing in self.order if existing != key)
+
+    def __contains__(self, key):
+        if key in FIELDS:
+            return getattr(self, key) is not MISSING
+        return self.extra is not None and key in self.extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.order)
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def update(self, fields):
+        for key, value in (fields.items() if hasattr(fields, "items") else fields):
+            self[key] = value
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (Response, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return f"Response({self.to_dict()!r})"
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        Response.__init__(self, state)
+
+
+def to_json(value):
+    # default hook for json.dumps, so responses serialize as plain dicts
+    if isinstance(value, Response):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def compact_data(data):
+    """
+    Converts the nested {pid: {cid: {model: {rid: response}}}} dict to use Response records,
+    with the ids interned so each one is only stored once however many responses share it.
+    """
+    compacted = {}
+    for pid, pid_data in data.items():
+        pid = sys.intern(pid)
+        compacted[pid] = {}
+        for cid, cid_data in pid_data.items():
+            cid = sys.intern(cid)
+            compacted[pid][cid] = {}
+            for model, model_data in cid_data.items():
+                model = sys.intern(model)
+                compacted[pid][cid][model] = {sys.intern(rid): Response.from_dict(response) for rid, response in model_data.items()}
+    return compacted
@@ -0,0 +1,236 @@
+import os
+import json
+import math
+import html
+import shutil
+
+from .dashboard import LEVELS, COLUMNS
+
+# columns of the responses table on each prompt's page
+RESPONSE_COLUMNS = ["cid", "model", "rid", "content", "feedback", "tokens", "cost", "latency", "scores"]
+
+STYLE = """
+body { font-family: -apple-system, Segoe UI, Helvetica, Arial, sans-serif; margin: 2em; color: #222; }
+table { border-collapse: collapse; margin: 1em 0; }
+th, td { border: 1px solid #ddd; padding: 4px 8px; text-align: right; vertical-align: top; }
+th { background: #f5f5f5; }
+td.text { text-align: left; white-space: pre-wrap; max-width: 60em; }
+.pager button { margin: 0 4px; }
+"""
+
+# pages are loaded as scripts rather than fetched, browsers block fetching local files opened from disk
+SCRIPT = """
+window.thumbReport = (function () {
+  var tables = {};
+
+  function format(value) {
+    if (value === null || value === undefined) return "";
+    if (typeof value === "number") return Number.isInteger(value) ? String(value) : value.toPrecision(4);
+    if (typeof value === "object") return Object.keys(value).map(function (key) { return key + ": " + format(value[key]); }).join(", ");
+    return String(value);
+  }
+
+  function render(name) {
+    var table = tables[name];
+    var rows = table.pages[table.page];
+    var body = document.querySelector("#" + name + " tbody");
+    body.textContent = "";
+    rows.forEach(function (row) {
+      var tr = document.createElement("tr");
+      table.columns.forEach(function (column) {
+        var td = document.createElement("td");
+        if (typeof row[column] === "string") td.className = "text";
+        td.textContent = format(row[column]);
+        tr.appendChild(td);
+      });
+      body.appendChild(tr);
+    });
+    document.querySelector("#" + name + " .page").textContent = "Page " + (table.page + 1) + " of " + table.count;
+  }
+
+  function show(name, page) {
+    var table = tables[name];
+    if (page < 0 || page >= table.count) return;
+    table.page = page;
+    if (table.pages[page]) return render(name);
+    var script = document.createElement("script");
+    script.src = table.path + "/page-" + (page + 1) + ".js";
+    document.body.appendChild(script);
+  }
+
+  return {
+    table: function (name, path, columns, count) {
+      tables[name] = { path: path, columns: columns, count: count, page: 0, pages: {} };
+      if (count > 0) show(name, 0);
+    },
+    loaded: function (name, page, rows) {
+      tables[name].pages[page] = rows;
+      if (tables[name].page === page) render(name);
+    },
+    next: function (name) { show(name, tables[name].page + 1); },
+    previous: function (name) { show(name, tables[name].page - 1); }
+  };
+})();
+"""
+
+
+def _short(value, length=200):
+    text = value if isinstance(value, str) else json.dumps(value)
+    return text if len(text) <= length else text[:length] + "…"
+
+
+def _page(title, body, depth=0):
+    root = "../" * depth
+    return (
+        f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>{html.escape(title)}</title>"
+        f"<link rel='stylesheet' href='{root}report.css'><script src='{root}report.js'></script></head>"
+        f"<body>{body}</body></html>"
+    )
+
+
+def _paged_table(name, path, columns, count):
+    # an empty table that the script fills in one page at a time
+    header = "".join(f"<th>{html.escape(column)}</th>" for column in columns)
+    return (
+        f"<div id='{name}'><div class='pager'><button onclick=\"thumbReport.previous('{name}')\">Previous</button>"
+        f"<span class='page'>No rows</span><button onclick=\"thumbReport.next('{name}')\">Next</button></div>"
+        f"<table><thead><tr>{header}</tr></thead><tbody></tbody></table></div>"
+        f"<script>thumbReport.table('{name}', '{path}', {json.dumps(columns)}, {count});</script>"
+    )
+
+
+class PageWriter:
+    """
+    Writes rows to numbered script files of page_size rows each, so only one page is ever held in memory.
+    """
+
+    def __init__(self, directory, name, page_size):
+        self.directory = directory
+        self.name = name
+        self.page_size = page_size
+        self.rows = []
+        self.pages = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.page_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        # </script> in a response can't end the script early once escaped
+        data = json.dumps(self.rows, default=str).replace("</", "<\\/")
+        with open(os.path.join(self.directory, f"page-{self.pages + 1}.js"), "w", encoding="utf8") as file:
+            file.write(f"thumbReport.loaded({json.dumps(self.name)}, {self.pages}, {data});\n")
+        self.pages += 1
+        self.rows = []
+
+
+def _clean(value):
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def _summary_table(frame):
+    return frame.to_html(index=False, float_format="{:.4g}".format, na_rep="")
+
+
+def write_report(test, directory, page_size=200):
+    """
+    Writes a static report of the test to a directory: an index with the results by prompt, model and case, the full
+    breakdown in pages, and a page for each prompt with all its responses, loaded a page at a time. Responses are
+    streamed from the test one prompt at a time, so memory stays bounded however big the test is. Returns the path
+    to the index.
+    """
+    if os.path.exists(directory) and os.listdir(directory):
+        # only ever replace an old report, not a directory that has something else in it
+        if not os.path.exists(os.path.join(directory, "report.js")):
+            raise ValueError(f"{directory} isn't empty, choose a new directory for the report")
+        shutil.rmtree(directory)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "report.css"), "w") as file:
+        file.write(STYLE)
+    with open(os.path.join(directory, "report.js"), "w") as file:
+        file.write(SCRIPT)
+
+    aggregator = test._aggregator()
+    auto_scores = test._auto_scores()
+
+    # the full breakdown can be as big as prompts x cases x models, so it's paged too
+    full_columns = LEVELS["full"] + COLUMNS
+    full = PageWriter(os.path.join(directory, "data", "full"), "full", page_size)
+    for key in sorted(aggregator.groups["full"].keys()):
+        row = aggregator.row("full", key)
+        full.add({**dict(zip(LEVELS["full"], key)), **{column: _clean(row[column]) for column in COLUMNS}})
+    full.flush()
+
+    pid_frame = aggregator.to_frame("pid")
+    pid_frame["PID"] = [f"<a href='prompts/{pid}.html'>{pid}</a>" for pid in pid_frame["PID"]]
+    body = f"<h1>ThumbTest: {html.escape(test.tid)}</h1><h2>Prompts</h2>"
+    body += pid_frame.to_html(index=False, escape=False, float_format="{:.4g}".format, na_rep="")
+    if len(aggregator.groups["model"]) > 1:
+        body += f"<h2>Models</h2>{_summary_table(aggregator.to_frame('model'))}"
+    if len(aggregator.groups["cid"]) > 1:
+        body += f"<h2>Cases</h2>{_summary_table(aggregator.to_frame('cid'))}"
+    body += f"<h2>By prompt, case and model</h2>{_paged_table('full', 'data/full', full_columns, full.pages)}"
+
+    # the keys, shortened so a long prompt or case doesn't swamp the page
+    body += "<h2>Prompt key</h2>" + "".join(
+        f"<p><a href='prompts/{pid}.html'>{pid}</a>: {html.escape(_short(prompt))}</p>" for pid, prompt in test.prompts.items()
+    )
+    if len(test.cases) > 1:
+        # there can be thousands of cases
+        cases = PageWriter(os.path.join(directory, "data", "cases"), "cases", page_size)
+        for cid, case in test.cases.items():
+            cases.add({"cid": cid, "case": _short(case, length=1000)})
+        cases.flush()
+        body += f"<h2>Case key</h2>{_paged_table('cases', 'data/cases', ['cid', 'case'], cases.pages)}"
+
+    with open(os.path.join(directory, "index.html"), "w", encoding="utf8") as file:
+        file.write(_page(f"ThumbTest: {test.tid}", body))
+
+    groups_by_pid = {}
+    for key, totals in aggregator.groups["full"].items():
+        groups_by_pid.setdefault(key[0], []).append(dict(zip(LEVELS["full"], key), **totals.row()))
+
+    # a drill-down page for each prompt, streaming its responses into pages
+    os.makedirs(os.path.join(directory, "prompts"))
+    for pid, prompt in test.prompts.items():
+        responses = PageWriter(os.path.join(directory, "data", pid), "responses", page_size)
+        for _, cid, model, rid, response in test._iter_responses(pid=pid):
+            scores = {}
+            for field in ["metrics", "evals"]:
+                scores.update({key: value for key, value in (response.get(field) or {}).items() if key != "hash"})
+            responses.add({
+                "cid": cid,
+                "model": model,
+                "rid": rid,
+                "content": response.get("content"),
+                "feedback": response.get("feedback"),
+                "tokens": response.get("tokens"),
+                "cost": response.get("cost"),
+                "latency": response.get("latency"),
+                "scores": scores or None,
+            })
+        responses.flush()
+
+        body = f"<p><a href='../index.html'>Back to the results</a></p><h1>Prompt {pid}</h1>"
+        body += f"<pre class='text'>{html.escape(prompt if isinstance(prompt, str) else json.dumps(prompt, indent=2))}</pre>"
+        rows = groups_by_pid.get(pid, [])
+        if rows:
+            body += "<h2>By case and model</h2><table><tr>" + "".join(f"<th>{column}</th>" for column in ["CID", "Model"] + COLUMNS) + "</tr>"
+            for row in sorted(rows, key=lambda row: (row["CID"], row["Model"])):
+                cells = [row["CID"], row["Model"]] + [_clean(row[column]) for column in COLUMNS]
+                body += "<tr>" + "".join(f"<td>{'' if cell is None else html.escape(f'{cell:.4g}' if isinstance(cell, float) else str(cell))}</td>" for cell in cells) + "</tr>"
+            body += "</table>"
+        if auto_scores.get(pid):
+            body += "<p>" + ", ".join(f"{html.escape(key)}: {value:.4g}" for key, value in auto_scores[pid].items()) + "</p>"
+        body += f"<h2>Responses</h2>{_paged_table('responses', f'../data/{pid}', RESPONSE_COLUMNS, responses.pages)}"
+
+        with open(os.path.join(directory, "prompts", f"{pid}.html"), "w", encoding="utf8") as file:
+            file.write(_page(f"Prompt {pid}", body, depth=1))
+
+    return os.path.join(directory, "index.html")
@@ -0,0 +1,258 @@
+import os
+import json
+import sqlite3
+
+# columns stored natively, everything else on a response goes in the extra json column
+RESPONSE_COLUMNS = ["content", "tokens", "cost", "prompt_tokens", "completion_tokens", "latency"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    pid TEXT NOT NULL,
+    cid TEXT NOT NULL,
+    model TEXT NOT NULL,
+    rid TEXT NOT NULL,
+    content TEXT,
+    tokens INTEGER,
+    cost REAL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    latency REAL,
+    feedback INTEGER,
+    extra TEXT,
+    PRIMARY KEY (pid, cid, model, rid)
+);
+CREATE INDEX IF NOT EXISTS idx_responses_pid ON responses (pid);
+CREATE INDEX IF NOT EXISTS idx_responses_cid ON responses (cid);
+CREATE INDEX IF NOT EXISTS idx_responses_model ON responses (model);
+CREATE INDEX IF NOT EXISTS idx_responses_feedback ON responses (feedback);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# the pricing tier a response was billed at
+TIER = "COALESCE(json_extract(extra, '$.tier'), 'standard')"
+NOT_CHAIN = "json_extract(extra, '$.steps') IS NULL"
+
+
+class SQLiteStore:
+    """
+    Stores the responses of a ThumbTest in a SQLite database in WAL mode.
+    Responses are only read when they're asked for, so large tests don't have to fit in memory.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+        directory = os.path.dirname(file_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # autocommit mode, transactions are opened explicitly
+        self.conn = sqlite3.connect(file_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=30000")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _row_to_response(self, row):
+        # rebuild the response dict in the same key order as the json cache
+        content, tokens, cost, prompt_tokens, completion_tokens, latency, feedback, extra = row
+        response = {"content": content}
+        extra = json.loads(extra) if extra else {}
+        if "error" in extra:
+            response["error"] = extra.pop("error")
+        for key, value in zip(RESPONSE_COLUMNS[1:], [tokens, cost, prompt_tokens, completion_tokens, latency]):
+            if value is not None:
+                response[key] = value
+        response.update(extra)
+        response["feedback"] = feedback
+        return response
+
+    def _response_to_row(self, pid, cid, model, rid, response):
+        extra = {key: value for key, value in response.items() if key not in RESPONSE_COLUMNS and key != "feedback"}
+        return (
+            pid, cid, model, rid,
+            *[response.get(key) for key in RESPONSE_COLUMNS],
+            response.get("feedback"),
+            json.dumps(extra) if extra else None,
+        )
+
+    def insert_responses(self, rows):
+        """
+        Insert a batch of (pid, cid, model, rid, response) rows in a single transaction.
+        Rows with a rid that has already been stored are ignored.
+        """
+        records = [self._response_to_row(*row) for row in rows]
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO responses (pid, cid, model, rid, content, tokens, cost, prompt_tokens, completion_tokens, latency, feedback, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                records,
+            )
+
+    def update_responses(self, updates):
+        """
+        Merge new fields into existing responses, given a list of (pid, cid, model, rid, fields).
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for pid, cid, model, rid, fields in updates:
+                row = self.conn.execute(
+                    "SELECT content, tokens, cost, prompt_tokens, completion_tokens, latency, feedback, extra FROM responses "
+                    "WHERE pid = ? AND cid = ? AND model = ? AND rid = ?",
+                    (pid, cid, model, rid),
+                ).fetchone()
+                if row is None:
+                    continue
+                response = self._row_to_response(row)
+                response.update(fields)
+                self.conn.execute(
+                    "REPLACE INTO responses (pid, cid, model, rid, content, tokens, cost, prompt_tokens, completion_tokens, latency, feedback, extra) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    self._response_to_row(pid, cid, model, rid, response),
+                )
+
+    def set_feedback(self, pid, cid, model, rid, value):
+        self.conn.execute(
+            "UPDATE responses SET feedback = ? WHERE pid = ? AND cid = ? AND model = ? AND rid = ?",
+            (value, pid, cid, model, rid),
+        )
+
+    def rids(self, pid, cid, model):
+        cursor = self.conn.execute(
+            "SELECT rid FROM responses WHERE pid = ? AND cid = ? AND model = ?", (pid, cid, model)
+        )
+        return [row[0] for row in cursor]
+
+    def iter_responses(self, pid=None, unlabeled=False):
+        """
+        Stream (pid, cid, model, rid, response) tuples, optionally for one pid or only those without feedback.
+        """
+        query = "SELECT pid, cid, model, rid, content, tokens, cost, prompt_tokens, completion_tokens, latency, feedback, extra FROM responses"
+        conditions, params = [], []
+        if pid is not None:
+            conditions.append("pid = ?")
+            params.append(pid)
+        if unlabeled:
+            conditions.append("feedback IS NULL")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY pid, cid, model, rid"
+
+        # use a separate cursor so callers can write while iterating
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+        for row in cursor:
+            yield (*row[:4], self._row_to_response(row[4:]))
+
+    def unlabeled(self):
+        """
+        The id and content of every response without feedback, in random order.
+        """
+        cursor = self.conn.execute(
+            "SELECT pid, cid, model, rid, content FROM responses WHERE feedback IS NULL ORDER BY RANDOM()"
+        )
+        return [{"pid": pid, "cid": cid, "model": model, "rid": rid, "content": content} for pid, cid, model, rid, content in cursor]
+
+    def pids(self):
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT pid FROM responses ORDER BY pid")]
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def pid_values(self):
+        """
+        The feedback, tokens and cost of every response for each pid, in the order responses are iterated.
+        """
+        cursor = self.conn.execute(
+            "SELECT pid, feedback, tokens, cost FROM responses ORDER BY pid, cid, model, rid"
+        )
+        values = {}
+        for pid, feedback, tokens, cost in cursor:
+            pid_values = values.setdefault(pid, {"feedback": [], "tokens": [], "cost": []})
+            pid_values["feedback"].append(feedback)
+            pid_values["tokens"].append(tokens)
+            pid_values["cost"].append(cost)
+        return values
+
+    def field_stats(self, field):
+        """
+        The average of each numeric value in a dict field of the responses (like metrics), for each pid.
+        """
+        cursor = self.conn.execute(
+            "SELECT pid, j.key, AVG(j.value) FROM responses, json_each(responses.extra, '$.' || ?) AS j "
+            "WHERE j.type IN ('integer', 'real', 'true', 'false') GROUP BY pid, j.key",
+            (field,),
+        )
+        stats = {}
+        for pid, key, value in cursor:
+            stats.setdefault(pid, {})[key] = value
+        return stats
+
+    def group_stats(self):
+        """
+        Runs, feedback and averages for each pid, cid and model combination.
+        """
+        cursor = self.conn.execute(
+            "SELECT pid, cid, model, COUNT(*), SUM(feedback), AVG(feedback), AVG(tokens), AVG(cost), AVG(latency) "
+            "FROM responses GROUP BY pid, cid, model"
+        )
+        return cursor.fetchall()
+
+    def group_totals(self):
+        """
+        Runs, labeled runs, and the summed feedback, tokens, cost and latency (with how many of each were recorded)
+        for each pid, cid and model combination.
+        """
+        cursor = self.conn.execute(
+            "SELECT pid, cid, model, COUNT(*), COUNT(feedback), SUM(feedback), SUM(tokens), COUNT(tokens), "
+            "SUM(cost), COUNT(cost), SUM(latency), COUNT(latency) FROM responses GROUP BY pid, cid, model"
+        )
+        return cursor.fetchall()
+
+    def token_totals(self):
+        """
+        Runs and the summed prompt, cached and completion tokens for each pid, cid, model and pricing tier, leaving out
+        chain runs, whose steps can each run on a different model.
+        """
+        cursor = self.conn.execute(
+            f"SELECT pid, cid, model, {TIER}, COUNT(*), SUM(prompt_tokens), "
+            "SUM(COALESCE(json_extract(extra, '$.cached_tokens'), 0)), SUM(completion_tokens) "
+            f"FROM responses WHERE {NOT_CHAIN} GROUP BY pid, cid, model, {TIER}"
+        )
+        return cursor.fetchall()
+
+    def set_costs(self, rates):
+        """
+        Recomputes the cost of every response from its token counts, given (model, tier, prompt, cached, completion)
+        prices per token. Chain runs are left alone.
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "UPDATE responses SET cost = (COALESCE(prompt_tokens, 0) - COALESCE(json_extract(extra, '$.cached_tokens'), 0)) * ? "
+                "+ COALESCE(json_extract(extra, '$.cached_tokens'), 0) * ? + COALESCE(completion_tokens, 0) * ? "
+                f"WHERE model = ? AND {TIER} = ? AND {NOT_CHAIN}",
+                [(prompt, cached, completion, model, tier) for model, tier, prompt, cached, completion in rates],
+            )
+
+    def data_version(self):
+        # changes whenever another connection commits to the database
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def get_meta(self):
+        return {key: json.loads(value) for key, value in self.conn.execute("SELECT key, value FROM meta")}
+
+    def set_meta(self, meta):
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in meta.items()],
+            )
@@ -4,4 +4,16 @@ def hash_id(string):
     # hash to get a unique id that will be the same if passed the same string
     hash = hashlib.md5(string.encode()).hexdigest()
     hash_id = hash[:8]
-    return hash_id
\ No newline at end of file
+    return hash_id
+
+def run_id(pid, cid, model, index):
+    # the same run of a prompt, case and model always gets the same id, so resumed tests redo exactly the missing runs
+    return hash_id(f"{pid}/{cid}/{model}/{index}")
+
+def escape_braces(string):
+    # double the curly brackets so text isn't read as template variables when formatted
+    return string.replace("{", "{{").replace("}", "}}")
+
+def content_hash(string):
+    # longer than hash_id, so caches keyed on response content don't collide across large tests
+    return hashlib.md5(string.encode()).hexdigest()[:16]